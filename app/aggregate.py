@@ -1,60 +1,278 @@
 from __future__ import annotations
+import threading
 from pathlib import Path
 from datetime import datetime
 import pandas as pd
-from typing import List, Dict, Any
+import pyarrow as pa
+from typing import List, Dict, Any, Optional
 
-AGG_ROWS = "agg_rows"               # lista de dicts (linhas)
-AGG_REPORT = "agg_report"           # lista de dicts (status por arquivo)
+AGG_STORE = "agg_store"             # AggStore da sessão (linhas + relatório)
+AGG_EXPORT = "agg_export"           # AggExport dos downloads do lote
+
+def _column(values: List[Any]) -> pa.Array:
+    """Coluna Arrow pelo tipo inferido; tipos misturados (ex.: 12 e '12 un') viram texto."""
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([None if v is None else str(v) for v in values], pa.string())
+
+def _unify(tables: List[pa.Table]) -> pa.Table:
+    """Concatena lotes com colunas diferentes; conflito de tipo numa coluna -> texto."""
+    try:
+        return pa.concat_tables(tables, promote_options="permissive")
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        types: Dict[str, set] = {}
+        for t in tables:
+            for f in t.schema:
+                types.setdefault(f.name, set()).add(f.type)
+        mixed = {name for name, ts in types.items() if len(ts - {pa.null()}) > 1}
+        fixed = []
+        for t in tables:
+            for name in mixed & set(t.column_names):
+                i = t.column_names.index(name)
+                col = pa.array([None if v is None else str(v) for v in t.column(i).to_pylist()], pa.string())
+                t = t.set_column(i, name, col)
+            fixed.append(t)
+        return pa.concat_tables(fixed, promote_options="permissive")
+
+def _float_ints(table: pa.Table) -> frozenset:
+    """Colunas inteiras com algum nulo: table.to_pandas() as converte para float64."""
+    return frozenset(f.name for f, col in zip(table.schema, table.columns)
+                     if pa.types.is_integer(f.type) and col.null_count)
+
+def _pandas_slice(table: pa.Table, offset: int) -> pd.DataFrame:
+    """
+    table[offset:] em pandas com os mesmos dtypes de table.to_pandas() (senão o CSV
+    acrescentado escreveria "2" onde o completo escreve "2.0").
+    """
+    part = table.slice(offset)
+    for name in _float_ints(table):
+        i = part.column_names.index(name)
+        part = part.set_column(i, name, part.column(i).cast(pa.float64()))
+    return part.to_pandas()
+
+class AggStore:
+    """
+    Agregado do lote: linhas em lotes Arrow só de acréscimo + relatório por arquivo.
+    A visão em DataFrame fica em cache e só é refeita depois de um acréscimo
+    (version muda). Pode receber linhas de threads de workers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables: List[pa.Table] = []
+        self._n_rows = 0
+        self.version = 0
+        self._table: Optional[pa.Table] = None
+        self._df: Optional[pd.DataFrame] = None
+        self._df_version = -1
+        self._report: List[Dict[str, Any]] = []
+        self.report_version = 0
+        self._report_df: Optional[pd.DataFrame] = None
+        self._report_df_version = -1
+
+    @property
+    def n_rows(self) -> int:
+        return self._n_rows
+
+    def append_rows(self, rows: List[Dict[str, Any]], *, source_pdf: str, page_idx: int,
+                    table_name: Optional[str]) -> int:
+        if not rows:
+            return 0
+        names: Dict[str, None] = {}  # ordem de primeira aparição
+        for r in rows:
+            names.update(dict.fromkeys(r))
+        for meta in ("_source_pdf", "_page_idx", "_table_name"):
+            names.pop(meta, None)
+        cols = {c: _column([r.get(c) for r in rows]) for c in names}
+        n = len(rows)
+        cols["_source_pdf"] = pa.array([source_pdf] * n, pa.string())
+        cols["_page_idx"] = pa.array([page_idx] * n, pa.int64())
+        cols["_table_name"] = pa.array([table_name] * n, pa.string())
+        table = pa.table(cols)
+        with self._lock:
+            self._tables.append(table)
+            self._n_rows += n
+            self._table = None
+            self.version += 1
+        return n
+
+    def table(self) -> pa.Table:
+        """Todas as linhas numa pa.Table (concatenação sem cópia, em cache até o próximo acréscimo)."""
+        with self._lock:
+            if self._table is None:
+                self._table = _unify(self._tables) if self._tables else pa.table({})
+                self._tables = [self._table]
+            return self._table
+
+    def rows_df(self) -> pd.DataFrame:
+        """DataFrame das linhas (somente leitura: é o mesmo objeto até o próximo acréscimo)."""
+        version = self.version
+        if self._df_version != version:
+            df = self.table().to_pandas()
+            with self._lock:
+                self._df, self._df_version = df, version
+        return self._df
+
+    def add_report(self, entry: Dict[str, Any]) -> int:
+        """Acrescenta uma linha ao relatório; devolve a posição para update_report."""
+        with self._lock:
+            self._report.append(dict(entry))
+            self.report_version += 1
+            return len(self._report) - 1
+
+    def update_report(self, idx: int, **fields) -> None:
+        with self._lock:
+            self._report[idx].update(fields)
+            self.report_version += 1
+
+    def report_entry(self, idx: int) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._report[idx])
+
+    def report_df(self) -> pd.DataFrame:
+        with self._lock:
+            if self._report_df_version != self.report_version:
+                self._report_df = pd.DataFrame(self._report)
+                self._report_df_version = self.report_version
+            return self._report_df
+
+def get_store(st) -> AggStore:
+    """AggStore da sessão. Workers recebem o objeto e chamam append_rows direto (sem st.*)."""
+    store = st.session_state.get(AGG_STORE)
+    if store is None:
+        store = st.session_state[AGG_STORE] = AggStore()
+    return store
 
 def ensure_state(st):
-    if AGG_ROWS not in st.session_state:
-        st.session_state[AGG_ROWS] = []
-    if AGG_REPORT not in st.session_state:
-        st.session_state[AGG_REPORT] = []
+    get_store(st)
 
 def reset(st):
-    st.session_state[AGG_ROWS] = []
-    st.session_state[AGG_REPORT] = []
+    st.session_state[AGG_STORE] = AggStore()
 
 def add_rows(st, rows: List[Dict[str, Any]], *, source_pdf: str, page_idx: int, table_name: str | None):
-    ensure_state(st)
-    for r in rows:
-        r2 = dict(r)
-        r2["_source_pdf"] = source_pdf
-        r2["_page_idx"] = page_idx
-        r2["_table_name"] = table_name
-        st.session_state[AGG_ROWS].append(r2)
-
-def add_report_entry(st, *, pdf: str, status: str, rows: int = 0, error: str | None = None):
-    ensure_state(st)
-    st.session_state[AGG_REPORT].append({
+    get_store(st).append_rows(rows, source_pdf=source_pdf, page_idx=page_idx, table_name=table_name)
+
+def add_report_entry(st, *, pdf: str, status: str, rows: int = 0, error: str | None = None) -> int:
+    return get_store(st).add_report({
         "arquivo": pdf,
         "status": status,           # "processando" | "vazio" | "ok" | "erro"
         "linhas": rows,
         "erro": error or ""
     })
 
+def update_report_entry(st, idx: int, **fields) -> None:
+    get_store(st).update_report(idx, **fields)
+
 def to_df_rows(st) -> pd.DataFrame:
-    ensure_state(st)
-    return pd.DataFrame(st.session_state[AGG_ROWS])
+    return get_store(st).rows_df()
 
 def to_df_report(st) -> pd.DataFrame:
-    ensure_state(st)
-    return pd.DataFrame(st.session_state[AGG_REPORT])
+    return get_store(st).report_df()
+
+class AggExport:
+    """
+    Arquivos de download do agregado, um por AggStore (nome com o horário da
+    primeira gravação). Só grava quando a versão do agregado mudou:
+
+    - linhas: as novas são acrescentadas ao fim do CSV; se o esquema mudou
+      (coluna nova, tipo promovido ou 1º nulo numa coluna inteira, que passa a
+      float64 no pandas) o arquivo é regravado inteiro;
+    - relatório: pequeno e com linhas alteradas no lugar, regravado inteiro;
+    - dataset Parquet particionado por _source_pdf/_table_name: as linhas novas
+      viram novos arquivos de parte (sync_dataset).
+
+    Os bytes para st.download_button (CSV, Parquet, Arrow IPC) ficam em cache pela versão.
+    """
+
+    def __init__(self, store: AggStore, out_dir: Path):
+        self.store = store
+        self.out_dir = Path(out_dir)
+        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.rows_path = self.out_dir / f"all_extracted_{ts}.csv"
+        self.report_path = self.out_dir / f"batch_report_{ts}.csv"
+        self.dataset_path = self.out_dir / f"all_extracted_{ts}_dataset"
+        self.stem = f"all_extracted_{ts}"
+        self._dataset = None
+        self._dataset_rows = 0
+        self._rows_version = -1
+        self._rows_written = 0
+        self._schema: Optional[pa.Schema] = None
+        self._float_ints: frozenset = frozenset()
+        self._report_version = -1
+        self._bytes: Dict[str, tuple] = {}  # "rows"/"report"/formato -> (versão, bytes)
+        self.stats = {"appends": 0, "rewrites": 0, "report_writes": 0}
+
+    def sync_rows(self) -> Path:
+        version = self.store.version
+        if version == self._rows_version:
+            return self.rows_path
+        table = self.store.table()
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        float_ints = _float_ints(table)
+        if self._schema is None or not table.schema.equals(self._schema) or float_ints != self._float_ints:
+            table.to_pandas().to_csv(self.rows_path, index=False, encoding="utf-8-sig")
+            self.stats["rewrites"] += 1
+        elif table.num_rows > self._rows_written:
+            new = _pandas_slice(table, self._rows_written)
+            new.to_csv(self.rows_path, mode="a", header=False, index=False, encoding="utf-8")
+            self.stats["appends"] += 1
+        self._schema, self._float_ints, self._rows_written = table.schema, float_ints, table.num_rows
+        self._rows_version = version
+        return self.rows_path
+
+    def sync_report(self) -> Path:
+        version = self.store.report_version
+        if version != self._report_version:
+            self.out_dir.mkdir(parents=True, exist_ok=True)
+            self.store.report_df().to_csv(self.report_path, index=False, encoding="utf-8-sig")
+            self._report_version = version
+            self.stats["report_writes"] += 1
+        return self.report_path
+
+    def _cached_bytes(self, kind: str, version: int, sync) -> bytes:
+        cached = self._bytes.get(kind)
+        if cached is None or cached[0] != version:
+            cached = self._bytes[kind] = (version, sync().read_bytes())
+        return cached[1]
+
+    def sync_dataset(self) -> Path:
+        """Acrescenta ao dataset particionado só as linhas ainda não exportadas."""
+        from app.save_utils import PartitionedDatasetWriter
+        table = self.store.table()
+        if table.num_rows > self._dataset_rows:
+            if self._dataset is None:
+                self._dataset = PartitionedDatasetWriter(self.dataset_path, "parquet")
+            self._dataset.write(table.slice(self._dataset_rows))
+            self._dataset_rows = table.num_rows
+        return self.dataset_path
+
+    def rows_bytes(self) -> bytes:
+        return self._cached_bytes("rows", self.store.version, self.sync_rows)
+
+    def arrow_bytes(self, fmt: str = "parquet") -> bytes:
+        """Linhas tipadas em Parquet ou Arrow IPC (row groups alinhados a arquivo/tabela)."""
+        from app.save_utils import arrow_file_bytes
+        version = self.store.version
+        cached = self._bytes.get(fmt)
+        if cached is None or cached[0] != version:
+            cached = self._bytes[fmt] = (version, arrow_file_bytes(self.store.table(), fmt))
+        return cached[1]
+
+    def report_bytes(self) -> bytes:
+        return self._cached_bytes("report", self.store.report_version, self.sync_report)
+
+def get_export(st, out_dir: Path) -> AggExport:
+    """Exportador do agregado atual da sessão (novo arquivo depois de reset)."""
+    store = get_store(st)
+    export = st.session_state.get(AGG_EXPORT)
+    if export is None or export.store is not store or export.out_dir != Path(out_dir):
+        export = st.session_state[AGG_EXPORT] = AggExport(store, out_dir)
+    return export
 
 def save_csv_rows(st, out_dir: Path) -> Path:
-    out_dir.mkdir(parents=True, exist_ok=True)
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    path = out_dir / f"all_extracted_{ts}.csv"
-    df = to_df_rows(st)
-    df.to_csv(path, index=False, encoding="utf-8-sig")
-    return path
+    """CSV das linhas do agregado (um arquivo por agregado, atualizado só com as novas linhas)."""
+    return get_export(st, out_dir).sync_rows()
 
 def save_csv_report(st, out_dir: Path) -> Path:
-    out_dir.mkdir(parents=True, exist_ok=True)
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    path = out_dir / f"batch_report_{ts}.csv"
-    df = to_df_report(st)
-    df.to_csv(path, index=False, encoding="utf-8-sig")
-    return path
+    return get_export(st, out_dir).sync_report()
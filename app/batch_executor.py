@@ -0,0 +1,99 @@
+# app/batch_executor.py
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from app.settings import BATCH_CONCURRENCY
+
+def run_ordered(
+    items: Iterable[Any],
+    worker: Callable[[Any], Any],
+    *,
+    concurrency: int = BATCH_CONCURRENCY,
+    max_inflight: Optional[int] = None,
+    on_start: Optional[Callable[[int, Any], None]] = None,
+    on_done: Optional[Callable[[int, Any, Any, Optional[BaseException]], None]] = None,
+    on_ordered: Optional[Callable[[int, Any, Any, Optional[BaseException]], None]] = None,
+    keep_results: bool = True,
+    on_poll: Optional[Callable[[], None]] = None,
+    poll_s: float = 0.5,
+) -> List[Dict[str, Any]]:
+    """
+    Executa worker(item) em paralelo (threads) e devolve os resultados NA ORDEM
+    dos itens: [{"index", "item", "result", "error"}, ...].
+
+    - concurrency: nº de workers simultâneos (1 = sequencial, como antes)
+    - max_inflight: limite de itens submetidos e ainda não concluídos
+      (fila limitada; padrão 2x concurrency)
+    - on_start / on_done / on_ordered: chamados SEMPRE na thread que chamou run_ordered
+      (a thread do Streamlit), então podem atualizar st.* com segurança.
+      on_done recebe (index, item, result, error) na ordem de conclusão;
+      on_ordered recebe os mesmos argumentos na ordem dos itens, assim que
+      todos os anteriores tiverem terminado.
+
+    - keep_results=False: o resultado é descartado assim que os callbacks o
+      consumirem (memória constante em lotes enormes; use os callbacks).
+
+    - on_poll: chamado na thread que chamou a cada poll_s segundos enquanto há
+      itens em voo (ex.: mostrar progresso parcial que os workers publicam em
+      uma estrutura própria). Com on_poll, mesmo concurrency=1 roda numa thread.
+
+    O worker NÃO deve acessar st.session_state nem widgets.
+    """
+    items = list(items)
+    concurrency = max(1, int(concurrency or 1))
+    max_inflight = max(concurrency, int(max_inflight or 2 * concurrency))
+    results: List[Dict[str, Any]] = [
+        {"index": i, "item": it, "result": None, "error": None} for i, it in enumerate(items)
+    ]
+
+    finished = [False] * len(items)
+    next_ordered = [0]
+
+    def _finish(i: int, result: Any, error: Optional[BaseException]) -> None:
+        results[i]["result"] = result
+        results[i]["error"] = error
+        finished[i] = True
+        if on_done:
+            on_done(i, items[i], result, error)
+        if not on_ordered:
+            if not keep_results:
+                results[i]["result"] = None
+            return
+        while next_ordered[0] < len(items) and finished[next_ordered[0]]:
+            j = next_ordered[0]
+            next_ordered[0] += 1
+            on_ordered(j, items[j], results[j]["result"], results[j]["error"])
+            if not keep_results:
+                results[j]["result"] = None
+
+    if concurrency == 1 and on_poll is None:
+        for i, it in enumerate(items):
+            if on_start:
+                on_start(i, it)
+            try:
+                _finish(i, worker(it), None)
+            except Exception as e:
+                _finish(i, None, e)
+        return results
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch") as pool:
+        pending = {}
+        next_i = 0
+        while next_i < len(items) or pending:
+            # Enche a janela de itens em voo (backpressure)
+            while next_i < len(items) and len(pending) < max_inflight:
+                if on_start:
+                    on_start(next_i, items[next_i])
+                pending[pool.submit(worker, items[next_i])] = next_i
+                next_i += 1
+
+            done, _ = wait(list(pending), timeout=poll_s if on_poll else None, return_when=FIRST_COMPLETED)
+            if on_poll:
+                on_poll()
+            for fut in done:
+                i = pending.pop(fut)
+                err = fut.exception()
+                _finish(i, None if err else fut.result(), err)
+
+    return results
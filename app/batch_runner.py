@@ -1,14 +1,20 @@
 from __future__ import annotations
-from typing import List
+import threading
+from typing import Any, Dict, List, Tuple
+from pathlib import Path
 import streamlit as st
-import pdfplumber
 from app.paths import OUT_DIR
-from app.settings import PROCESS_DPI, FALLBACK_DPI
-from app.pdf_utils import page_to_image, bbox_rel_to_px
-from app.save_utils import save_crop_image
+from app.settings import (
+    FALLBACK_DPI, CLIP_RENDER, BATCH_CONCURRENCY, PAGE_CONCURRENCY, DEFAULT_PAGE_FILTER,
+)
+from app.pdf_utils import (
+    choose_dpi, render_pdf_page, render_region, render_selected_regions, select_pages, bbox_rel_to_px,
+)
+from app.save_utils import save_crop_image, save_region_crop
 from app.gemini_client import call_gemini_on_image
 from app.result_utils import extract_rows_from_model_payload, is_empty_extraction, get_table_name
-from app.aggregate import add_rows, add_report_entry
+from app.aggregate import add_rows, add_report_entry, update_report_entry, get_store, to_df_report
+from app.batch_executor import run_ordered
 from app.ui_compat import dataframe_fluid
 
 SYSTEM_PROMPT = (
@@ -18,24 +24,43 @@ SYSTEM_PROMPT = (
     "Quando não existir, use null. Sem texto fora do JSON."
 )
 
-def process_single_pdf(file, *, bbox_rel: dict, api_key: str, page_index: int = 0) -> int:
-    """Retorna qtd de linhas extraídas (0 se vazio). Lança exceção se falhar geral."""
-    with pdfplumber.open(file) as pdf:
-        page = pdf.pages[page_index]
+def extract_single_pdf(file, *, bbox_rel: dict, api_key: str, page_index: int = 0, use_cache: bool = True,
+                       on_rows=None) -> Tuple[List[Dict[str, Any]], str | None]:
+    """
+    Extrai as linhas de um PDF sem tocar no st.session_state (seguro em threads).
+    Retorna (rows, table_name); rows == [] se vazio. Lança exceção se falhar geral.
+    """
+    pdfname = getattr(file, "name", "lote.pdf")
+    if CLIP_RENDER:
+        # Rasteriza só a região do preset (DPI adaptativo ao menor texto da bbox)
+        try:
+            dpi = choose_dpi(file, page_index, bbox_rel)["dpi"]
+            crop_pil = render_region(file, page_index, bbox_rel, dpi)
+        except Exception:
+            dpi = FALLBACK_DPI
+            crop_pil = render_region(file, page_index, bbox_rel, dpi)
+        # Salva para auditoria (não usa o arquivo no envio; enviamos PIL)
+        save_region_crop(crop_pil, Path(pdfname).stem, page_index, dpi=dpi)
+    else:
         try:
-            page_hi = page_to_image(page, PROCESS_DPI)
+            dpi = choose_dpi(file, page_index, bbox_rel, full_page=True)["dpi"]
+            page_hi = render_pdf_page(file, page_index, dpi=dpi)
         except Exception:
-            page_hi = page_to_image(page, FALLBACK_DPI)
+            dpi = FALLBACK_DPI
+            page_hi = render_pdf_page(file, page_index, dpi=dpi)
 
-    w, h = page_hi.size
-    bbox_px = bbox_rel_to_px(bbox_rel, w, h)
-    crop_pil = page_hi.crop(bbox_px)
+        w, h = page_hi.size
+        bbox_px = bbox_rel_to_px(bbox_rel, w, h)
+        crop_pil = page_hi.crop(bbox_px)
 
-    # Salva para auditoria (não usa o arquivo no envio; enviamos PIL)
-    save_crop_image(crop_pil, getattr(file, "name", "lote.pdf"), page_index)
+        # Salva para auditoria (não usa o arquivo no envio; enviamos PIL)
+        save_crop_image(page_hi, bbox_rel, Path(pdfname).stem, page_index, dpi=dpi)
 
-    # Chamar modelo
-    raw_text = call_gemini_on_image(api_key, crop_pil, SYSTEM_PROMPT)
+    return _extract_crop_rows(crop_pil, api_key=api_key, use_cache=use_cache, on_rows=on_rows)
+
+def _extract_crop_rows(crop_pil, *, api_key: str, use_cache: bool, on_rows=None) -> Tuple[List[Dict[str, Any]], str | None]:
+    # Chamar modelo (com on_rows, em streaming)
+    raw_text = call_gemini_on_image(api_key, crop_pil, SYSTEM_PROMPT, use_cache=use_cache, on_rows=on_rows)
 
     # Tentar JSON -> payload
     import json
@@ -46,14 +71,55 @@ def process_single_pdf(file, *, bbox_rel: dict, api_key: str, page_index: int =
         raise RuntimeError("Resposta do modelo não é JSON válido.")
 
     if is_empty_extraction(payload):
-        return 0
+        return [], None
+
+    return extract_rows_from_model_payload(payload), get_table_name(payload)
+
+def extract_pdf_pages(file, *, bbox_rel: dict, api_key: str, page_filter: str | None = DEFAULT_PAGE_FILTER,
+                      use_cache: bool = True, concurrency: int = PAGE_CONCURRENCY,
+                      on_rows=None) -> List[Dict[str, Any]]:
+    """
+    extract_single_pdf para as páginas de page_filter (ver pdf_utils.select_pages).
+    Com CLIP_RENDER os recortes saem de um único handle do documento; as chamadas
+    ao modelo das páginas rodam em paralelo. Retorna [{"index", "item": page_index,
+    "result": (rows, table_name), "error"}] na ordem das páginas.
+    on_rows(page_index, linhas) recebe as linhas em streaming (threads das páginas).
+    """
+    if not CLIP_RENDER:
+        return run_ordered(
+            select_pages(file, page_filter),
+            lambda i: extract_single_pdf(file, bbox_rel=bbox_rel, api_key=api_key, page_index=i,
+                                         use_cache=use_cache, on_rows=_page_rows(on_rows, i)),
+            concurrency=concurrency,
+        )
+
+    pdfname = getattr(file, "name", "lote.pdf")
+    try:
+        regions = render_selected_regions(file, page_filter, bbox_rel)
+    except Exception:  # filtro inválido volta a falhar aqui e vira erro do arquivo no relatório
+        regions = render_selected_regions(file, page_filter, bbox_rel, FALLBACK_DPI)
+    crops = {i: (img, info["dpi"]) for i, img, info in regions}
+    del regions  # crops.pop libera os pixels ao fim de cada página
+
+    def _work(page_index):
+        crop_pil, dpi = crops.pop(page_index)
+        save_region_crop(crop_pil, Path(pdfname).stem, page_index, dpi=dpi)
+        return _extract_crop_rows(crop_pil, api_key=api_key, use_cache=use_cache, on_rows=_page_rows(on_rows, page_index))
+
+    return run_ordered(list(crops), _work, concurrency=concurrency)
 
-    rows = extract_rows_from_model_payload(payload)
-    tname = get_table_name(payload)
-    add_rows(st, rows, source_pdf=getattr(file, "name", "lote.pdf"), page_idx=page_index, table_name=tname)
+def _page_rows(on_rows, page_index):
+    return None if on_rows is None else (lambda rows: on_rows(page_index, rows))
+
+def process_single_pdf(file, *, bbox_rel: dict, api_key: str, page_index: int = 0, use_cache: bool = True) -> int:
+    """Retorna qtd de linhas extraídas (0 se vazio). Lança exceção se falhar geral."""
+    rows, tname = extract_single_pdf(file, bbox_rel=bbox_rel, api_key=api_key, page_index=page_index, use_cache=use_cache)
+    if rows:
+        add_rows(st, rows, source_pdf=getattr(file, "name", "lote.pdf"), page_idx=page_index, table_name=tname)
     return len(rows)
 
-def run_batch(files: List, *, bbox_rel: dict, api_key: str):
+def run_batch(files: List, *, bbox_rel: dict, api_key: str, concurrency: int = BATCH_CONCURRENCY,
+              use_cache: bool = True, page_filter: str | None = DEFAULT_PAGE_FILTER):
     n = len(files)
     if n == 0:
         st.warning("Selecione ao menos um PDF.")
@@ -65,42 +131,99 @@ def run_batch(files: List, *, bbox_rel: dict, api_key: str):
     table_ph = st.empty()
     log_ph = st.empty()
 
-    ok = 0
-    empty = 0
-    err = 0
+    counts = {"ok": 0, "vazio": 0, "erro": 0}
+    report_idx = {}   # índice do arquivo -> posição da linha em agg_report
+    finished = [0]
+    streamed = {}     # id(arquivo) -> linhas já recebidas em streaming (escrito pelas threads)
+    streamed_lock = threading.Lock()
 
-    for i, f in enumerate(files):
-        pdfname = getattr(f, "name", f"pdf_{i+1}.pdf")
-        add_report_entry(st, pdf=pdfname, status="processando", rows=0)
+    def _name(i, f):
+        return getattr(f, "name", f"pdf_{i+1}.pdf")
 
-        # Atualiza tabela de status
-        from app.aggregate import to_df_report
+    def _refresh_table():
         with table_ph.container():
             dataframe_fluid(to_df_report(st), height=300)
 
-        try:
-            count = process_single_pdf(f, bbox_rel=bbox_rel, api_key=api_key, page_index=0)
-            if count == 0:
-                empty += 1
-                st.toast(f"{pdfname}: tabela vazia.", icon="⚠️")
-                # Atualiza linha
-                st.session_state["agg_report"][-1].update({"status":"vazio","linhas":0})
+    # Callbacks rodam na thread do Streamlit (run_ordered garante isso)
+    def on_start(i, f):
+        report_idx[i] = add_report_entry(st, pdf=_name(i, f), status="processando", rows=0)
+        _refresh_table()
+
+    def on_poll():
+        with streamed_lock:
+            snap = dict(streamed)
+        store = get_store(st)
+        changed = False
+        for i, f in enumerate(files):
+            if i not in report_idx or id(f) not in snap:
+                continue
+            n_rows = snap[id(f)]
+            entry = store.report_entry(report_idx[i])
+            if entry["status"] == "processando" and entry["linhas"] != n_rows:
+                store.update_report(report_idx[i], linhas=n_rows)
+                changed = True
+        if changed:
+            _refresh_table()
+
+    # Roda nas threads do executor: nada de st.* aqui
+    def work(f):
+        def on_rows(page_index, rows):
+            with streamed_lock:
+                streamed[id(f)] = streamed.get(id(f), 0) + len(rows)
+        return extract_pdf_pages(f, bbox_rel=bbox_rel, api_key=api_key, page_filter=page_filter,
+                                 use_cache=use_cache, on_rows=on_rows)
+
+    def on_done(i, f, result, error):
+        pdfname = _name(i, f)
+
+        def _update(**fields):
+            update_report_entry(st, report_idx[i], **fields)
+
+        if error is not None:
+            counts["erro"] += 1
+            st.toast(f"{pdfname}: erro — {error}", icon="❌")
+            _update(status="erro", erro=str(error))
+        else:
+            n_rows = sum(len(p["result"][0]) for p in result if p["error"] is None)
+            page_errors = [f'pág. {p["item"]}: {p["error"]}' for p in result if p["error"] is not None]
+            if n_rows:
+                counts["ok"] += 1
+                st.toast(f"{pdfname}: {n_rows} linha(s) extraída(s).", icon="✅")
+                _update(status="ok", linhas=n_rows, erro="; ".join(page_errors))
+            elif page_errors:
+                counts["erro"] += 1
+                st.toast(f"{pdfname}: erro — {page_errors[0]}", icon="❌")
+                _update(status="erro", erro="; ".join(page_errors))
             else:
-                ok += 1
-                st.toast(f"{pdfname}: {count} linha(s) extraída(s).", icon="✅")
-                st.session_state["agg_report"][-1].update({"status":"ok","linhas":count})
-        except Exception as e:
-            err += 1
-            st.toast(f"{pdfname}: erro — {e}", icon="❌")
-            st.session_state["agg_report"][-1].update({"status":"erro","erro":str(e)})
-
-        # Atualiza progress
-        progress_ph.progress((i+1)/n)
-        # Atualiza grid
-        from app.aggregate import to_df_report
-        with table_ph.container():
-            dataframe_fluid(to_df_report(st), height=300)
-        # Log resumido
-        log_ph.info(f"Concluído {i+1}/{n}: {pdfname}")
-
-    status_box.update(label=f"Lote finalizado: ok={ok}, vazios={empty}, erros={err}", state="complete")
+                counts["vazio"] += 1
+                st.toast(f"{pdfname}: tabela vazia.", icon="⚠️")
+                _update(status="vazio", linhas=0)
+
+        finished[0] += 1
+        progress_ph.progress(finished[0] / n)
+        _refresh_table()
+        log_ph.info(f"Concluído {finished[0]}/{n}: {pdfname}")
+
+    def on_ordered(i, f, result, error):
+        # Linhas entram no agregado na ordem dos arquivos/páginas, não na de conclusão
+        if error is not None:
+            return
+        for p in result:
+            if p["error"] is None and p["result"][0]:
+                rows, tname = p["result"]
+                add_rows(st, rows, source_pdf=_name(i, f), page_idx=p["item"], table_name=tname)
+
+    run_ordered(
+        files,
+        work,
+        concurrency=concurrency,
+        on_start=on_start,
+        on_done=on_done,
+        on_ordered=on_ordered,
+        on_poll=on_poll,
+    )
+
+    status_box.update(
+        label=f"Lote finalizado: ok={counts['ok']}, vazios={counts['vazio']}, erros={counts['erro']}",
+        state="complete",
+    )
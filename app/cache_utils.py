@@ -0,0 +1,26 @@
+# app/cache_utils.py
+import os
+from pathlib import Path
+
+def trim_disk_lru(cache_dir: Path, suffix: str, limit_bytes: int) -> None:
+    """
+    Remove os arquivos *suffix de cache_dir menos usados (mtime mais antigo;
+    quem lê do cache atualiza o mtime com os.utime) até o total caber em limit_bytes.
+    """
+    entries = []
+    total = 0
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(suffix):
+            st_ = entry.stat()
+            entries.append((st_.st_mtime, st_.st_size, entry.path))
+            total += st_.st_size
+    if total <= limit_bytes:
+        return
+    for _, size, path in sorted(entries):
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        if total <= limit_bytes:
+            break
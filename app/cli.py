@@ -0,0 +1,210 @@
+"""
+Extração em lote sem Streamlit (cron / máquina de processamento).
+
+    python -m app.cli extract <pasta|glob> --preset <id> [--pages 0,2-4|all|last|text:<palavra>]
+                              [--concurrency 4] [--engine staged|threads]
+                              [--format jsonl|csv|parquet] [--out DIR]
+    python -m app.cli presets-import [presets.json]
+
+Cada (PDF, página) passa pelo percurso de pipeline.process_pdf_once (por padrão
+no pipeline em estágios, app/staged_pipeline.py); as linhas são gravadas
+assim que cada item termina e o relatório por arquivo (mesma estrutura de
+agg_report) é impresso em JSON, uma linha por arquivo.
+"""
+from __future__ import annotations
+import argparse
+import contextlib
+import glob
+import json
+import os
+import sys
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+_PROJECT_ROOT = Path(__file__).resolve().parents[1]
+if str(_PROJECT_ROOT) not in sys.path:
+    sys.path.insert(0, str(_PROJECT_ROOT))
+
+from dotenv import load_dotenv
+
+from app.paths import CONFIG_DIR, OUT_DIR
+from app.settings import BATCH_CONCURRENCY, STAGE_RENDER_WORKERS, DEFAULT_PAGE_FILTER
+
+def iter_pdf_paths(source: str) -> Iterator[Path]:
+    """Pasta (recursiva) ou padrão glob -> caminhos de PDF em ordem estável."""
+    p = Path(source)
+    if p.is_dir():
+        paths = (q for q in p.rglob("*") if q.suffix.lower() == ".pdf")
+    elif p.is_file():
+        paths = iter([p])
+    else:
+        paths = (Path(q) for q in glob.iglob(source, recursive=True) if q.lower().endswith(".pdf"))
+    return iter(sorted(paths))
+
+def _file_report(name: str, outcomes: List[Tuple[int, Optional[str]]]) -> Dict:
+    """Consolida os resultados das páginas de um arquivo no formato de agg_report."""
+    rows = sum(n for n, _ in outcomes)
+    errors = [e for _, e in outcomes if e]
+    if rows > 0:
+        status = "ok"
+    elif errors:
+        status = "erro"
+    else:
+        status = "vazio"
+    return {"arquivo": name, "status": status, "linhas": rows, "erro": "; ".join(errors)}
+
+def cmd_extract(args: argparse.Namespace) -> int:
+    from app.presets import get_preset_by_id, record_preset_use
+    from app.pdf_utils import select_pages
+    from app.pipeline import process_pdf_once
+    from app.batch_executor import run_ordered
+    from app.save_utils import StreamingRowWriter
+
+    load_dotenv(CONFIG_DIR / ".env")
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        print("GEMINI_API_KEY não encontrada (config/.env ou variável de ambiente).", file=sys.stderr)
+        return 2
+
+    preset = get_preset_by_id(args.preset)
+    if not preset or not preset.get("bbox_rel"):
+        print(f"Preset '{args.preset}' não encontrado ou sem bbox_rel.", file=sys.stderr)
+        return 2
+    record_preset_use(preset["id"])
+    bbox_rel = preset["bbox_rel"]
+    page_filter = args.pages or preset.get("page_filter") or DEFAULT_PAGE_FILTER
+
+    out_dir = Path(args.out) if args.out else OUT_DIR / f"cli_{datetime.now():%Y%m%d_%H%M%S}"
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    # Itens (pdf, página); o nº de páginas pendentes por arquivo fecha o relatório
+    items: List[Tuple[Path, int]] = []
+    pending: Dict[Path, int] = {}
+    outcomes: Dict[Path, List[Tuple[int, Optional[str]]]] = {}
+    reports: List[Dict] = []
+    for pdf in iter_pdf_paths(args.source):
+        try:
+            pages = select_pages(pdf, page_filter)
+        except Exception as e:
+            reports.append(_file_report(pdf.name, [(0, f"PDF ilegível: {e}")]))
+            print(json.dumps(reports[-1], ensure_ascii=False), flush=True)
+            continue
+        if not pages:
+            reports.append(_file_report(pdf.name, []))
+            print(json.dumps(reports[-1], ensure_ascii=False), flush=True)
+            continue
+        pending[pdf] = len(pages)
+        outcomes[pdf] = []
+        items.extend((pdf, i) for i in pages)
+
+    if not items and not reports:
+        print("Nenhum PDF encontrado.", file=sys.stderr)
+        return 2
+
+    writer = StreamingRowWriter(out_dir / f"extracted.{args.format}", args.format)
+
+    def work(item):
+        pdf, page_index = item
+        return process_pdf_once(
+            pdf_file=pdf, page_index=page_index, bbox_rel=bbox_rel,
+            api_key=api_key, save_artifacts=not args.no_artifacts,
+            use_cache=not args.no_cache, text_layer=not args.no_text_layer,
+        )
+
+    def on_done(i, item, r, err):
+        pdf, page_index = item
+        if err is not None:
+            outcomes[pdf].append((0, str(err)))
+        else:
+            rows = [] if r["is_empty"] else r["rows"]
+            for row in rows:
+                row["_source_pdf"] = pdf.name
+                row["_page_idx"] = page_index
+            writer.write(rows)
+            outcomes[pdf].append((len(rows), None))
+        pending[pdf] -= 1
+        if pending[pdf] == 0:
+            reports.append(_file_report(pdf.name, outcomes.pop(pdf)))
+            print(json.dumps(reports[-1], ensure_ascii=False), file=report_out, flush=True)
+
+    # stdout fica só com o relatório; os prints de depuração do pipeline vão para stderr
+    report_out = sys.stdout
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            if args.engine == "staged":
+                from app.staged_pipeline import run_staged
+                run_staged(
+                    items, bbox_rel=bbox_rel, api_key=api_key, on_result=on_done,
+                    save_artifacts=not args.no_artifacts, use_cache=not args.no_cache,
+                    render_workers=args.render_workers, extract_concurrency=args.concurrency,
+                    text_layer=not args.no_text_layer,
+                )
+            else:
+                run_ordered(items, work, concurrency=args.concurrency, on_done=on_done, keep_results=False)
+    finally:
+        writer.close()
+
+    import pandas as pd
+    pd.DataFrame(reports, columns=["arquivo", "status", "linhas", "erro"]).to_csv(
+        out_dir / "batch_report.csv", index=False, encoding="utf-8-sig"
+    )
+    totals = {s: sum(1 for r in reports if r["status"] == s) for s in ("ok", "vazio", "erro")}
+    from app.pipeline import text_layer_stats
+    tl = text_layer_stats()
+    if tl["used"]:
+        print(f"Camada de texto: {tl['used']} de {tl['tried']} página(s) sem chamada ao Gemini", file=sys.stderr)
+    print(
+        f"Lote finalizado: ok={totals['ok']}, vazios={totals['vazio']}, erros={totals['erro']} "
+        f"— {writer.rows_written} linha(s) em {writer.path}",
+        file=sys.stderr,
+    )
+    return 1 if totals["erro"] else 0
+
+def cmd_presets_import(args: argparse.Namespace) -> int:
+    from app.preset_db import import_json
+    from app.presets import PRESETS_PATH
+    src = Path(args.json) if args.json else PRESETS_PATH
+    try:
+        n = import_json(src)
+    except (OSError, ValueError) as e:
+        print(f"Falha ao importar {src}: {e}", file=sys.stderr)
+        return 2
+    print(f"{n} preset(s) importado(s) de {src}", file=sys.stderr)
+    return 0
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m app.cli", description="Takeoff AI - extração headless")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    ex = sub.add_parser("extract", help="Extrai tabelas de uma pasta/glob de PDFs com um preset")
+    ex.add_argument("source", help="Pasta (busca recursiva) ou padrão glob, ex.: 'lotes/**/*.pdf'")
+    ex.add_argument("--preset", required=True, help="id do preset (config/presets.json)")
+    ex.add_argument("--pages", help="Páginas 0-index: '0', '0,2-4', 'last', 'all' ou 'text:<palavra>' "
+                                    "(padrão: page_filter do preset)")
+    ex.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY,
+                    help="Itens em paralelo (no motor 'staged': chamadas simultâneas ao Gemini)")
+    ex.add_argument("--engine", choices=("staged", "threads"), default="staged",
+                    help="'staged': render em processos + extração assíncrona; 'threads': process_pdf_once por thread")
+    ex.add_argument("--render-workers", type=int, default=STAGE_RENDER_WORKERS,
+                    help="Processos de rasterização (motor 'staged')")
+    ex.add_argument("--format", choices=("jsonl", "csv", "parquet"), default="jsonl", help="Formato da saída")
+    ex.add_argument("--out", help="Diretório de saída (padrão: out/cli_<timestamp>)")
+    ex.add_argument("--no-cache", action="store_true", help="Ignora o cache de respostas do Gemini")
+    ex.add_argument("--no-artifacts", action="store_true", help="Não salva os crops em Crop/")
+    ex.add_argument("--no-text-layer", action="store_true",
+                    help="Sempre envia ao Gemini (ignora tabelas legíveis na camada de texto do PDF)")
+    ex.set_defaults(func=cmd_extract)
+
+    im = sub.add_parser("presets-import",
+                        help="Copia os presets de um presets.json para o banco SQLite (PRESETS_BACKEND='sqlite')")
+    im.add_argument("json", nargs="?", help="Arquivo de origem (padrão: config/presets.json)")
+    im.set_defaults(func=cmd_presets_import)
+    return parser
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
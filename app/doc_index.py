@@ -0,0 +1,180 @@
+# app/doc_index.py
+"""
+Índice persistente dos documentos já processados.
+
+    fingerprint (sha256 dos bytes) -> nome, leiaute, preset, modelo, resultados por página
+
+Um segundo mapa, montado na carga, liga o fingerprint de leiaute aos documentos
+do mesmo modelo de prancha. As consultas são dicts em memória (O(1)); o arquivo
+é relido só quando outro processo o altera (mtime/tamanho) e gravado de forma
+atômica (tmp + rename). Em lote, record(..., flush=False) só acumula e o
+arquivo é gravado uma vez no fim (flush()).
+"""
+from __future__ import annotations
+import atexit
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from app.paths import CACHE_DIR
+from app.settings import DOC_INDEX_MAX_ENTRIES
+
+class DocumentIndex:
+    def __init__(self, path: Path, max_entries: int):
+        self.path = Path(path)
+        self.max_entries = int(max_entries)
+        self._lock = threading.RLock()
+        self._docs: Dict[str, Dict[str, Any]] = {}
+        self._by_layout: Dict[str, List[str]] = {}
+        self._stamp = None  # (mtime_ns, size) do arquivo carregado
+        self._pending: Dict[str, Dict[str, Any]] = {}  # registrados e ainda não gravados
+        self.stats = {"hits": 0, "misses": 0, "layout_hits": 0, "records": 0}
+
+    def _file_stamp(self):
+        try:
+            st_ = os.stat(self.path)
+        except OSError:
+            return None
+        return (st_.st_mtime_ns, st_.st_size)
+
+    def _reindex(self) -> None:
+        self._by_layout = {}
+        for fp, entry in self._docs.items():
+            if entry.get("layout"):
+                self._by_layout.setdefault(entry["layout"], []).append(fp)
+
+    def _refresh(self) -> None:
+        stamp = self._file_stamp()
+        if stamp == self._stamp:
+            return
+        docs = {}
+        if stamp is not None:
+            try:
+                data = json.loads(self.path.read_text(encoding="utf-8"))
+                docs = data if isinstance(data, dict) else {}
+            except (OSError, ValueError) as e:
+                print(f"Aviso: índice de documentos ilegível, ignorando: {e}")
+        docs.update(self._pending)  # o que ainda não foi gravado prevalece sobre o arquivo
+        self._docs, self._stamp = docs, stamp
+        self._reindex()
+
+    def _save(self) -> None:
+        if len(self._docs) > self.max_entries:
+            # Remove os vistos há mais tempo
+            stale = sorted(self._docs, key=lambda fp: self._docs[fp].get("last_seen", 0))
+            for fp in stale[: len(self._docs) - self.max_entries]:
+                del self._docs[fp]
+            self._reindex()
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp.write_text(json.dumps(self._docs, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, self.path)
+            self._stamp = self._file_stamp()
+            self._pending = {}
+        except (OSError, TypeError, ValueError) as e:
+            print(f"Aviso: não foi possível gravar o índice de documentos: {e}")
+
+    def get(self, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """Entrada do documento (ou None se nunca foi processado)."""
+        with self._lock:
+            self._refresh()
+            entry = self._docs.get(fingerprint)
+            self.stats["hits" if entry else "misses"] += 1
+            return entry
+
+    def same_layout(self, layout: Optional[str], exclude: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Documentos já vistos com o mesmo leiaute, do mais recente ao mais antigo."""
+        if not layout:
+            return []
+        with self._lock:
+            self._refresh()
+            entries = [self._docs[fp] for fp in self._by_layout.get(layout, ()) if fp != exclude]
+            if entries:
+                self.stats["layout_hits"] += 1
+            return sorted(entries, key=lambda e: -e.get("last_seen", 0))
+
+    def lookup(self, pdf_ref) -> Dict[str, Any]:
+        """
+        Reconhece o documento: {"fingerprint", "layout", "entry", "same_layout"}.
+        O fingerprint de leiaute só é calculado se o documento ainda não está no índice.
+        """
+        from app.pdf_utils import pdf_content_hash, layout_fingerprint
+        fp = pdf_content_hash(pdf_ref)
+        entry = self.get(fp)
+        layout = entry.get("layout") if entry else None
+        if layout is None:
+            try:
+                layout = layout_fingerprint(pdf_ref)
+            except Exception as e:
+                print(f"Aviso: fingerprint de leiaute indisponível: {e}")
+        return {"fingerprint": fp, "layout": layout, "entry": entry,
+                "same_layout": self.same_layout(layout, exclude=fp)}
+
+    def record(
+        self,
+        fingerprint: str,
+        *,
+        name: str,
+        layout: Optional[str] = None,
+        preset_id: Optional[str] = None,
+        template: Optional[str] = None,
+        pages: Optional[Dict[int, Dict[str, Any]]] = None,
+        flush: bool = True,
+    ) -> Dict[str, Any]:
+        """
+        Inclui/atualiza o documento. pages: {página: {"rows", "source", "outputs", ...}}
+        é mesclado com o que já havia. Campos None não apagam os existentes.
+        flush=False: só em memória até o próximo flush() (lotes: uma gravação no fim).
+        """
+        now = time.time()
+        with self._lock:
+            self._refresh()
+            entry = self._docs.setdefault(fingerprint, {"first_seen": now, "pages": {}})
+            old_layout = entry.get("layout")
+            entry["name"] = name
+            entry["last_seen"] = now
+            for key, value in (("layout", layout), ("preset_id", preset_id), ("template", template)):
+                if value:
+                    entry[key] = value
+            for page, info in (pages or {}).items():
+                entry["pages"][str(page)] = dict(info, at=now)
+            if entry.get("layout") != old_layout:
+                if old_layout:
+                    self._by_layout[old_layout].remove(fingerprint)
+                self._by_layout.setdefault(entry["layout"], []).append(fingerprint)
+            self._pending[fingerprint] = entry
+            if flush:
+                self._save()
+            self.stats["records"] += 1
+            return entry
+
+    def flush(self) -> None:
+        """Grava os registros pendentes (relê o arquivo antes: preserva o que outro processo gravou)."""
+        with self._lock:
+            if not self._pending:
+                return
+            self._refresh()
+            self._save()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._docs, self._by_layout, self._pending = {}, {}, {}
+            try:
+                self.path.unlink()
+            except OSError:
+                pass
+            self._stamp = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats["documents"] = len(self._docs)
+            stats["pending"] = len(self._pending)
+        return stats
+
+doc_index = DocumentIndex(CACHE_DIR / "doc_index.json", DOC_INDEX_MAX_ENTRIES)
+atexit.register(doc_index.flush)
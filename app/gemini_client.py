@@ -3,13 +3,24 @@ Cliente da API Gemini para extração de tabelas
 """
 import os
 import json
-import re
 import io
-from typing import Dict, List, Optional, Any, Union
+import math
+import time
+import asyncio
+import hashlib
+import threading
+import weakref
+from collections import deque
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional, Any, Sequence, Tuple, Union
 from PIL import Image
 import google.generativeai as genai
 from dotenv import load_dotenv
 
+from app.paths import CONFIG_DIR
+from app.json_utils import extract_json, loads_loose, StreamingRowParser
+from app.response_cache import response_cache, response_key
+from app.image_utils import EncodedImage, encode_for_upload
+
 DEFAULT_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-pro")
 
 # Prompt compartilhado para extração de tabelas
@@ -54,6 +65,218 @@ SHARED_PROMPT = (
   "REGRAS: Sem texto fora do JSON. Mantenha unidades como na imagem. Se uma coluna não existir para uma tabela, simplesmente não inclua.\n"
 )
 
+# ---------------------------------------------------------------------------
+# Registro de handles: um GenerativeModel por (api_key, modelo, generation_config)
+# ---------------------------------------------------------------------------
+
+LATENCY_BUCKETS_S = (0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+
+class ModelHandle:
+    """GenerativeModel reutilizável com contadores e histograma de latência."""
+
+    def __init__(self, model_name: str, model: Any, bind_async: Optional[Callable[[Any], None]] = None):
+        self.model_name = model_name
+        self.model = model
+        self._bind_async = bind_async
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.total_s = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS_S) + 1)  # último = acima do maior bucket
+        self.streams = 0
+        self.first_chunk_s = 0.0
+
+    def _record(self, elapsed: float, ok: bool) -> None:
+        idx = next((i for i, b in enumerate(LATENCY_BUCKETS_S) if elapsed <= b), len(LATENCY_BUCKETS_S))
+        with self._lock:
+            self.calls += 1
+            self.errors += 0 if ok else 1
+            self.total_s += elapsed
+            self.histogram[idx] += 1
+
+    def generate_content(self, contents, **kwargs):
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            resp = self.model.generate_content(contents, **kwargs)
+            ok = True
+            return resp
+        finally:
+            self._record(time.perf_counter() - t0, ok)
+
+    def stream_text(self, contents, **kwargs) -> Iterator[str]:
+        """generate_content(stream=True): devolve o texto de cada chunk assim que chega."""
+        t0 = time.perf_counter()
+        ok = False
+        first = True
+        try:
+            for chunk in self.model.generate_content(contents, stream=True, **kwargs):
+                if first:
+                    first = False
+                    with self._lock:
+                        self.streams += 1
+                        self.first_chunk_s += time.perf_counter() - t0
+                text = _chunk_text(chunk)
+                if text:
+                    yield text
+            ok = True
+        finally:
+            self._record(time.perf_counter() - t0, ok)
+
+    async def generate_content_async(self, contents, **kwargs):
+        if self._bind_async is not None:
+            self._bind_async(self.model)
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            resp = await self.model.generate_content_async(contents, **kwargs)
+            ok = True
+            return resp
+        finally:
+            self._record(time.perf_counter() - t0, ok)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            labels = [f"<={b}s" for b in LATENCY_BUCKETS_S] + [f">{LATENCY_BUCKETS_S[-1]}s"]
+            return {
+                "model": self.model_name,
+                "calls": self.calls,
+                "errors": self.errors,
+                "avg_s": round(self.total_s / self.calls, 3) if self.calls else 0.0,
+                "avg_first_chunk_s": round(self.first_chunk_s / self.streams, 3) if self.streams else None,
+                "histogram": dict(zip(labels, self.histogram)),
+            }
+
+class ModelRegistry:
+    """
+    Registro de handles compartilhado pelo processo (seguro entre threads).
+    genai.configure é global no SDK: só é chamado quando a chave muda, e os
+    transportes são vinculados ao modelo (o síncrono na criação, o assíncrono
+    antes da 1ª chamada async) para que cada handle mantenha os clientes da sua chave.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._handles: Dict[Tuple[str, str, str], ModelHandle] = {}
+        self._configured_key: Optional[str] = None
+
+    @staticmethod
+    def _config_key(generation_config: Optional[Dict[str, Any]]) -> str:
+        return json.dumps(generation_config or {}, sort_keys=True, default=str)
+
+    def _configure(self, api_key: str) -> None:
+        # chamar com self._lock
+        if self._configured_key != api_key:
+            genai.configure(api_key=api_key)
+            self._configured_key = api_key
+
+    def _bind_transport(self, model: Any) -> None:
+        # SDK cria o cliente na 1ª chamada; vinculamos já, sob o lock, com a chave atual
+        from google.generativeai import client as genai_client
+        if model._client is None:
+            model._client = genai_client.get_default_generative_client()
+
+    def _bind_async_transport(self, model: Any, api_key: str) -> None:
+        """
+        Cliente assíncrono (generate_content_async) com a chave do handle. O SDK o
+        cria na 1ª chamada async com a chave global do momento; aqui é criado antes
+        dessa chamada, já dentro do event loop (o canal grpc.aio precisa dele), com
+        a chave do handle configurada sob o lock.
+        """
+        if getattr(model, "_async_client", None) is not None:
+            return
+        from google.generativeai import client as genai_client
+        with self._lock:
+            if getattr(model, "_async_client", None) is None:
+                self._configure(api_key)
+                model._async_client = genai_client.get_default_generative_async_client()
+
+    def get(self, api_key: str, model_name: str = DEFAULT_MODEL,
+            generation_config: Optional[Dict[str, Any]] = None) -> ModelHandle:
+        if not api_key:
+            raise RuntimeError("GEMINI_API_KEY ausente.")
+        key = (hashlib.sha256(api_key.encode()).hexdigest(), model_name, self._config_key(generation_config))
+        handle = self._handles.get(key)
+        if handle is not None:
+            return handle
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle is None:
+                self._configure(api_key)
+                if generation_config:
+                    model = genai.GenerativeModel(model_name, generation_config=generation_config)
+                else:
+                    model = genai.GenerativeModel(model_name)
+                self._bind_transport(model)
+                handle = self._handles[key] = ModelHandle(
+                    model_name, model, lambda m, k=api_key: self._bind_async_transport(m, k)
+                )
+        return handle
+
+    def warm(self, api_key: str, model_names: Sequence[str] = (DEFAULT_MODEL,)) -> None:
+        """Cria os handles no startup (sem chamada de rede)."""
+        for name in model_names:
+            self.get(api_key, name)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            handles = list(self._handles.values())
+        return [h.stats() for h in handles]
+
+model_registry = ModelRegistry()
+
+class UploadStats:
+    """Tamanho e tempo de codificação de cada imagem enviada (últimas `keep` + totais)."""
+
+    def __init__(self, keep: int = 200):
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=keep)
+        self.count = 0
+        self.bytes = 0
+        self.raw_bytes = 0
+        self.encode_s = 0.0
+        self.formats: Dict[str, int] = {}
+
+    def record(self, enc: EncodedImage) -> None:
+        info = enc.info()
+        with self._lock:
+            self._recent.append(info)
+            self.count += 1
+            self.bytes += enc.nbytes
+            self.raw_bytes += enc.raw_bytes
+            self.encode_s += enc.encode_s
+            kind = enc.format.split("-q")[0]
+            self.formats[kind] = self.formats.get(kind, 0) + 1
+
+    def recent(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._recent)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            n = self.count
+            return {
+                "uploads": n,
+                "avg_kb": round(self.bytes / n / 1024, 1) if n else 0.0,
+                "avg_encode_ms": round(self.encode_s / n * 1000, 1) if n else 0.0,
+                "ratio": round(self.raw_bytes / self.bytes, 1) if self.bytes else 0.0,
+                "formats": dict(self.formats),
+            }
+
+upload_stats = UploadStats()
+
+def _encode(pil_img: Image.Image) -> EncodedImage:
+    enc = encode_for_upload(pil_img)
+    upload_stats.record(enc)
+    return enc
+
+def _chunk_text(chunk) -> str:
+    # chunk sem partes (ex.: só finish_reason/safety) faz .text levantar ValueError
+    try:
+        return chunk.text or ""
+    except (ValueError, AttributeError, IndexError):
+        return ""
+
 def _ensure_pil(img: Union[Image.Image, bytes, bytearray, str, os.PathLike]) -> Image.Image:
     """Garante que a entrada seja convertida para PIL.Image"""
     if isinstance(img, Image.Image):
@@ -72,45 +295,259 @@ def call_gemini_on_image(
     img: Union[Image.Image, bytes, bytearray, str, os.PathLike],
     prompt: str,
     model_name: str = DEFAULT_MODEL,
+    use_cache: bool = True,
+    on_rows: Optional[Callable[[List[Dict[str, Any]]], None]] = None,
 ) -> str:
     """
-    Sempre envia PIL.Image ao SDK. NÃO envia bytes crus.
+    img (PIL, bytes ou caminho) é aberto como PIL e codificado por
+    encode_for_upload antes do envio: o SDK recebe os bytes já codificados
+    (PNG paleta / WebP sem perdas / JPEG, conforme UPLOAD_FORMAT) dentro do
+    orçamento UPLOAD_MAX_KB, em vez de reencodar a imagem em JPEG qualidade 75.
+    Com use_cache, respostas anteriores para o mesmo crop/prompt/modelo vêm do disco.
+    on_rows: ver call_gemini_on_image_payload.
+    """
+    raw_text, _ = call_gemini_on_image_payload(api_key, img, prompt, model_name, use_cache=use_cache, on_rows=on_rows)
+    return raw_text
+
+def call_gemini_on_image_payload(
+    api_key: str,
+    img: Union[Image.Image, bytes, bytearray, str, os.PathLike],
+    prompt: str,
+    model_name: str = DEFAULT_MODEL,
+    use_cache: bool = True,
+    on_rows: Optional[Callable[[List[Dict[str, Any]]], None]] = None,
+) -> Tuple[str, Any]:
+    """
+    Como call_gemini_on_image, mas devolve (texto bruto, payload parseado).
+    Em cache hit o payload já vem parseado, sem nova chamada nem novo parse.
+
+    on_rows: liga o streaming (generate_content(stream=True)); é chamado, na
+    thread de quem chamou, com as linhas de tables[*].rows que ficaram
+    completas a cada chunk. Em cache hit recebe todas as linhas de uma vez.
+    O retorno é o mesmo do modo sem streaming.
     """
     if not api_key:
         raise RuntimeError("GEMINI_API_KEY ausente.")
 
-    genai.configure(api_key=api_key)
     pil_img = _ensure_pil(img)
+    key = response_key(pil_img, prompt, model_name) if use_cache else None
+    if key:
+        entry = response_cache.get(key)
+        if entry is not None:
+            if on_rows:
+                rows = StreamingRowParser().feed(entry["raw_text"] or "")
+                if rows:
+                    on_rows(rows)
+            return entry["raw_text"], entry["payload"]
+
+    model = model_registry.get(api_key, model_name)
 
-    model = genai.GenerativeModel(model_name)
+    # Enviar como parte multimodal: [prompt, imagem já codificada (formato/tamanho controlados)]
+    contents = [prompt, _encode(pil_img).as_part()]
+    if on_rows:
+        parser = StreamingRowParser()
+        parts = []
+        for text in model.stream_text(contents):
+            parts.append(text)
+            rows = parser.feed(text)
+            if rows:
+                on_rows(rows)
+        raw_text = "".join(parts)
+    else:
+        resp = model.generate_content(contents)
+        raw_text = resp.text or ""
+    payload, repaired = extract_json(raw_text)
+    if repaired:
+        print("Aviso: resposta do Gemini truncada; mantidas as linhas completas.")
 
-    # Enviar como parte multimodal: [prompt, PIL.Image]
-    resp = model.generate_content([prompt, pil_img])
-    return resp.text or ""
+    # Só guarda respostas aproveitáveis (erros, vazios e truncadas são refeitos na próxima vez)
+    if key and payload is not None and not repaired:
+        response_cache.put(key, model_name=model_name, raw_text=raw_text, payload=payload)
+    return raw_text, payload
 
 def call_gemini_on_image_json(
     api_key: str,
     img: Union[Image.Image, bytes, bytearray, str, os.PathLike],
     prompt: str = SHARED_PROMPT,
     model_name: str = DEFAULT_MODEL,
+    use_cache: bool = True,
 ) -> str:
     """
     Versão especializada para extração de tabelas em JSON.
     Usa o prompt compartilhado por padrão.
     """
-    return call_gemini_on_image(api_key, img, prompt, model_name)
+    return call_gemini_on_image(api_key, img, prompt, model_name, use_cache=use_cache)
+
+# ---------------------------------------------------------------------------
+# Cliente assíncrono: semáforo global + token bucket de RPM/TPM
+# ---------------------------------------------------------------------------
+
+class TokenBucket:
+    """
+    Token bucket assíncrono para limites "por minuto".
+    Capacidade = limite/minuto; reabastece continuamente. per_minute <= 0 desliga.
+    """
+
+    def __init__(self, per_minute: float, *, clock: Callable[[], float] = time.monotonic):
+        self.capacity = float(per_minute or 0)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self._clock = clock
+        self._updated = clock()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1.0) -> None:
+        if self.capacity <= 0:
+            return
+        amount = min(float(amount), self.capacity)  # pedido maior que o balde: espera encher
+        async with self._lock:  # FIFO: ninguém "fura a fila" de quem está esperando
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+def estimate_request_tokens(prompt: str, img: Union[Image.Image, EncodedImage]) -> int:
+    """
+    Estimativa grosseira de tokens de entrada: ~4 chars/token no texto e
+    258 tokens por bloco de 768x768 da imagem (regra de contagem do Gemini).
+    """
+    tiles = max(1, math.ceil(img.width / 768)) * max(1, math.ceil(img.height / 768))
+    return len(prompt) // 4 + 258 * tiles
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+def _is_rate_limit_error(e: Exception) -> bool:
+    return type(e).__name__ in ("ResourceExhausted", "TooManyRequests") or "429" in str(e)
+
+# backend(model_name, [prompt, {"mime_type", "data"}]) -> texto da resposta
+AsyncBackend = Callable[[str, List[Any]], Awaitable[str]]
+
+class AsyncGeminiClient:
+    """
+    Cliente assíncrono para disparar muitos crops em paralelo sem tempestades de 429.
+
+    - sessão compartilhada: handles do model_registry (configure uma vez por chave)
+    - semáforo: no máximo GEMINI_MAX_CONCURRENCY requisições em voo
+    - token buckets: GEMINI_RPM (requisições/min) e GEMINI_TPM (tokens/min)
+    - backend injetável (ex.: servidor fake local nos testes)
+
+    Os limitadores pertencem ao event loop em que são usados: use um cliente
+    por loop (get_async_client cuida disso).
+    """
+
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        model_name: str = DEFAULT_MODEL,
+        *,
+        max_concurrency: Optional[int] = None,
+        rpm: Optional[int] = None,
+        tpm: Optional[int] = None,
+        max_retries: Optional[int] = None,
+        backend: Optional[AsyncBackend] = None,
+    ):
+        load_dotenv(CONFIG_DIR / ".env")
+        self.api_key = api_key or os.getenv("GEMINI_API_KEY")
+        self.model_name = model_name
+        self.max_concurrency = max_concurrency or _env_int("GEMINI_MAX_CONCURRENCY", 8)
+        self.max_retries = max_retries if max_retries is not None else _env_int("GEMINI_MAX_RETRIES", 4)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._rpm = TokenBucket(rpm if rpm is not None else _env_int("GEMINI_RPM", 60))
+        self._tpm = TokenBucket(tpm if tpm is not None else _env_int("GEMINI_TPM", 1_000_000))
+        self._backend = backend or self._genai_backend
+        self.stats = {"requests": 0, "retries": 0, "errors": 0}
+
+    async def _genai_backend(self, model_name: str, parts: List[Any]) -> str:
+        model = model_registry.get(self.api_key, model_name)
+        resp = await model.generate_content_async(parts)
+        return resp.text or ""
+
+    async def generate(
+        self,
+        img: Union[EncodedImage, Image.Image, bytes, bytearray, str, os.PathLike],
+        prompt: str,
+        model_name: Optional[str] = None,
+    ) -> str:
+        """
+        Equivalente assíncrono de call_gemini_on_image, respeitando os limites.
+        Aceita o crop já codificado (encode_for_upload); senão codifica numa thread.
+        """
+        enc = img if isinstance(img, EncodedImage) else await asyncio.to_thread(_encode, _ensure_pil(img))
+        model_name = model_name or self.model_name
+        tokens = estimate_request_tokens(prompt, enc)
+        attempt = 0
+        while True:
+            await self._rpm.acquire(1)
+            await self._tpm.acquire(tokens)
+            async with self._semaphore:
+                self.stats["requests"] += 1
+                try:
+                    return await self._backend(model_name, [prompt, enc.as_part()])
+                except Exception as e:
+                    if not _is_rate_limit_error(e) or attempt >= self.max_retries:
+                        self.stats["errors"] += 1
+                        raise
+            # 429: backoff exponencial fora do semáforo, liberando a vaga
+            self.stats["retries"] += 1
+            await asyncio.sleep(min(60.0, 2 ** attempt))
+            attempt += 1
+
+    async def generate_many(
+        self,
+        imgs: Sequence[Union[Image.Image, bytes, bytearray, str, os.PathLike]],
+        prompt: str,
+        model_name: Optional[str] = None,
+    ) -> List[Union[str, Exception]]:
+        """Processa vários crops concorrentemente; erros voltam no lugar do texto."""
+        return await asyncio.gather(
+            *(self.generate(img, prompt, model_name) for img in imgs),
+            return_exceptions=True,
+        )
+
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, AsyncGeminiClient]]" = weakref.WeakKeyDictionary()
+
+def get_async_client(api_key: str, model_name: str = DEFAULT_MODEL) -> AsyncGeminiClient:
+    """Cliente compartilhado (semáforo/limites globais) do event loop atual."""
+    loop = asyncio.get_running_loop()
+    per_loop = _async_clients.setdefault(loop, {})
+    client = per_loop.get(api_key)
+    if client is None:
+        client = per_loop[api_key] = AsyncGeminiClient(api_key, model_name)
+    return client
+
+async def call_gemini_on_image_async(
+    api_key: str,
+    img: Union[Image.Image, bytes, bytearray, str, os.PathLike],
+    prompt: str,
+    model_name: str = DEFAULT_MODEL,
+) -> str:
+    """Versão assíncrona de call_gemini_on_image (usa o cliente compartilhado do loop)."""
+    if not api_key:
+        raise RuntimeError("GEMINI_API_KEY ausente.")
+    return await get_async_client(api_key, model_name).generate(img, prompt, model_name)
 
 class GeminiClient:
     def __init__(self, config_dir: str = "config"):
         load_dotenv(f"{config_dir}/.env")
         self.api_key = os.getenv("GEMINI_API_KEY")
-        self.model_name = os.getenv("GEMINI_MODEL", "gemini-1.5-pro")
+        self.model_name = os.getenv("GEMINI_MODEL", DEFAULT_MODEL)
         
         if not self.api_key:
             raise ValueError("GEMINI_API_KEY não encontrada. Configure o arquivo .env")
         
-        genai.configure(api_key=self.api_key)
-        self.model = genai.GenerativeModel(self.model_name)
+        # Handle compartilhado com call_gemini_on_image (mesmo modelo, mesmo transporte)
+        self.model = model_registry.get(self.api_key, self.model_name)
     
     def extract_table_from_image(self, image_path: str) -> Dict[str, Any]:
         """
@@ -212,58 +649,9 @@ class GeminiClient:
     def _extract_json_from_response(self, response_text: str) -> Optional[List[Dict]]:
         """
         Extrai JSON da resposta do Gemini, tratando diferentes formatos
+        (cercas de código, texto em volta, resposta truncada) em uma passada.
         """
-        # Remover espaços em branco
-        text = response_text.strip()
-        
-        # Tentar diferentes padrões de extração
-        
-        # 1. JSON direto
-        try:
-            return json.loads(text)
-        except:
-            pass
-        
-        # 2. JSON com cercas de código
-        patterns = [
-            r'```json\s*(.*?)\s*```',
-            r'```\s*(.*?)\s*```',
-            r'\[.*\]',  # Array JSON
-            r'\{.*\}',  # Objeto JSON
-        ]
-        
-        for pattern in patterns:
-            matches = re.findall(pattern, text, re.DOTALL)
-            for match in matches:
-                try:
-                    # Limpar o match
-                    cleaned = match.strip()
-                    if cleaned.startswith('[') or cleaned.startswith('{'):
-                        return json.loads(cleaned)
-                except:
-                    continue
-        
-        # 3. Tentar encontrar array JSON no texto
-        try:
-            # Procurar por arrays JSON
-            array_match = re.search(r'\[[\s\S]*\]', text)
-            if array_match:
-                return json.loads(array_match.group())
-        except:
-            pass
-        
-        # 4. Última tentativa: tentar parse do texto completo
-        try:
-            # Remover possíveis prefixos/sufixos
-            cleaned_text = re.sub(r'^[^{[]*', '', text)
-            cleaned_text = re.sub(r'[^}\]]*$', '', cleaned_text)
-            
-            if cleaned_text.startswith('[') or cleaned_text.startswith('{'):
-                return json.loads(cleaned_text)
-        except:
-            pass
-        
-        return None
+        return loads_loose(response_text)
     
     def validate_api_key(self) -> bool:
         """Valida se a API key está funcionando"""
@@ -275,30 +663,89 @@ class GeminiClient:
             print(f"Erro na validação da API key: {e}")
             return False
 
-def validate_gemini_key(api_key: str) -> bool:
-    """
-    Valida se a chave da API Gemini é válida
-    Args:
-        api_key: Chave da API Gemini
-    Returns:
-        bool: True se a chave for válida, False caso contrário
-    """
+def _check_gemini_key(api_key: str) -> Tuple[bool, str]:
+    """Faz a requisição de teste; devolve (válida, mensagem de erro)."""
     try:
         if not api_key or not api_key.strip():
-            return False
-        
-        # Configurar a API com a chave fornecida
-        genai.configure(api_key=api_key)
+            return False, "Chave vazia."
         
-        # Criar um modelo temporário para teste
-        temp_model = genai.GenerativeModel("gemini-1.5-pro")
+        # Reaproveita o handle do modelo padrão (sem novo configure/GenerativeModel)
+        model = model_registry.get(api_key, DEFAULT_MODEL)
         
         # Fazer uma requisição simples de teste
-        response = temp_model.generate_content("Teste de conexão")
+        response = model.generate_content("Teste de conexão")
         
         # Se chegou até aqui sem erro, a chave é válida
-        return response.text is not None
+        if response.text is None:
+            return False, "Resposta vazia na requisição de teste."
+        return True, ""
         
     except Exception as e:
         print(f"Erro na validação da chave Gemini: {e}")
-        return False
+        return False, str(e)
+
+def validate_gemini_key(api_key: str) -> bool:
+    """
+    Valida se a chave da API Gemini é válida
+    Args:
+        api_key: Chave da API Gemini
+    Returns:
+        bool: True se a chave for válida, False caso contrário
+    """
+    return _check_gemini_key(api_key)[0]
+
+class KeyValidationCache:
+    """
+    Valida cada chave uma vez por processo, em background.
+    Depois do TTL devolve o último resultado e revalida em segundo plano
+    (stale-while-revalidate), então o rerun do Streamlit nunca espera a rede.
+    """
+
+    def __init__(self, ttl_s: float = 3600, validator: Optional[Callable[[str], Tuple[bool, str]]] = None):
+        self.ttl_s = float(ttl_s)
+        self._validator = validator or _check_gemini_key
+        self._lock = threading.Lock()
+        self._state: Dict[str, Dict[str, Any]] = {}
+
+    @staticmethod
+    def _key_id(api_key: str) -> str:
+        return hashlib.sha256((api_key or "").encode()).hexdigest()  # não guarda a chave em claro
+
+    def _run(self, kid: str, api_key: str) -> None:
+        valid, error = self._validator(api_key)
+        with self._lock:
+            self._state[kid].update(valid=valid, error=error, checked_at=time.time(), checking=False)
+
+    def status(self, api_key: str) -> Dict[str, Any]:
+        """
+        {"valid": True/False/None, "error": str, "checked_at": float, "checking": bool}
+        valid=None => primeira validação ainda em andamento.
+        """
+        kid = self._key_id(api_key)
+        with self._lock:
+            state = self._state.setdefault(
+                kid, {"valid": None, "error": "", "checked_at": 0.0, "checking": False}
+            )
+            expired = state["checked_at"] == 0.0 or time.time() - state["checked_at"] > self.ttl_s
+            if expired and not state["checking"]:
+                state["checking"] = True
+                threading.Thread(
+                    target=self._run, args=(kid, api_key), name="gemini-key-check", daemon=True
+                ).start()
+            return dict(state)
+
+    def invalidate(self, api_key: str) -> None:
+        """Força nova validação no próximo status()."""
+        with self._lock:
+            state = self._state.get(self._key_id(api_key))
+            if state and not state["checking"]:
+                state["checked_at"] = 0.0
+
+    def wait(self, api_key: str, timeout: float = 30.0) -> Dict[str, Any]:
+        """Bloqueia até haver resultado (útil fora do Streamlit)."""
+        deadline = time.time() + timeout
+        state = self.status(api_key)
+        while state["valid"] is None and time.time() < deadline:
+            time.sleep(0.1)
+            state = self.status(api_key)
+        return state
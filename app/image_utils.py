@@ -1,6 +1,13 @@
 from PIL import Image
 import io
-from typing import Any
+import math
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from app.settings import (
+    UPLOAD_FORMAT, UPLOAD_MAX_KB, UPLOAD_QUANTIZE, UPLOAD_JPEG_QUALITY, UPLOAD_JPEG_MIN_QUALITY,
+    TILE_HEIGHT_PX, TILE_OVERLAP_PX,
+)
 
 def as_pil_image(obj: Any) -> Image.Image:
     """
@@ -21,3 +28,210 @@ def as_pil_image(obj: Any) -> Image.Image:
     if img.mode not in ("RGB", "L"):
         img = img.convert("RGB")
     return img
+
+class EncodedImage:
+    """Crop já codificado para upload (parte inline do Gemini) + métricas."""
+
+    def __init__(self, data: bytes, mime_type: str, fmt: str, size: Tuple[int, int],
+                 raw_bytes: int, encode_s: float, scaled: bool = False):
+        self.data = data
+        self.mime_type = mime_type
+        self.format = fmt             # ex.: "png-paleta", "webp-lossless", "jpeg-q85"
+        self.width, self.height = size
+        self.raw_bytes = raw_bytes    # pixels descomprimidos
+        self.encode_s = encode_s
+        self.scaled = scaled          # True se precisou reduzir a resolução para caber no orçamento
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.data)
+
+    def as_part(self) -> Dict[str, Any]:
+        """Blob inline aceito pelo SDK em generate_content([prompt, parte])."""
+        return {"mime_type": self.mime_type, "data": self.data}
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "format": self.format,
+            "bytes": self.nbytes,
+            "raw_bytes": self.raw_bytes,
+            "encode_ms": round(self.encode_s * 1000, 1),
+            "size": (self.width, self.height),
+            "scaled": self.scaled,
+        }
+
+def _save(img: Image.Image, fmt: str, **params) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format=fmt, **params)
+    return buf.getvalue()
+
+def _exact_palette(img: Image.Image) -> Optional[Image.Image]:
+    """Modo P sem perdas quando o crop tem até 256 cores (render sem antialias: o caso comum)."""
+    colors = img.getcolors(256)
+    if colors is None:
+        return None
+    if img.mode == "L":
+        return img  # PNG em tons de cinza já é 8 bits
+    # quantize(palette=...) do Pillow aproxima cores vizinhas; o índice exato sai do numpy
+    # (RGBX lido como uint32 = uma chave por pixel; busca binária nas <= 256 cores)
+    import numpy as np
+    swatch = Image.new("RGB", (len(colors), 1))
+    swatch.putdata([rgb for _, rgb in colors])
+    palette_keys = np.frombuffer(swatch.convert("RGBX").tobytes(), dtype=np.uint32)
+    order = np.argsort(palette_keys)
+    keys = np.frombuffer(img.convert("RGBX").tobytes(), dtype=np.uint32)
+    idx = np.searchsorted(palette_keys[order], keys).astype(np.uint8)
+    pal = Image.frombytes("P", img.size, idx.tobytes())
+    pal.putpalette(bytes(c for i in order for c in colors[i][1]))
+    return pal
+
+def _color_histogram(img: Image.Image, max_colors: int = 65536):
+    """Histograma de cores de uma amostra (~1 MP); None se houver mais de max_colors (foto)."""
+    factor = int((img.width * img.height / 1_000_000) ** 0.5)
+    sample = img.reduce(factor) if factor > 1 else img
+    return sample.getcolors(max_colors), sample.width * sample.height
+
+def _line_drawing_palette(img: Image.Image, hist, n_pixels: int, colors: int = 256,
+                          coverage: float = 0.98) -> Optional[Image.Image]:
+    """
+    Desenho de linha (poucas cores dominam; o resto é antialias/ruído nas bordas)
+    -> paleta de `colors` cores. Fotos e imagens de tom contínuo ficam de fora.
+    """
+    top = sum(n for n, _ in sorted(hist, reverse=True)[:colors])
+    if top < coverage * n_pixels:
+        return None
+    # FASTOCTREE: ~6x mais rápido que MEDIANCUT e funde o ruído de fundo dos escaneados
+    return img.convert("RGB").quantize(colors=colors, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+
+def encode_for_upload(
+    img: Image.Image,
+    *,
+    fmt: str = UPLOAD_FORMAT,
+    max_bytes: int = UPLOAD_MAX_KB * 1024,
+    quantize: bool = UPLOAD_QUANTIZE,
+    jpeg_quality: int = UPLOAD_JPEG_QUALITY,
+    jpeg_min_quality: int = UPLOAD_JPEG_MIN_QUALITY,
+) -> EncodedImage:
+    """
+    Codifica o crop para envio ao Gemini dentro de um orçamento de bytes.
+
+    auto: PNG de paleta exata (<= 256 cores) -> paleta quantizada para desenhos
+    de linha (quantize) -> WebP sem perdas -> JPEG de qualidade limitada.
+    Fotos (> 65536 cores na amostra) vão direto para JPEG, onde o WebP sem
+    perdas seria grande e lento.
+    png / webp / jpeg forçam o formato. Em qualquer caso, se o resultado passar
+    de max_bytes cai para JPEG (jpeg_quality até jpeg_min_quality) e, por último,
+    reduz a resolução até caber.
+    """
+    t0 = time.perf_counter()
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    raw_bytes = len(img.getbands()) * img.width * img.height
+    fmt = (fmt or "auto").lower()
+
+    def done(data: bytes, mime: str, label: str, size=img.size, scaled=False) -> EncodedImage:
+        return EncodedImage(data, mime, label, size, raw_bytes, time.perf_counter() - t0, scaled)
+
+    # 1) Sem perdas (ou paleta, no caso de desenho de linha)
+    pal = None
+    if fmt in ("auto", "png"):
+        pal = _exact_palette(img)
+        if pal is not None:
+            data = _save(pal, "PNG", optimize=False)
+            if len(data) <= max_bytes:
+                return done(data, "image/png", "png-paleta")
+        elif fmt == "png":
+            data = _save(img, "PNG", compress_level=6)
+            if len(data) <= max_bytes:
+                return done(data, "image/png", "png")
+    continuous = False
+    if fmt == "auto" and pal is None:
+        hist, n_pixels = _color_histogram(img)
+        continuous = hist is None
+        if not continuous and quantize:
+            pal = _line_drawing_palette(img, hist, n_pixels)
+            if pal is not None:
+                data = _save(pal, "PNG", optimize=False)
+                if len(data) <= max_bytes:
+                    return done(data, "image/png", "png-quantizado")
+    if fmt == "webp" or (fmt == "auto" and not continuous):
+        data = _save(img, "WEBP", lossless=True, method=2, quality=25)  # esforço médio: ~3x mais rápido que o padrão
+        if len(data) <= max_bytes:
+            return done(data, "image/webp", "webp-lossless")
+
+    # 2) JPEG com qualidade limitada
+    rgb = img.convert("RGB") if img.mode != "RGB" else img
+    jpeg_quality = max(jpeg_quality, jpeg_min_quality)  # configuração invertida: começa no mínimo
+    for q in [*range(jpeg_quality, jpeg_min_quality, -5), jpeg_min_quality]:  # passos de 5, sempre terminando no mínimo
+        data = _save(rgb, "JPEG", quality=q, optimize=False)
+        if len(data) <= max_bytes:
+            return done(data, "image/jpeg", f"jpeg-q{q}")
+
+    # 3) Último recurso: reduz a resolução (proporcional ao excesso) até caber
+    scaled = rgb
+    while len(data) > max_bytes and min(scaled.size) > 64:
+        factor = max(0.5, 0.95 * (max_bytes / len(data)) ** 0.5)
+        scaled = scaled.resize((max(1, int(scaled.width * factor)), max(1, int(scaled.height * factor))),
+                               Image.Resampling.LANCZOS)
+        data = _save(scaled, "JPEG", quality=jpeg_min_quality, optimize=False)
+    return done(data, "image/jpeg", f"jpeg-q{jpeg_min_quality}", scaled.size, scaled=True)
+
+# ---------------------------------------------------------------------------
+# Faixas horizontais para extração de recortes altos (pipeline._extract_crop)
+# ---------------------------------------------------------------------------
+
+def _runs(mask) -> List[Tuple[int, int]]:
+    """Sequências [início, fim) de linhas True."""
+    import numpy as np
+    d = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return list(zip(np.flatnonzero(d == 1).tolist(), np.flatnonzero(d == -1).tolist()))
+
+def tile_bands(img: Image.Image, *, tile_height: int = TILE_HEIGHT_PX,
+               overlap: int = TILE_OVERLAP_PX) -> List[Tuple[int, int]]:
+    """
+    Divide a altura do recorte em faixas (y0, y1) sobrepostas, de cima para baixo.
+
+    Os cortes caem, em ordem de preferência, num vão em branco largo (entre
+    tabelas), numa régua horizontal (linha escura em >= metade da largura) ou
+    num vão entre linhas de texto, dentro de +-1/4 da altura alvo; sem nada
+    disso, na altura ideal. A sobreposição vai de `overlap` px até a fronteira
+    de linha seguinte, para que as linhas da emenda apareçam inteiras nas duas
+    faixas (merge_tile_payloads remove as repetidas).
+    """
+    import numpy as np
+    h = img.height
+    n = math.ceil(h / max(1, tile_height))
+    if n <= 1:
+        return [(0, h)]
+
+    dark = (np.asarray(img.convert("L")) < 128).mean(axis=1)
+    big_gap = max(24, tile_height // 40)
+    # (y, prioridade): 3 = vão largo, 2 = régua, 1 = vão entre linhas de texto
+    cands = [((a + b) // 2, 3 if b - a >= big_gap else 1) for a, b in _runs(dark <= 0.002) if b - a >= 4]
+    cands += [((a + b) // 2, 2) for a, b in _runs(dark >= 0.5)]
+    cands.sort()
+    bounds = np.array([y for y, _ in cands], dtype=np.int64)
+
+    step = h / n
+    window = tile_height // 4
+    cuts = [0]
+    for k in range(1, n):
+        ideal = int(k * step)
+        near = [(p, -abs(y - ideal), y) for y, p in cands if abs(y - ideal) <= window and y > cuts[-1] + window]
+        cuts.append(max(near)[2] if near else ideal)
+    cuts.append(h)
+
+    def _bound_at_or_after(y):
+        i = int(np.searchsorted(bounds, y))
+        return int(bounds[i]) if i < len(bounds) and bounds[i] - y <= window else y
+
+    def _bound_at_or_before(y):
+        i = int(np.searchsorted(bounds, y, side="right")) - 1
+        return int(bounds[i]) if i >= 0 and y - bounds[i] <= window else y
+
+    bands = []
+    for k in range(n):
+        y0 = 0 if k == 0 else max(0, _bound_at_or_before(cuts[k] - overlap))
+        y1 = h if k == n - 1 else min(h, _bound_at_or_after(cuts[k + 1] + overlap))
+        bands.append((y0, y1))
+    return bands
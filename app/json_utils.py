@@ -1,48 +1,345 @@
 # app/json_utils.py
 import json
 import re
-from typing import Any
+from json.decoder import JSONDecodeError, scanstring
+from typing import Any, Dict, List, Tuple
 
-def loads_loose(text: str) -> Any:
+_STRUCT = re.compile(r'[{}\[\]",:]')
+_CLOSER = {"{": "}", "[": "]"}
+_FENCE = "```"
+_DECODER = json.JSONDecoder(strict=False)  # tolera quebras de linha cruas dentro de strings
+_UNPARSED = object()
+
+def _find_fence(text: str, pos: int = 0) -> int:
+    """Posição do próximo ``` no início de uma linha (só espaços antes), ou -1."""
+    while True:
+        i = text.find(_FENCE, pos)
+        if i < 0:
+            return -1
+        j = i
+        while j > 0 and text[j - 1] in " \t":
+            j -= 1
+        if j == 0 or text[j - 1] == "\n":
+            return i
+        pos = i + len(_FENCE)
+
+def strip_code_fences(text: str) -> str:
+    """
+    Remove cercas ```json ... ``` (cerca = ``` no início de uma linha).
+    Cerca sem fechamento (resposta truncada) vale até o fim do texto.
+    """
+    fence = _find_fence(text)
+    if fence < 0:
+        return text
+    body = text.find("\n", fence)
+    body = len(text) if body < 0 else body + 1
+    close = _find_fence(text, body)
+    return text[body:close if close >= 0 else len(text)]
+
+def _scan_json_candidates(text: str) -> List[Tuple[int, int, str, Any]]:
+    """
+    Uma passada pelo texto, atenta a strings: devolve os valores JSON de nível
+    mais externo como (início, fim, sufixo, valor). Cada candidato é tentado
+    primeiro pelo parser em C (raw_decode; valor já parseado); se falhar, é
+    varrido token a token. Valor truncado no fim do texto vem cortado no
+    último ponto seguro (após um valor completo) do array aberto mais interno,
+    descartando o elemento incompleto dele (a linha recebida pela metade) se
+    ele ainda não contém nenhum array completo; se contém (a tabela cujo "rows"
+    já fechou), o corte desce para dentro dele e o elemento é mantido. Vem com
+    o sufixo que fecha os arrays/objetos abertos (valor = _UNPARSED); sem array
+    aberto, o corte é após o último valor completo; colchetes desbalanceados
+    descartam o candidato e a varredura segue adiante (nunca volta atrás).
+    """
+    candidates = []
+    raw_decode = _DECODER.raw_decode
+    stack = []            # fechamentos esperados
+    cuts = []             # por nível aberto: último ponto seguro de corte dentro dele (None = nenhum)
+    nested = []           # por nível aberto: já contém um array completo
+    start = 0
+    pos = 0
+    after_colon = False   # próximo valor é valor de chave
+    truncated = False
+    search = _STRUCT.search
+    while True:
+        m = search(text, pos)
+        if m is None:
+            truncated = bool(stack)
+            break
+        c, i = m.group(), m.start()
+        pos = i + 1
+        if not stack:
+            # fora de qualquer valor: só um '{' ou '[' inicia candidato
+            if c in _CLOSER:
+                try:
+                    value, end = raw_decode(text, i)
+                except ValueError:
+                    pass
+                else:
+                    candidates.append((i, end, "", value))
+                    pos = end
+                    continue
+                stack.append(_CLOSER[c])
+                cuts = [i + 1]
+                nested = [False]
+                start = i
+            continue
+
+        if c == '"':
+            try:
+                _, pos = scanstring(text, pos, False)
+            except JSONDecodeError as e:
+                if e.msg.startswith("Unterminated"):
+                    truncated = True  # string aberta até o fim do texto
+                    break
+                stack.clear()  # escape inválido: descarta o candidato
+                continue
+            if after_colon or stack[-1] == "]":
+                cuts[-1] = pos  # valor string completo
+        elif c == ":":
+            after_colon = True
+            continue
+        elif c in _CLOSER:
+            # valor de chave: {} / [] vazio é seguro; elemento de array ainda não
+            cuts.append(i + 1 if stack[-1] == "}" else None)
+            nested.append(False)
+            stack.append(_CLOSER[c])
+        elif c == ",":
+            cuts[-1] = i
+        elif c == stack[-1]:
+            stack.pop()
+            cuts.pop()
+            inner = nested.pop()
+            if not stack:
+                candidates.append((start, i + 1, "", _UNPARSED))
+            else:
+                cuts[-1] = i + 1
+                nested[-1] = nested[-1] or inner or c == "]"
+        else:
+            stack.clear()  # fechamento trocado: descarta o candidato
+        after_colon = False
+    if truncated:
+        depth = max((d + 1 for d, closer in enumerate(stack) if closer == "]"), default=len(stack))
+        while depth < len(stack) and nested[depth]:
+            depth += 1  # elemento com array completo dentro (ex.: tabela com "rows" fechado): mantém
+        while depth > 1 and cuts[depth - 1] is None:
+            depth -= 1
+        if cuts[depth - 1] is not None:
+            candidates.append((start, cuts[depth - 1], "".join(reversed(stack[:depth])), _UNPARSED))
+    return candidates
+
+def extract_json(text: str) -> Tuple[Any, bool]:
     """
-    Parse JSON de forma tolerante, removendo cercas de código e ruído.
+    Extrai o valor JSON de uma resposta de modelo em tempo linear:
+    remove cercas de código, ignora texto em volta e, se a resposta veio
+    truncada, fecha os arrays/objetos abertos mantendo só os itens completos
+    (o último elemento recebido pela metade é descartado).
+    Entre vários valores no texto, fica o maior que parseia.
+    Retorna (valor, reparado); (None, False) se não houver JSON.
     """
     if not text:
-        return None
-    
-    # Limpar o texto
-    cleaned = text.strip()
-    
-    # Remover cercas de código ```json ... ```
-    code_block_pattern = r'```(?:json)?\s*\n?(.*?)\n?```'
-    match = re.search(code_block_pattern, cleaned, re.DOTALL | re.IGNORECASE)
-    if match:
-        cleaned = match.group(1).strip()
-    
-    # Remover "json" no início se existir
-    if cleaned.lower().startswith('json'):
+        return None, False
+    cleaned = strip_code_fences(text.strip()).strip()
+    if cleaned[:4].lower() == "json":
         cleaned = cleaned[4:].strip()
-    
-    # Tentar parse direto
+
+    # Caminho comum: JSON válido direto (parser em C)
     try:
-        return json.loads(cleaned)
-    except json.JSONDecodeError:
+        return _DECODER.decode(cleaned), False
+    except ValueError:
         pass
-    
-    # Se falhou, tentar encontrar JSON válido no texto
-    # Procurar por arrays ou objetos JSON
-    patterns = [
-        r'\[.*\]',  # Array JSON
-        r'\{.*\}',  # Objeto JSON
-    ]
-    
-    for pattern in patterns:
-        matches = re.findall(pattern, cleaned, re.DOTALL)
-        for match in matches:
-            try:
-                return json.loads(match)
-            except json.JSONDecodeError:
+
+    # Candidatos não se sobrepõem: no pior caso cada trecho é parseado duas vezes
+    candidates = sorted(_scan_json_candidates(cleaned), key=lambda c: c[1] - c[0], reverse=True)
+    for start, end, suffix, value in candidates:
+        if value is not _UNPARSED:
+            return value, False
+        try:
+            return _DECODER.decode(cleaned[start:end] + suffix), bool(suffix)
+        except ValueError:
+            continue
+    return None, False
+
+def loads_loose(text: str) -> Any:
+    """
+    Parse JSON de forma tolerante, removendo cercas de código e ruído
+    (ver extract_json; respostas truncadas voltam reparadas).
+    """
+    return extract_json(text)[0]
+
+class StreamingRowParser:
+    """
+    Parser incremental para respostas em streaming no envelope
+    {"tables":[{"name":...,"rows":[{...}, ...]}]}.
+
+    feed(trecho) devolve as linhas (objetos de tables[*].rows; arrays "rows"
+    em outro lugar, como project_data ou dentro de uma linha, são ignorados)
+    que ficaram completas com esse trecho. Cada caractere é visto uma única vez
+    e só o texto da linha em aberto fica em memória; ruído fora do JSON
+    (cercas ```json, texto antes do primeiro '{') é ignorado.
+    O payload final continua vindo de loads_loose sobre o texto completo.
+    """
+
+    def __init__(self):
+        # frame: [tipo ('{' ou '['), chave no pai, chave atual, esperando chave, nº de filhos]
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._is_key = False
+        self._str = []
+        self._row = None          # caracteres da linha em aberto
+        self._row_depth = 0
+        self._row_table = 0
+        self._done = False
+        self.table_names = {}     # índice da tabela -> name (se vier antes/depois das linhas)
+        self.rows_seen = 0
+
+    def _in_table_rows(self) -> bool:
+        """Topo da pilha é o array "rows" de um elemento de "tables" (tables[*].rows)."""
+        stack = self._stack
+        return (len(stack) >= 3 and stack[-1][0] == "[" and stack[-1][1] == "rows"
+                and stack[-2][0] == "{" and stack[-3][0] == "[" and stack[-3][1] == "tables")
+
+    def _table_index(self) -> int:
+        for frame in reversed(self._stack):
+            if frame[0] == "[" and frame[1] == "tables":
+                return max(0, frame[4] - 1)
+        return 0
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        rows = []
+        if self._done or not chunk:
+            return rows
+        stack = self._stack
+        for c in chunk:
+            if self._row is not None:
+                self._row.append(c)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                    self._str.append(c)
+                elif c == "\\":
+                    self._escape = True
+                    self._str.append(c)
+                elif c == '"':
+                    self._in_string = False
+                    self._end_string()
+                else:
+                    self._str.append(c)
                 continue
-    
-    # Se nada funcionou, retornar None
-    return None
+
+            if c == '"':
+                if stack:
+                    self._in_string = True
+                    self._str = []
+                    top = stack[-1]
+                    self._is_key = top[0] == "{" and top[3]
+            elif c == "{" or c == "[":
+                if stack:
+                    parent = stack[-1]
+                    parent[4] += 1
+                    key = parent[2] if parent[0] == "{" else None
+                    if c == "{" and self._row is None and self._in_table_rows():
+                        self._row = ["{"]
+                        self._row_depth = len(stack) + 1
+                        self._row_table = self._table_index()
+                elif self._done:
+                    break
+                else:
+                    key = None
+                stack.append([c, key, None, c == "{", 0])
+            elif c == "}" or c == "]":
+                if not stack:
+                    continue
+                stack.pop()
+                if self._row is not None and len(stack) < self._row_depth:
+                    try:
+                        row = json.loads("".join(self._row))
+                    except ValueError:
+                        row = None
+                    self._row = None
+                    if isinstance(row, dict):
+                        rows.append(row)
+                        self.rows_seen += 1
+                if not stack:
+                    self._done = True  # fim do JSON raiz: o resto é ruído
+                    break
+            elif c == ":":
+                if stack and stack[-1][0] == "{":
+                    stack[-1][3] = False
+            elif c == ",":
+                if stack and stack[-1][0] == "{":
+                    stack[-1][3] = True
+        return rows
+
+    def _end_string(self) -> None:
+        try:
+            value = json.loads('"' + "".join(self._str) + '"')
+        except ValueError:
+            value = "".join(self._str)
+        self._str = []
+        top = self._stack[-1]
+        if self._is_key:
+            top[2] = value
+        elif top[2] == "name" and len(self._stack) >= 2 and self._stack[-2][1] == "tables":
+            self.table_names[self._table_index()] = value
+
+if __name__ == "__main__":
+    # Benchmark: python -m app.json_utils [n_linhas]
+    import sys
+    import time
+
+    def _regex_loads_loose(text):
+        # Implementação anterior (cercas por regex + findall guloso com DOTALL), para comparação
+        cleaned = text.strip()
+        match = re.search(r'```(?:json)?\s*\n?(.*?)\n?```', cleaned, re.DOTALL | re.IGNORECASE)
+        if match:
+            cleaned = match.group(1).strip()
+        try:
+            return json.loads(cleaned)
+        except json.JSONDecodeError:
+            pass
+        for pattern in (r'\[.*\]', r'\{.*\}'):
+            for match in re.findall(pattern, cleaned, re.DOTALL):
+                try:
+                    return json.loads(match)
+                except json.JSONDecodeError:
+                    continue
+        return None
+
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+    payload = {"tables": [{"name": "estrutura", "rows": [
+        {"material": f"Perfil W{i} [aço]", "descricao": "Viga {principal} " * 3,
+         "qtd": str(i), "peso_total_kg": "12,5"} for i in range(n_rows)]}]}
+    body = json.dumps(payload, ensure_ascii=False)
+    cases = {
+        "válido": body,
+        "cercas + ruído": "Segue [conforme pedido]:\n```json\n" + body + "\n```\nObs.: {fim} [1]",
+        "texto em volta": "Segue a tabela [rev. 2] {ok}:\n" + body + "\nObs.: [1] {fim}",
+        "truncado": body[: int(len(body) * 0.9)],
+    }
+    print(f"payload: {len(body) / 1024:.0f} KB, {n_rows} linhas")
+    for name, text in cases.items():
+        for label, fn in (("extract_json", lambda t: extract_json(t)[0]), ("regex", _regex_loads_loose)):
+            dt = float("inf")
+            for _ in range(3):
+                t0 = time.perf_counter()
+                value = fn(text)
+                dt = min(dt, time.perf_counter() - t0)
+            rows = len(value["tables"][0]["rows"]) if isinstance(value, dict) and value.get("tables") else 0
+            print(f"  {name:<15} {label:<13} {dt * 1000:8.1f} ms  linhas={rows}")
+
+    # Reparo de truncamento: linhas completas ficam, a recebida pela metade sai
+    repairs = {
+        '{"tables":[{"name":"t","rows":[{"a":"1"},{"a":"2"}]':
+            {"tables": [{"name": "t", "rows": [{"a": "1"}, {"a": "2"}]}]},
+        '{"tables":[{"name":"t","rows":[{"a":"1"}],"header_in_image":"X':
+            {"tables": [{"name": "t", "rows": [{"a": "1"}]}]},
+        '{"tables":[{"name":"t","rows":[{"a":"1"},{"a":"3","peso":':
+            {"tables": [{"name": "t", "rows": [{"a": "1"}]}]},
+        '{"b":[1,2': {"b": [1]},
+    }
+    for text, expected in repairs.items():
+        value, repaired = extract_json(text)
+        assert repaired and value == expected, (text, value)
+    print(f"  reparos de truncamento: {len(repairs)} ok")
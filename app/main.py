@@ -15,6 +15,7 @@ configure()
 
 import streamlit as st
 import tempfile
+import time
 import os
 from pathlib import Path
 from PIL import Image
@@ -47,16 +48,17 @@ def _pil_to_png_bytes(img: Image.Image) -> bytes:
 
 # Importar módulos locais (sem execução de código Streamlit)
 import pandas as pd
-from app.presets import list_active_presets, preset_label, get_preset_by_id, upsert_preset
-from app.gemini_client import GeminiClient, validate_gemini_key, call_gemini_on_image
-from app.pdf_utils import PDFUtils, bbox_rel_to_px, draw_overlay, render_page_pair, render_pdf_page
+from app.presets import list_active_presets, preset_label, get_preset_by_id, upsert_preset, record_preset_use
+from app.template_index import auto_preset, template_key
+from app.gemini_client import GeminiClient, KeyValidationCache, call_gemini_on_image, model_registry, upload_stats, DEFAULT_MODEL
+from app.pdf_utils import PDFUtils, bbox_rel_to_px, draw_overlay, render_page_pair, render_pdf_page, render_cache_stats
 from app.ui_state import UIState
 from app.ui_compat import image_fluid, dataframe_fluid, patch_streamlit_image_to_url, pil_to_data_url
 from app.image_utils import as_pil_image
 from app.paths import ensure_dirs, OUT_DIR, CROPS_DIR
 from app.save_utils import save_crop_image
 from app.result_utils import is_empty_extraction, extract_rows_from_model_payload, get_table_name
-from app.settings import PROCESS_DPI
+from app.settings import PROCESS_DPI, BATCH_CONCURRENCY, KEY_VALIDATION_TTL_S, DEFAULT_PAGE_FILTER
 # aggregate será importado quando necessário (evita execução prematura de st.session_state)
 
 def _bbox_ready(b):
@@ -351,6 +353,8 @@ def init_components():
     """Inicializa os componentes principais"""
     try:
         gemini_client = GeminiClient()
+        # Aquece os handles usados pelo pipeline e pelo GeminiClient
+        model_registry.warm(gemini_client.api_key, sorted({DEFAULT_MODEL, gemini_client.model_name}))
         pdf_utils = PDFUtils()
         ui_state = UIState()
         return gemini_client, pdf_utils, ui_state
@@ -363,9 +367,18 @@ gemini_client, pdf_utils, ui_state = init_components()
 if not all([gemini_client, pdf_utils, ui_state]):
     st.stop()
 
+# Validação da chave compartilhada entre sessões (mesmo mecanismo de init_components)
+@st.cache_resource
+def get_key_validator():
+    """Cache de validação da chave Gemini (uma checagem por chave por processo)"""
+    return KeyValidationCache(ttl_s=KEY_VALIDATION_TTL_S)
+
 # Validação de credenciais da API Gemini
 def validate_credentials():
-    """Valida se as credenciais da API Gemini estão configuradas e são válidas"""
+    """
+    Verifica se a chave existe e consulta o status da validação em cache.
+    A requisição de teste roda em background: o rerun nunca espera a rede.
+    """
     try:
         # Verificar se a API key existe
         if not gemini_client.api_key:
@@ -381,8 +394,8 @@ def validate_credentials():
             """)
             st.stop()
         
-        # Validar se a chave é válida
-        if not validate_gemini_key(gemini_client.api_key):
+        status = get_key_validator().status(gemini_client.api_key)
+        if status["valid"] is False:
             st.error("❌ **Erro:** A chave da API Gemini é inválida ou não foi possível autenticar.")
             st.markdown("""
             **Possíveis causas:**
@@ -397,16 +410,20 @@ def validate_credentials():
             3. Verifique sua quota de API
             4. Teste a conectividade com a internet
             """)
-            st.stop()
+            if status["error"]:
+                st.caption(f"Detalhe: {status['error']}")
+            if st.button("🔄 Validar novamente", key="btn_revalidate_key"):
+                get_key_validator().invalidate(gemini_client.api_key)
+                st.rerun()
         
-        return True
+        return status
         
     except Exception as e:
         st.error(f"❌ **Erro:** Erro inesperado na validação de credenciais: {str(e)}")
         st.stop()
 
 # Executar validação de credenciais
-validate_credentials()
+key_status = validate_credentials()
 
 # Título e descrição
 st.title("📊 Takeoff AI Multi v2")
@@ -426,8 +443,12 @@ with st.sidebar:
     st.header("⚙️ Configurações")
     
     # Status da API Gemini
-    st.success("✅ API Gemini configurada e válida")
-    st.info("A chave da API foi validada com sucesso!")
+    if key_status["valid"] is True:
+        st.success("✅ API Gemini configurada e válida")
+    elif key_status["valid"] is None:
+        st.info("⏳ Validando a chave da API em segundo plano…")
+    else:
+        st.warning("⚠️ Chave da API Gemini não validada")
     
     # Template name
     template_name = st.text_input(
@@ -451,6 +472,65 @@ with st.sidebar:
     else:
         st.info("Nenhum preset salvo ainda")
 
+    # Cache de respostas do Gemini
+    from app.response_cache import response_cache
+    st.toggle(
+        "Usar cache de respostas do Gemini",
+        value=True, key="use_response_cache",
+        help="Reaproveita a resposta quando o mesmo recorte já foi enviado com o mesmo prompt e modelo. "
+             "Desligue para forçar uma nova chamada."
+    )
+    _cs = response_cache.get_stats()
+    st.caption(
+        f"🧠 Cache de respostas: {_cs['hits']} hits / {_cs['misses']} misses "
+        f"(taxa {_cs['hit_rate']:.0%})"
+    )
+    if st.button("🗑️ Limpar cache de respostas", key="btn_clear_response_cache"):
+        response_cache.clear()
+        st.toast("Cache de respostas limpo.", icon="🗑️")
+
+    from app.pipeline import text_layer_stats
+    st.toggle(
+        "Ler tabelas da camada de texto do PDF",
+        value=True, key="use_text_layer",
+        help="Em PDFs vetoriais, quando a tabela do recorte sai limpa do texto do PDF, "
+             "o Gemini não é chamado. Desligue para sempre usar o Gemini."
+    )
+    _ts = text_layer_stats()
+    if _ts["tried"]:
+        st.caption(
+            f"⚡ Camada de texto: {_ts['used']} chamada(s) ao Gemini evitada(s) "
+            f"em {_ts['tried']} página(s) ({_ts['no_text']} sem texto, {_ts['low_score']} com nota baixa)"
+        )
+
+    # Chamadas por handle do Gemini (contadores + histograma de latência)
+    _ms = [m for m in model_registry.stats() if m["calls"]]
+    if _ms:
+        with st.expander("📈 Chamadas ao Gemini"):
+            for m in _ms:
+                st.caption(f"**{m['model']}**: {m['calls']} chamadas, {m['errors']} erros, média {m['avg_s']}s")
+                if m.get("avg_first_chunk_s") is not None:
+                    st.caption(f"Streaming: primeiro trecho em {m['avg_first_chunk_s']}s (média)")
+                st.bar_chart(pd.Series(m["histogram"], name="chamadas"))
+            _us = upload_stats.get_stats()
+            if _us["uploads"]:
+                _fmts = ", ".join(f"{k}: {v}" for k, v in _us["formats"].items())
+                st.caption(
+                    f"📤 Imagens enviadas: {_us['uploads']}, média {_us['avg_kb']} KB "
+                    f"({_us['ratio']}x menor que os pixels), codificação {_us['avg_encode_ms']} ms — {_fmts}"
+                )
+
+    # Estatísticas do cache de renderização
+    _rs = render_cache_stats()
+    st.caption(
+        f"🗂️ Cache de páginas: {_rs['hits_mem']} hits (memória), "
+        f"{_rs['hits_disk']} hits (disco), {_rs['misses']} misses"
+    )
+    from app.doc_index import doc_index
+    _ds = doc_index.get_stats()
+    if _ds["documents"]:
+        st.caption(f"📌 Documentos conhecidos: {_ds['documents']} ({_ds['hits']} reconhecido(s) nesta sessão)")
+
 # Upload de PDF
 st.header("📄 Upload do PDF")
 
@@ -480,6 +560,28 @@ if uploaded_file is not None:
     else:
         # Atualizar estado
         ui_state.set_pdf_uploaded(pdf_path, pdf_info)
+
+        # Documento já visto? (sha256 dos bytes: cópias renomeadas também são reconhecidas)
+        from app.doc_index import doc_index
+        _upload_key = (uploaded_file.name, uploaded_file.size, getattr(uploaded_file, "file_id", None))
+        if st.session_state.get("doc_lookup_key") != _upload_key:
+            _doc = doc_index.lookup(uploaded_file)
+            st.session_state.doc_lookup_key = _upload_key
+            st.session_state.doc_fingerprint = _doc["fingerprint"]
+            st.session_state.doc_layout = _doc["layout"]
+        _known = doc_index.get(st.session_state.doc_fingerprint)
+        if _known:
+            _pages = _known.get("pages", {})
+            st.info(
+                f"📌 Documento já processado como **{_known['name']}** "
+                f"em {time.strftime('%d/%m/%Y %H:%M', time.localtime(_known['last_seen']))}: "
+                f"{sum(p.get('rows', 0) for p in _pages.values())} linha(s) em {len(_pages)} página(s)"
+                + (f", preset `{_known['preset_id']}`" if _known.get("preset_id") else "")
+            )
+        else:
+            _similar = doc_index.same_layout(st.session_state.doc_layout)
+            if _similar:
+                st.caption(f"📋 Mesmo leiaute de {len(_similar)} documento(s) já processado(s), ex.: {_similar[0]['name']}")
         
         # Exibir informações do PDF
         col1, col2, col3, col4 = st.columns(4)
@@ -519,6 +621,21 @@ if uploaded_file is not None:
             # Listar presets ativos
             active_presets = list_active_presets()
             options = ["Nenhum", "➕ Novo Preset"] + [f"({p['scope']}) {p['name']}" for p in active_presets]
+
+            # Preset automático: uma vez por documento, se o usuário não escolheu outro nem ignorou
+            _fp = st.session_state.get("doc_fingerprint")
+            if (
+                _fp and st.session_state.get("auto_preset_for") != _fp
+                and st.session_state.selected_preset_id in (None, st.session_state.get("auto_preset_id"))
+                and not st.session_state.get("creating_new_preset")
+                and not ui_state.get_ignore_preset()
+            ):
+                st.session_state.auto_preset_for = _fp
+                _auto, _why = auto_preset(uploaded_file, active_presets, name=uploaded_file.name)
+                st.session_state.auto_preset_id = _auto["id"] if _auto else None
+                st.session_state.auto_preset_reason = _why
+                st.session_state.selected_preset_id = st.session_state.auto_preset_id
+                st.session_state.pop("select_manual_preset", None)  # o selectbox volta a seguir selected_preset_id
             
             # Determinar índice selecionado
             selected_idx = 0  # "Nenhum" por padrão
@@ -561,6 +678,8 @@ if uploaded_file is not None:
                 
                 # Exibir informações do preset
                 st.success(f"✅ Preset aplicado: **{selected_preset['name']}** ({selected_preset['scope']})")
+                if selected_preset["id"] == st.session_state.get("auto_preset_id") and st.session_state.get("auto_preset_for") == _fp:
+                    st.caption(f"🤖 Escolhido automaticamente ({st.session_state.auto_preset_reason})")
                 bbox_rel = st.session_state.get("bbox_rel")
                 if _bbox_ready(bbox_rel):
                     st.info(
@@ -583,11 +702,6 @@ if uploaded_file is not None:
                 ui_state.set_current_preset(None)
                 ui_state.set_crop_coords(None)
             
-            # Verificar se há preset aplicável automaticamente (apenas se nenhum foi selecionado manualmente)
-            if not st.session_state.selected_preset_id and not ui_state.get_ignore_preset():
-                # Por enquanto, não implementamos a lógica de preset automático
-                # Pode ser implementada posteriormente se necessário
-                pass
             
             # Exibir imagem
             image_fluid(page_image, caption=f"Página {page_num + 1}")
@@ -779,6 +893,14 @@ if uploaded_file is not None:
                                 key="new_preset_scope"
                             )
                         
+                        preset_pages = st.text_input(
+                            "Páginas no lote",
+                            value="all",
+                            key="new_preset_page_filter",
+                            help="Páginas processadas no lote (0-index): 'all', '0', '0,2-4', 'last' "
+                                 "ou 'text:LISTA DE MATERIAIS'.",
+                        )
+                        
                         if st.button("💾 Salvar Preset", key="btn_save_preset", type="primary"):
                             bbox_rel = st.session_state.get("bbox_rel")
                             if not _bbox_ready(bbox_rel):
@@ -793,8 +915,13 @@ if uploaded_file is not None:
                                     "name": preset_name.strip(),
                                     "scope": preset_scope,
                                     "bbox_rel": bbox_rel,
+                                    "page_filter": preset_pages.strip() or DEFAULT_PAGE_FILTER,
                                     "template_name": st.session_state.get("template_name", ""),
                                     "pdf_name": st.session_state.get("pdf_name", "") if preset_scope == "document" else "",
+                                    # Chaves da escolha automática (app/template_index.py)
+                                    "template_id": template_key(st.session_state.get("template_name")) or None,
+                                    "layout_fingerprint": st.session_state.get("doc_layout") if preset_scope == "template" else None,
+                                    "document_fingerprint": st.session_state.get("doc_fingerprint") if preset_scope == "document" else None,
                                     "active": True,
                                     "created_at": pd.Timestamp.now().isoformat()
                                 }
@@ -877,6 +1004,21 @@ if uploaded_file is not None:
                         
                         from app.pipeline import process_pdf_once
                         
+                        # Linhas aparecem conforme o Gemini responde (streaming)
+                        live_ph = st.empty()
+                        streamed_rows = []
+                        last_draw = [0.0]
+
+                        def _show_rows(rows):
+                            streamed_rows.extend(rows)
+                            now = time.monotonic()
+                            if now - last_draw[0] < 0.5 and len(streamed_rows) > len(rows):
+                                return  # redesenha no máximo 2x/s
+                            last_draw[0] = now
+                            with live_ph.container():
+                                st.caption(f"⏳ {len(streamed_rows)} linha(s) recebida(s)…")
+                                dataframe_fluid(pd.DataFrame(streamed_rows), height=min(400, 120 + 28*len(streamed_rows)))
+
                         result = process_pdf_once(
                             pdf_file=uploaded_file,
                             page_index=st.session_state.get("page_idx", 0),
@@ -884,7 +1026,12 @@ if uploaded_file is not None:
                             api_key=gemini_client.api_key,
                             template_name=st.session_state.get("template_name"),
                             save_artifacts=True,
+                            use_cache=st.session_state.get("use_response_cache", True),
+                            text_layer=st.session_state.get("use_text_layer", True),
+                            on_rows=_show_rows,
                         )
+                        live_ph.empty()
+                        record_preset_use(st.session_state.get("selected_preset_id"))
                         
                         if result["is_empty"]:
                             st.warning("⚠️ Nenhum item encontrado: a lista de materiais está vazia neste PDF/crop.")
@@ -904,6 +1051,34 @@ if uploaded_file is not None:
                             add_rows(st, result["rows"], source_pdf=result["pdf_name"], page_idx=result["page_index"], table_name=result["artifacts"]["table_name"])
                             
                             st.toast(f"Crop salvo em: {crop_path}", icon="✅")
+
+                        if st.session_state.get("doc_fingerprint"):
+                            doc_index.record(
+                                st.session_state.doc_fingerprint, name=result["pdf_name"],
+                                layout=st.session_state.get("doc_layout"),
+                                preset_id=st.session_state.get("selected_preset_id"),
+                                template=st.session_state.get("template_name"),
+                                pages={result["page_index"]: {
+                                    "rows": 0 if result["is_empty"] else len(result["rows"]),
+                                    "source": result["artifacts"]["source"],
+                                    "bbox_rel": bbox_rel,
+                                    "outputs": {k: str(v) for k, v in st.session_state.output_paths.items()},
+                                }},
+                            )
+
+                        _di = result["artifacts"].get("dpi_info")
+                        if result["artifacts"]["source"] == "text_layer":
+                            st.caption(
+                                f"⚡ Tabela lida da camada de texto do PDF, sem chamar o Gemini "
+                                f"(nota {result['payload']['text_layer_score']})"
+                            )
+                        elif _di:
+                            st.caption(
+                                f"🔎 Recorte enviado a {_di['dpi']} DPI"
+                                + (f" (menor texto: {_di['glyph_pt']} pt)" if _di["glyph_pt"] else f" ({_di['source']})")
+                                + (" — limitado pelo orçamento de pixels" if _di["capped"] else "")
+                                + (f", em {len(result['artifacts']['tiles'])} faixas" if result["artifacts"].get("tiles") else "")
+                            )
             
             # Divisor para separar ações dos resultados
             st.divider()
@@ -968,6 +1143,15 @@ if uploaded_file is not None:
                                     mime="text/csv",
                                     key="download_csv"
                                 )
+                        if "parquet" in st.session_state.output_paths:
+                            with open(st.session_state.output_paths["parquet"], 'rb') as f:
+                                st.download_button(
+                                    label="⬇️ Parquet",
+                                    data=f.read(),
+                                    file_name=os.path.basename(st.session_state.output_paths["parquet"]),
+                                    mime="application/vnd.apache.parquet",
+                                    key="download_parquet"
+                                )
 
 # Seção de processamento em lote
 st.divider()
@@ -990,7 +1174,8 @@ with batch_section:
     st.markdown("#### 🎛️ Preset do Lote")
 
     _active = list_active_presets()
-    preset_labels = ["(usar crop atual)"] + [f'{p.get("name","(sem nome)")} ({p.get("scope","global")})' for p in _active]
+    _AUTO_LABEL = "🤖 Automático (por documento)"
+    preset_labels = ["(usar crop atual)", _AUTO_LABEL] + [f'{p.get("name","(sem nome)")} ({p.get("scope","global")})' for p in _active]
 
     # Estado padrão
     st.session_state.setdefault("bbox_rel", None)
@@ -1001,7 +1186,7 @@ with batch_section:
     if st.session_state.get("selected_preset_id"):
         try:
             ids = [p.get("id") for p in _active]
-            idx_default = 1 + ids.index(st.session_state["selected_preset_id"])
+            idx_default = 2 + ids.index(st.session_state["selected_preset_id"])
         except ValueError:
             idx_default = 0
 
@@ -1010,8 +1195,13 @@ with batch_section:
         options=preset_labels, index=idx_default, key="batch_preset_select"
     )
 
-    if sel != "(usar crop atual)":
-        chosen = _active[preset_labels.index(sel) - 1]
+    chosen = None
+    batch_auto = sel == _AUTO_LABEL
+    if batch_auto:
+        st.caption("Cada PDF usa o preset reconhecido pelo documento, leiaute ou modelo; "
+                   "sem reconhecimento, usa o crop atual.")
+    elif sel != "(usar crop atual)":
+        chosen = _active[preset_labels.index(sel) - 2]
         st.session_state["selected_preset_id"] = chosen.get("id")
         st.session_state["bbox_rel"] = chosen.get("bbox_rel")
         # (Opcional) badge
@@ -1021,6 +1211,21 @@ with batch_section:
         if not st.session_state.get("bbox_rel"):
             st.info("Usando o crop atual: delimite o crop acima caso não queira aplicar um preset.")
 
+    # Páginas do lote: vem do page_filter do preset (editável; uma chave por preset)
+    batch_page_filter = st.text_input(
+        "Páginas do lote",
+        value=(chosen or {}).get("page_filter") or DEFAULT_PAGE_FILTER,
+        key=f"batch_page_filter_{(chosen or {}).get('id', 'crop')}",
+        help="0-index: '0', '0,2-4', '3-', 'last', 'all' ou 'text:LISTA DE MATERIAIS' "
+             "(páginas cujo texto contém a palavra).",
+    )
+
+    st.slider(
+        "PDFs em paralelo", min_value=1, max_value=16,
+        value=BATCH_CONCURRENCY, key="batch_concurrency",
+        help="Quantos PDFs são enviados ao Gemini ao mesmo tempo. Use 1 para processar em sequência."
+    )
+
     # Botões de ação
     colb1, colb2, colb3 = st.columns([1,1,1])
     
@@ -1031,45 +1236,158 @@ with batch_section:
             st.button("🧹 Limpar relatório do lote", key="btn_reset_lote", on_click=lambda: agg_reset(st))
     
     with colb2:
-        _can_run_batch = bool(multi_files) and bool(st.session_state.get("bbox_rel"))
+        _can_run_batch = bool(multi_files) and (batch_auto or bool(st.session_state.get("bbox_rel")))
 
-        def run_batch_cascata(files, *, bbox_rel, api_key):
+        def run_batch_cascata(files, *, bbox_rel, api_key, page_filter=DEFAULT_PAGE_FILTER, auto=False):
             if not files:
                 st.warning("Selecione ao menos um PDF.")
                 return
 
             status = st.status("Processando lote…", expanded=True)
             pbar = st.progress(0.0)
-            rep_rows = []   # relatório por arquivo
+            st.subheader("📒 Relatório do Lote (ao vivo)")
+            rep_ph = st.empty()
+            rep_rows = [None] * len(files)   # relatório por arquivo (ordem dos arquivos)
             dfs = []        # dataframes para concatenar
+            # Dataset Parquet particionado por arquivo/tabela, acrescido a cada arquivo concluído
+            from app.save_utils import PartitionedDatasetWriter, write_arrow_file
+            lote_ds = PartitionedDatasetWriter(OUT_DIR / f"lote_{time.strftime('%Y%m%d_%H%M%S')}_dataset")
 
-            total = len(files)
-            for i, f in enumerate(files):
-                fname = getattr(f, "name", f"pdf_{i+1}.pdf")
-                try:
-                    from app.pipeline import process_pdf_once
-                    r = process_pdf_once(
-                        pdf_file=f, page_index=0, bbox_rel=bbox_rel,
-                        api_key=api_key, template_name=st.session_state.get("template_name"),
-                        save_artifacts=True,
-                    )
-                    if r["is_empty"]:
-                        rep_rows.append({"arquivo": fname, "status": "vazio", "linhas": 0, "erro": ""})
-                        st.toast(f"{fname}: tabela vazia.", icon="⚠️")
-                    else:
-                        dfs.append(r["df"].assign(_source_pdf=fname, _page_idx=r["page_index"], _table_name=r["artifacts"]["table_name"]))
-                        rep_rows.append({"arquivo": fname, "status": "ok", "linhas": len(r["df"]), "erro": ""})
-                        st.toast(f"{fname}: {len(r['df'])} linha(s).", icon="✅")
-                except Exception as e:
-                    rep_rows.append({"arquivo": fname, "status": "erro", "linhas": 0, "erro": str(e)})
-                    st.toast(f"{fname}: erro — {e}", icon="❌")
+            # Linhas recebidas em streaming por arquivo (escritas pelas threads, lidas no poll)
+            import threading
+            streamed = {}
+            streamed_lock = threading.Lock()
 
-                pbar.progress((i+1)/total)
+            from app.pipeline import process_pdf_pages
+            from app.batch_executor import run_ordered
 
-            # Tabela de relatório
-            rep_df = pd.DataFrame(rep_rows)
-            st.subheader("📒 Relatório do Lote (ao vivo)")
-            dataframe_fluid(rep_df, height=min(400, 120 + 28*len(rep_df)))
+            total = len(files)
+            template_name = st.session_state.get("template_name")
+            use_cache = st.session_state.get("use_response_cache", True)
+            use_text_layer = st.session_state.get("use_text_layer", True)
+            finished = [0]
+
+            def _fname(i, f):
+                return getattr(f, "name", f"pdf_{i+1}.pdf")
+
+            def _render_report():
+                rows = [r for r in rep_rows if r is not None]
+                if rows:
+                    with rep_ph.container():
+                        dataframe_fluid(pd.DataFrame(rows), height=min(400, 120 + 28*len(rows)))
+
+            # Roda nas threads do executor: nada de st.* aqui
+            # (páginas do mesmo PDF: um handle do documento, Gemini em paralelo)
+            from app.doc_index import doc_index
+            from app.template_index import document_features, get_template_index
+            doc_ids = {}      # id(f) -> fingerprint/leiaute (calculados na thread do worker)
+            auto_chosen = {}  # id(f) -> (preset, motivo) na escolha automática
+            used_pages = {}   # id(f) -> page_filter efetivo (o do preset no modo automático)
+
+            def _work(f):
+                f_bbox, f_pages = bbox_rel, page_filter
+                if not auto:
+                    doc_ids[id(f)] = doc_index.lookup(f)
+                else:
+                    feats = doc_ids[id(f)] = document_features(f, getattr(f, "name", None))
+                    preset, why = get_template_index(_active).match(feats)
+                    auto_chosen[id(f)] = (preset, why)
+                    if preset is not None:
+                        f_bbox, f_pages = preset["bbox_rel"], preset.get("page_filter") or DEFAULT_PAGE_FILTER
+                    elif not f_bbox:
+                        raise ValueError("nenhum preset reconhecido e nenhum crop definido")
+                used_pages[id(f)] = f_pages
+
+                def _on_rows(page_index, rows):
+                    with streamed_lock:
+                        streamed[id(f)] = streamed.get(id(f), 0) + len(rows)
+                return process_pdf_pages(
+                    pdf_file=f, page_filter=f_pages, bbox_rel=f_bbox,
+                    api_key=api_key, template_name=template_name,
+                    save_artifacts=True, use_cache=use_cache, on_rows=_on_rows,
+                    text_layer=use_text_layer,
+                )
+
+            def _on_start(i, f):
+                rep_rows[i] = {"arquivo": _fname(i, f), "status": "processando", "linhas": 0, "erro": ""}
+                _render_report()
+
+            # Linhas que já chegaram (antes da resposta completa do Gemini)
+            def _on_poll():
+                with streamed_lock:
+                    snap = dict(streamed)
+                changed = False
+                for i, f in enumerate(files):
+                    r = rep_rows[i]
+                    n = snap.get(id(f), 0)
+                    if r is not None and r["status"] == "processando" and r["linhas"] != n:
+                        r["linhas"] = n
+                        changed = True
+                if changed:
+                    _render_report()
+
+            # Callbacks na thread do Streamlit (conclusão fora de ordem)
+            def _on_done(i, f, pages, err):
+                fname = _fname(i, f)
+                _auto = auto_chosen.pop(id(f), (None, ""))
+                f_pages = used_pages.pop(id(f), page_filter)
+                if err is None:
+                    n_rows = sum(len(p["result"]["df"]) for p in pages if p["error"] is None)
+                    err = "; ".join(f'pág. {p["item"]}: {p["error"]}' for p in pages if p["error"] is not None)
+                else:
+                    n_rows, err = 0, str(err)
+                if n_rows:
+                    rep_rows[i] = {"arquivo": fname, "status": "ok", "linhas": n_rows, "erro": err}
+                    st.toast(f"{fname}: {n_rows} linha(s).", icon="✅")
+                elif err:
+                    rep_rows[i] = {"arquivo": fname, "status": "erro", "linhas": 0, "erro": err}
+                    st.toast(f"{fname}: erro — {err}", icon="❌")
+                else:
+                    note = "" if pages else f"nenhuma página corresponde a '{f_pages}'"
+                    rep_rows[i] = {"arquivo": fname, "status": "vazio", "linhas": 0, "erro": note}
+                    st.toast(f"{fname}: {note or 'tabela vazia.'}", icon="⚠️")
+                _doc = doc_ids.pop(id(f), None)
+                if auto:
+                    rep_rows[i]["preset"] = f'{_auto[0]["name"]} ({_auto[1]})' if _auto[0] else "(crop atual)"
+                    _preset_id = _auto[0]["id"] if _auto[0] else None
+                else:
+                    _preset_id = st.session_state.get("selected_preset_id")
+                record_preset_use(_preset_id)
+                if _doc is not None and pages:
+                    doc_index.record(
+                        _doc["fingerprint"], name=fname, layout=_doc["layout"],
+                        preset_id=_preset_id, template=template_name, flush=False,
+                        pages={
+                            p["item"]: {"rows": len(p["result"]["df"]), "source": p["result"]["artifacts"]["source"],
+                                        "bbox_rel": _auto[0]["bbox_rel"] if _auto[0] else bbox_rel}
+                            for p in pages if p["error"] is None
+                        },
+                    )
+                finished[0] += 1
+                pbar.progress(finished[0] / total)
+                _render_report()
+
+            # CSV agregado mantém a ordem dos arquivos e das páginas
+            def _on_ordered(i, f, pages, err):
+                if err is not None:
+                    return
+                n_before = len(dfs)
+                for p in pages:
+                    r = p["result"]
+                    if p["error"] is None and not r["is_empty"]:
+                        dfs.append(r["df"].assign(_source_pdf=_fname(i, f), _page_idx=r["page_index"], _table_name=r["artifacts"]["table_name"]))
+                if len(dfs) > n_before:
+                    try:
+                        lote_ds.write(pd.concat(dfs[n_before:], ignore_index=True))
+                    except Exception as e:
+                        print(f"Aviso: dataset Parquet do lote não atualizado ({_fname(i, f)}): {e}")
+
+            run_ordered(
+                files, _work,
+                concurrency=st.session_state.get("batch_concurrency", BATCH_CONCURRENCY),
+                on_start=_on_start, on_done=_on_done, on_ordered=_on_ordered, on_poll=_on_poll,
+            )
+            doc_index.flush()  # índice de documentos: uma gravação por lote
 
             # CSV único agregado
             if dfs:
@@ -1083,6 +1401,17 @@ with batch_section:
                     "⬇️ CSV único (lote)", data=open(out_csv, "rb").read(),
                     file_name=out_csv.name, mime="text/csv", key="dl_lote_csv",
                 )
+                try:
+                    out_parquet = Path(write_arrow_file(big, OUT_DIR / "lote_all_extracted.parquet"))
+                except Exception as e:
+                    st.warning(f"Parquet do lote não gerado (o CSV acima está completo): {e}")
+                else:
+                    st.download_button(
+                        "⬇️ Parquet (lote)", data=out_parquet.read_bytes(),
+                        file_name=out_parquet.name, mime="application/vnd.apache.parquet", key="dl_lote_parquet",
+                    )
+                if lote_ds.rows_written:
+                    st.caption(f"Dataset particionado por arquivo/tabela: {lote_ds.base_dir}")
             else:
                 st.warning("Processo concluído, mas nenhum PDF continha itens na lista de materiais.")
 
@@ -1091,14 +1420,15 @@ with batch_section:
             key="btn_process_batch",
             disabled=not _can_run_batch,
             on_click=lambda: run_batch_cascata(
-                multi_files, bbox_rel=st.session_state["bbox_rel"], api_key=gemini_client.api_key
+                multi_files, bbox_rel=st.session_state["bbox_rel"], api_key=gemini_client.api_key,
+                page_filter=batch_page_filter, auto=batch_auto,
             )
         )
 
     # Mensagens de status
     if not multi_files:
         st.warning("Adicione PDFs para o lote.")
-    elif not st.session_state.get("bbox_rel"):
+    elif not st.session_state.get("bbox_rel") and not batch_auto:
         st.error("Defina um preset (acima) ou delimite o crop para habilitar o lote.")
 
 with agg_section:
@@ -1117,21 +1447,31 @@ with agg_section:
 # Downloads do lote
 if not df_rows.empty or not df_rep.empty:
     st.subheader("📁 Downloads do Lote")
-    col1, col2 = st.columns([1, 1])
+    col1, col2, col3 = st.columns([1, 1, 1])
     
+    # Arquivos regravados/acrescidos só quando o agregado muda; bytes em cache pela versão
+    from app.aggregate import get_export
+    agg_export = get_export(st, OUT_DIR)
+
     with col1:
         if not df_rows.empty:
-            from app.aggregate import save_csv_rows
-            path_rows = save_csv_rows(st, OUT_DIR)
-            st.download_button("⬇️ CSV único (lote)", data=open(path_rows, "rb").read(),
-                               file_name=path_rows.name, mime="text/csv", key="dl_csv_lote")
+            st.download_button("⬇️ CSV único (lote)", data=agg_export.rows_bytes(),
+                               file_name=agg_export.rows_path.name, mime="text/csv", key="dl_csv_lote")
 
     with col2:
         if not df_rep.empty:
-            from app.aggregate import save_csv_report
-            path_rep = save_csv_report(st, OUT_DIR)
-            st.download_button("⬇️ Relatório do lote (CSV)", data=open(path_rep, "rb").read(),
-                               file_name=path_rep.name, mime="text/csv", key="dl_rep_lote")
+            st.download_button("⬇️ Relatório do lote (CSV)", data=agg_export.report_bytes(),
+                               file_name=agg_export.report_path.name, mime="text/csv", key="dl_rep_lote")
+
+    with col3:
+        if not df_rows.empty:
+            # Tipos preservados; row groups alinhados a arquivo/tabela. Dataset particionado em out/ para o takeoff
+            from app.save_utils import ARROW_FORMATS
+            agg_export.sync_dataset()
+            for _fmt, _label in (("parquet", "⬇️ Parquet (lote)"), ("arrow", "⬇️ Arrow IPC (lote)")):
+                _ext, _mime, _ = ARROW_FORMATS[_fmt]
+                st.download_button(_label, data=agg_export.arrow_bytes(_fmt),
+                                   file_name=agg_export.stem + _ext, mime=_mime, key=f"dl_{_fmt}_lote")
 
 # Limpeza de arquivos temporários
 def cleanup_temp_files():
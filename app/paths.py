@@ -4,7 +4,8 @@ BASE_DIR = Path(__file__).resolve().parents[1]
 CONFIG_DIR = BASE_DIR / "config"
 OUT_DIR = BASE_DIR / "out"
 CROPS_DIR = BASE_DIR / "Crop"  # solicitado pelo usuário
+CACHE_DIR = BASE_DIR / "cache"  # caches persistentes (renderizações, respostas)
 
 def ensure_dirs():
-    for d in (CONFIG_DIR, OUT_DIR, CROPS_DIR):
+    for d in (CONFIG_DIR, OUT_DIR, CROPS_DIR, CACHE_DIR):
         d.mkdir(parents=True, exist_ok=True)
@@ -2,13 +2,25 @@
 Utilitários para manipulação de PDFs
 """
 import os
+import math
+import mmap
 import hashlib
-from typing import List, Dict, Optional, Tuple
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, List, Dict, Optional, Tuple
 from pathlib import Path
 import pdfplumber
 from PIL import Image, ImageDraw
 import io
 
+from app.cache_utils import trim_disk_lru
+from app.paths import CACHE_DIR
+from app.settings import (
+    RENDER_CACHE_MEM_MB, RENDER_CACHE_DISK_MB, PROCESS_DPI, DETECT_TABLES_WORKERS,
+    ADAPTIVE_DPI, DPI_TARGET_GLYPH_PX, DPI_MIN, DPI_MAX, DPI_MAX_MEGAPIXELS,
+)
+
 class PDFUtils:
     def __init__(self):
         pass
@@ -42,14 +54,10 @@ class PDFUtils:
     def page_to_image(self, pdf_path: str, page_num: int, dpi: int = 400) -> Optional[Image.Image]:
         """Converte uma página do PDF para imagem PIL"""
         try:
-            with pdfplumber.open(pdf_path) as pdf:
-                if page_num >= len(pdf.pages):
-                    return None
-                
-                page = pdf.pages[page_num]
-                # Converter para imagem
-                img = page.to_image(resolution=dpi)
-                return img.original
+            # Passa pelo cache de renderização (evita re-rasterizar a cada rerun)
+            return render_pdf_page(pdf_path, page_num, dpi=dpi)
+        except IndexError:
+            return None
         except Exception as e:
             print(f"Erro ao converter página para imagem: {e}")
             return None
@@ -75,126 +83,868 @@ class PDFUtils:
             return False
     
     def detect_tables(self, pdf_path: str, page_num: int) -> List[Dict]:
-        """Detecta tabelas em uma página do PDF usando pdfplumber"""
+        """Detecta tabelas em uma página do PDF usando pdfplumber (em cache por documento/página)"""
         try:
-            with pdfplumber.open(pdf_path) as pdf:
-                if page_num >= len(pdf.pages):
-                    return []
-                
-                page = pdf.pages[page_num]
-                
-                # Detectar tabelas com diferentes configurações
-                tables = []
-                
-                # Tabelas com linhas
-                tables.extend(page.find_tables(table_settings={
-                    "vertical_strategy": "lines",
-                    "horizontal_strategy": "lines"
-                }))
-                
-                # Tabelas lattice
-                tables.extend(page.find_tables(table_settings={
-                    "vertical_strategy": "lines",
-                    "horizontal_strategy": "lines",
-                    "intersection_tolerance": 10
-                }))
-                
-                # Tabelas text
-                tables.extend(page.find_tables(table_settings={
-                    "vertical_strategy": "text",
-                    "horizontal_strategy": "text"
-                }))
-                
-                # Converter para formato padronizado
-                result = []
-                for i, table in enumerate(tables):
-                    bbox = table.bbox
-                    result.append({
-                        "id": i,
-                        "bbox": {
-                            "x0": bbox[0],
-                            "y0": bbox[1],
-                            "x1": bbox[2],
-                            "y1": bbox[3]
-                        },
-                        "rows": len(table.extract()),
-                        "confidence": 0.8  # Placeholder
-                    })
-                
-                return result
-                
+            return detect_tables_cached(pdf_path, page_num)
         except Exception as e:
             print(f"Erro ao detectar tabelas: {e}")
             return []
+
+    def detect_tables_all(self, pdf_path: str, pages: Optional[List[int]] = None) -> Dict[int, List[Dict]]:
+        """Detecta tabelas em várias páginas (todas, se pages=None) num pool de processos"""
+        try:
+            return detect_tables_pages(pdf_path, pages)
+        except Exception as e:
+            print(f"Erro ao detectar tabelas: {e}")
+            return {}
     
     def get_document_fingerprint(self, pdf_path: str) -> str:
-        """Gera um fingerprint único para o documento"""
+        """Fingerprint do documento: sha256 dos bytes (cópias renomeadas têm o mesmo valor)"""
         try:
-            # Usar nome do arquivo + tamanho + primeira página como fingerprint
-            file_name = os.path.basename(pdf_path)
-            file_size = os.path.getsize(pdf_path)
-            
-            with pdfplumber.open(pdf_path) as pdf:
-                if len(pdf.pages) > 0:
-                    first_page_text = pdf.pages[0].extract_text()[:1000]  # Primeiros 1000 chars
-                else:
-                    first_page_text = ""
-            
-            # Criar hash
-            content = f"{file_name}_{file_size}_{first_page_text}"
-            return hashlib.md5(content.encode()).hexdigest()
-            
+            return pdf_content_hash(pdf_path)
         except Exception as e:
             print(f"Erro ao gerar fingerprint: {e}")
-            return hashlib.md5(pdf_path.encode()).hexdigest()
+            return hashlib.sha256(str(pdf_path).encode()).hexdigest()
+
+    def get_layout_fingerprint(self, pdf_path: str) -> Optional[str]:
+        """Fingerprint do leiaute da 1ª página (mesmo modelo de prancha -> mesmo valor)"""
+        try:
+            return layout_fingerprint(pdf_path)
+        except Exception as e:
+            print(f"Erro ao gerar fingerprint de leiaute: {e}")
+            return None
     
     def get_template_id(self, pdf_path: str) -> Optional[str]:
-        """Tenta identificar o template do PDF (implementação básica)"""
+        """Tenta identificar o template do PDF pelo texto da 1ª página (padrões pré-compilados)"""
+        from app.template_index import match_template_id
         try:
-            with pdfplumber.open(pdf_path) as pdf:
-                if len(pdf.pages) > 0:
-                    text = pdf.pages[0].extract_text()
-                    
-                    # Procurar por padrões que indiquem template
-                    patterns = [
-                        r"modelo\s*[:.]?\s*([a-zA-Z0-9\s]+)",
-                        r"template\s*[:.]?\s*([a-zA-Z0-9\s]+)",
-                        r"formulário\s*[:.]?\s*([a-zA-Z0-9\s]+)",
-                        r"vale\s*v(\d+)",
-                        r"versão\s*[:.]?\s*([a-zA-Z0-9\s]+)"
-                    ]
-                    
-                    for pattern in patterns:
-                        import re
-                        match = re.search(pattern, text, re.IGNORECASE)
-                        if match:
-                            return match.group(1).strip()
-            
-            return None
-            
+            return match_template_id(first_page_features(pdf_path)["text"])
         except Exception as e:
             print(f"Erro ao identificar template: {e}")
             return None
 
+# ---------------------------------------------------------------------------
+# Detecção de tabelas: uma passada por página. As bordas são mescladas uma vez
+# e servem às duas variantes por linhas (tolerância de interseção 3 e 10);
+# bboxes duplicadas entre estratégias caem por IoU e as linhas são contadas
+# pela geometria das células (sem extrair texto). Cache por (sha256, página).
+# ---------------------------------------------------------------------------
+
+_LINE_STRATEGIES = (("lines", 3, 0.9), ("lattice", 10, 0.8))  # (nome, tolerância de interseção, confiança)
+_TEXT_CONFIDENCE = 0.6
+_IOU_DUPLICATE = 0.5
+_DETECT_CACHE_MAX = 256
+
+_detect_cache: "OrderedDict[Tuple[str, int], List[Dict]]" = OrderedDict()
+_detect_lock = threading.Lock()
+
+def _bbox_iou(a, b) -> float:
+    ix = min(a[2], b[2]) - max(a[0], b[0])
+    iy = min(a[3], b[3]) - max(a[1], b[1])
+    if ix <= 0 or iy <= 0:
+        return 0.0
+    inter = ix * iy
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+# _finder_edges/_tables_from_edges usam internos do pdfplumber (TableFinder sem
+# __init__, get_edges, edges_to_intersections, cells_to_tables), conferidos na
+# versão fixada em requirements.txt (0.10.3) e na 0.11. Se faltarem ou mudarem
+# de assinatura, _detect_tables_on passa para page.find_tables (API pública,
+# mesmas estratégias e tolerâncias; calcula as bordas a cada chamada).
+_FAST_DETECT = True
+
+def _finder_edges(page, settings: Dict[str, Any]):
+    """Bordas mescladas (snap/join) do TableFinder do pdfplumber, sem o cálculo de células dele."""
+    from pdfplumber.table import TableFinder, TableSettings
+    finder = TableFinder.__new__(TableFinder)
+    finder.page, finder.settings = page, TableSettings.resolve(settings)
+    return finder.get_edges(), finder.settings
+
+def _intersections_to_cells(intersections) -> List[Tuple[float, float, float, float]]:
+    """
+    Mesmo resultado de pdfplumber.table.intersections_to_cells, sem a varredura
+    quadrática: pontos indexados por coluna/linha e bordas de cada ponto em sets.
+    """
+    from pdfplumber.utils import obj_to_bbox
+    v_sets = {p: set(map(obj_to_bbox, e["v"])) for p, e in intersections.items()}
+    h_sets = {p: set(map(obj_to_bbox, e["h"])) for p, e in intersections.items()}
+
+    def connects(p1, p2) -> bool:
+        if p1[0] == p2[0] and not v_sets[p1].isdisjoint(v_sets[p2]):
+            return True
+        return p1[1] == p2[1] and not h_sets[p1].isdisjoint(h_sets[p2])
+
+    points = sorted(intersections)
+    by_x: Dict[float, List] = {}
+    by_y: Dict[float, List] = {}
+    for p in points:  # ordem (x, y): colunas saem ordenadas por y, linhas por x
+        by_x.setdefault(p[0], []).append(p)
+        by_y.setdefault(p[1], []).append(p)
+
+    cells = []
+    for pt in points:
+        col, row = by_x[pt[0]], by_y[pt[1]]
+        below = col[col.index(pt) + 1:]
+        right = row[row.index(pt) + 1:]
+        found = None
+        for below_pt in below:
+            if not connects(pt, below_pt):
+                continue
+            for right_pt in right:
+                if not connects(pt, right_pt):
+                    continue
+                corner = (right_pt[0], below_pt[1])
+                if corner in intersections and connects(corner, right_pt) and connects(corner, below_pt):
+                    found = (pt[0], pt[1], corner[0], corner[1])
+                    break
+            if found:
+                break
+        if found:
+            cells.append(found)
+    return cells
+
+def _tables_from_edges(page, edges, tol: float):
+    from pdfplumber.table import Table, cells_to_tables, edges_to_intersections
+    cells = _intersections_to_cells(edges_to_intersections(edges, tol, tol))
+    return [Table(page, group) for group in cells_to_tables(cells)]
+
+def _found_tables_fast(page) -> List[Tuple]:
+    found = []  # (confiança, estratégia, bbox, nº de linhas)
+    edges, _ = _finder_edges(page, {"vertical_strategy": "lines", "horizontal_strategy": "lines"})
+    for name, tol, conf in _LINE_STRATEGIES:
+        found.extend((conf, name, t.bbox, len(t.rows)) for t in _tables_from_edges(page, edges, tol))
+    edges, settings = _finder_edges(page, {"vertical_strategy": "text", "horizontal_strategy": "text"})
+    found.extend(
+        (_TEXT_CONFIDENCE, "text", t.bbox, len(t.rows))
+        for t in _tables_from_edges(page, edges, settings.intersection_x_tolerance)
+    )
+    return found
+
+def _found_tables_public(page) -> List[Tuple]:
+    found = []
+    for name, tol, conf in _LINE_STRATEGIES:
+        settings = {"vertical_strategy": "lines", "horizontal_strategy": "lines", "intersection_tolerance": tol}
+        found.extend((conf, name, t.bbox, len(t.rows)) for t in page.find_tables(settings))
+    found.extend(
+        (_TEXT_CONFIDENCE, "text", t.bbox, len(t.rows))
+        for t in page.find_tables({"vertical_strategy": "text", "horizontal_strategy": "text"})
+    )
+    return found
+
+def _detect_tables_on(page) -> List[Dict]:
+    global _FAST_DETECT
+    found = None
+    if _FAST_DETECT:
+        try:
+            found = _found_tables_fast(page)
+        except (ImportError, AttributeError, TypeError, KeyError) as e:
+            _FAST_DETECT = False
+            print(f"Aviso: internos do pdfplumber mudaram ({e}); detecção de tabelas via page.find_tables")
+    if found is None:
+        found = _found_tables_public(page)
+
+    kept = []
+    for item in sorted(found, key=lambda f: -f[0]):
+        if all(_bbox_iou(item[2], k[2]) < _IOU_DUPLICATE for k in kept):
+            kept.append(item)
+    return [
+        {
+            "id": i,
+            "bbox": {"x0": bbox[0], "y0": bbox[1], "x1": bbox[2], "y1": bbox[3]},
+            "rows": n_rows,
+            "confidence": conf,
+            "strategy": name,
+        }
+        for i, (conf, name, bbox, n_rows) in enumerate(kept)
+    ]
+
+def _pickable_pdf(pdf_ref):
+    """Caminho ou bytes (vai para outro processo)."""
+    if isinstance(pdf_ref, (str, os.PathLike)):
+        return os.fspath(pdf_ref)
+    if isinstance(pdf_ref, (bytes, bytearray)):
+        return bytes(pdf_ref)
+    if hasattr(pdf_ref, "getvalue"):
+        return pdf_ref.getvalue()
+    pdf_ref.seek(0)
+    return pdf_ref.read()
+
+def _detect_tables_job(pdf_src, pages: List[int]) -> Dict[int, List[Dict]]:
+    """Tarefa do pool: abre o PDF uma vez e detecta as tabelas das páginas pedidas."""
+    if isinstance(pdf_src, bytes):
+        pdf_src = io.BytesIO(pdf_src)
+    out = {}
+    with pdfplumber.open(pdf_src) as pdf:
+        for i in pages:
+            if not 0 <= i < len(pdf.pages):
+                out[i] = []
+                continue
+            page = pdf.pages[i]
+            out[i] = _detect_tables_on(page)
+            page.close()
+    return out
+
+def _detect_cache_get(key) -> Optional[List[Dict]]:
+    with _detect_lock:
+        hit = _detect_cache.get(key)
+        if hit is not None:
+            _detect_cache.move_to_end(key)
+        return hit
+
+def _detect_cache_put(key, tables: List[Dict]) -> None:
+    with _detect_lock:
+        _detect_cache[key] = tables
+        _detect_cache.move_to_end(key)
+        while len(_detect_cache) > _DETECT_CACHE_MAX:
+            _detect_cache.popitem(last=False)
+
+def _copy_tables(tables: List[Dict]) -> List[Dict]:
+    return [dict(t, bbox=dict(t["bbox"])) for t in tables]
+
+def detect_tables_cached(pdf_ref, page_num: int) -> List[Dict]:
+    """Tabelas de uma página: [{"id", "bbox", "rows", "confidence", "strategy"}] (bbox em pontos)."""
+    return detect_tables_pages(pdf_ref, [page_num], workers=1)[page_num]
+
+def detect_tables_pages(pdf_ref, pages: Optional[List[int]] = None, *,
+                        workers: int = DETECT_TABLES_WORKERS) -> Dict[int, List[Dict]]:
+    """
+    Tabelas de várias páginas (todas, se pages=None): {página: [...]}.
+    As páginas fora do cache são repartidas entre `workers` processos.
+    """
+    doc_hash = pdf_content_hash(pdf_ref)
+    if pages is None:
+        pages = list(range(page_count(pdf_ref)))
+    out: Dict[int, List[Dict]] = {}
+    todo = []
+    for i in pages:
+        hit = _detect_cache_get((doc_hash, int(i)))
+        if hit is None:
+            todo.append(int(i))
+        else:
+            out[i] = hit
+
+    if todo:
+        src = _pickable_pdf(pdf_ref)
+        workers = max(1, min(int(workers or 1), len(todo)))
+        if workers == 1:
+            results = [_detect_tables_job(src, todo)]
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            chunks = [todo[k::workers] for k in range(workers)]
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(_detect_tables_job, [src] * workers, chunks))
+        for result in results:
+            for i, tables in result.items():
+                _detect_cache_put((doc_hash, i), tables)
+                out[i] = tables
+    return {i: _copy_tables(out[i]) for i in pages}
+
 # Funções utilitárias para renderização consistente
+RENDERER_ID = "pdfplumber"  # entra na chave do cache: trocar o backend invalida as entradas
+
 def page_to_image(page, dpi: int) -> Image.Image:
     """Renderiza a página para PIL.Image no dpi especificado (usa pdfplumber backend)."""
     return page.to_image(resolution=dpi).original
 
+# ---------------------------------------------------------------------------
+# Cache de renderização: chave = (sha256 do PDF, página, dpi, renderer)
+# Camada 1: LRU em memória limitado por bytes; camada 2: PNGs em cache/render
+# com remoção dos arquivos menos usados quando o diretório passa do limite.
+# ---------------------------------------------------------------------------
+
+_hash_memo: Dict[Tuple[str, int, int], str] = {}  # (path, mtime_ns, size) -> sha256
+
+def _sha256_file(path: str, size: int) -> str:
+    """sha256 via mmap (sem copiar o arquivo para a memória do Python); blocos de 1 MB se o mmap falhar."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        if size:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    h.update(mm)
+                return h.hexdigest()
+            except (OSError, ValueError):
+                f.seek(0)
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def pdf_content_hash(pdf_ref) -> str:
+    """sha256 dos bytes do PDF (caminho, bytes ou file-like como UploadedFile)."""
+    if isinstance(pdf_ref, (bytes, bytearray)):
+        return hashlib.sha256(pdf_ref).hexdigest()
+    if isinstance(pdf_ref, (str, os.PathLike)):
+        path = os.fspath(pdf_ref)
+        st_ = os.stat(path)
+        memo_key = (os.path.abspath(path), st_.st_mtime_ns, st_.st_size)
+        cached = _hash_memo.get(memo_key)
+        if cached:
+            return cached
+        _hash_memo[memo_key] = _sha256_file(path, st_.st_size)
+        return _hash_memo[memo_key]
+    if hasattr(pdf_ref, "getvalue"):  # UploadedFile / BytesIO
+        return hashlib.sha256(pdf_ref.getvalue()).hexdigest()
+    if hasattr(pdf_ref, "read"):  # file-like genérico: lê e volta o cursor
+        pos = pdf_ref.tell()
+        pdf_ref.seek(0)
+        h = hashlib.sha256()
+        for chunk in iter(lambda: pdf_ref.read(1024 * 1024), b""):
+            h.update(chunk)
+        pdf_ref.seek(pos)
+        return h.hexdigest()
+    raise TypeError(f"Referência de PDF não suportada: {type(pdf_ref)}")
+
+def _image_nbytes(img: Image.Image) -> int:
+    return img.width * img.height * len(img.getbands())
+
+class RenderCache:
+    """LRU em memória + camada em disco para páginas renderizadas."""
+
+    def __init__(self, cache_dir: Path, mem_limit_mb: int, disk_limit_mb: int):
+        self.cache_dir = Path(cache_dir)
+        self.mem_limit = int(mem_limit_mb) * 1024 * 1024
+        self.disk_limit = int(disk_limit_mb) * 1024 * 1024
+        self._mem: "OrderedDict[Tuple, Image.Image]" = OrderedDict()
+        self._mem_bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits_mem": 0, "hits_disk": 0, "misses": 0}
+
+    def _disk_path(self, key: Tuple) -> Path:
+        doc_hash, page_index, dpi, renderer = key
+        return self.cache_dir / f"{doc_hash[:40]}_p{page_index}_{dpi}dpi_{renderer}.png"
+
+    def _remember(self, key: Tuple, img: Image.Image) -> None:
+        size = _image_nbytes(img)
+        if size > self.mem_limit:
+            return  # maior que o LRU inteiro: fica só no disco
+        with self._lock:
+            if key in self._mem:
+                self._mem.move_to_end(key)
+                return
+            self._mem[key] = img
+            self._mem_bytes += size
+            while self._mem_bytes > self.mem_limit and self._mem:
+                _, old = self._mem.popitem(last=False)
+                self._mem_bytes -= _image_nbytes(old)
+
+    def peek(self, key: Tuple) -> Optional[Image.Image]:
+        """Consulta só a memória, sem afetar contadores nem a ordem do LRU."""
+        with self._lock:
+            return self._mem.get(key)
+
+    def get(self, key: Tuple) -> Optional[Image.Image]:
+        with self._lock:
+            img = self._mem.get(key)
+            if img is not None:
+                self._mem.move_to_end(key)
+                self.stats["hits_mem"] += 1
+                return img
+        path = self._disk_path(key)
+        if path.exists():
+            try:
+                with Image.open(path) as im:
+                    img = im.copy()
+                os.utime(path)  # marca uso recente para a remoção por LRU
+            except Exception:
+                img = None
+            if img is not None:
+                with self._lock:
+                    self.stats["hits_disk"] += 1
+                self._remember(key, img)
+                return img
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, key: Tuple, img: Image.Image) -> None:
+        self._remember(key, img)
+        if self.disk_limit <= 0:
+            return
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            path = self._disk_path(key)
+            tmp = path.with_suffix(f".{threading.get_ident()}.tmp")
+            img.save(tmp, format="PNG", compress_level=1)
+            os.replace(tmp, path)
+            self._evict_disk()
+        except Exception as e:
+            print(f"Aviso: não foi possível gravar cache de renderização: {e}")
+
+    def _evict_disk(self) -> None:
+        trim_disk_lru(self.cache_dir, ".png", self.disk_limit)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._mem.clear()
+            self._mem_bytes = 0
+
+_render_cache = RenderCache(CACHE_DIR / "render", RENDER_CACHE_MEM_MB, RENDER_CACHE_DISK_MB)
+
+def render_cache_stats() -> Dict[str, int]:
+    """Contadores de hit/miss do cache de renderização."""
+    with _render_cache._lock:
+        stats = dict(_render_cache.stats)
+        stats["mem_items"] = len(_render_cache._mem)
+        stats["mem_mb"] = _render_cache._mem_bytes // (1024 * 1024)
+    return stats
+
+def render_page_cached(pdf_ref, page_index: int, dpi: int) -> Image.Image:
+    """
+    Renderiza (ou recupera do cache) a página no dpi pedido.
+    A imagem devolvida é compartilhada pelo cache: não a modifique in-place.
+    """
+    key = (pdf_content_hash(pdf_ref), int(page_index), int(dpi), RENDERER_ID)
+    img = _render_cache.get(key)
+    if img is not None:
+        return img
+    if isinstance(pdf_ref, (bytes, bytearray)):
+        pdf_ref = io.BytesIO(pdf_ref)
+    if hasattr(pdf_ref, "seek"):
+        pdf_ref.seek(0)
+    with _PDFIUM_LOCK, pdfplumber.open(pdf_ref) as pdf:  # page.to_image rasteriza via pdfium
+        page = pdf.pages[page_index]
+        img = page_to_image(page, dpi)
+    img.load()
+    _render_cache.put(key, img)
+    return img
+
+def render_crop_job(pdf_src, page_index: int, bbox_rel: Dict[str, float], dpi: Optional[int],
+                    base_name: str, save_artifact: bool) -> Tuple[Image.Image, Optional[str], Dict[str, Any]]:
+    """
+    Tarefa de render+crop para o process pool do pipeline em estágios.
+    pdf_src deve ser picklável (caminho ou bytes). dpi=None -> adaptativo (choose_dpi).
+    Devolve (crop, caminho salvo, dpi_info).
+    """
+    dpi_info = choose_dpi(pdf_src, page_index, bbox_rel, dpi)
+    crop = render_region(pdf_src, page_index, bbox_rel, dpi_info["dpi"])
+    crop_path = None
+    if save_artifact:
+        from app.save_utils import save_region_crop
+        crop_path = str(save_region_crop(crop, base_name, page_index, dpi=dpi_info["dpi"]))
+    return crop, crop_path, dpi_info
+
 def render_page_pair(pdf_path, page_index: int, dpi_hd: int, preview_max_w: int = 1200):
     """Abre PDF, renderiza a página em alta (HD) e cria um preview proporcional."""
-    with pdfplumber.open(pdf_path) as pdf:
-        page = pdf.pages[page_index]
-        img_hd = page_to_image(page, dpi_hd)
+    img_hd = render_page_cached(pdf_path, page_index, dpi_hd)
     img_prev = img_hd.copy()
     img_prev.thumbnail((preview_max_w, int(preview_max_w * 10000)), Image.LANCZOS)
     return img_hd, img_prev
 
 def render_pdf_page(pdf_path, page_index: int, dpi: int = 400) -> Image.Image:
     """Renderiza uma página específica do PDF em DPI especificado."""
-    with pdfplumber.open(pdf_path) as pdf:
-        page = pdf.pages[page_index]
-        return page_to_image(page, dpi)
+    return render_page_cached(pdf_path, page_index, dpi)
+
+# pdfium não é thread-safe, nem entre documentos diferentes: abrir, ler páginas/texto,
+# rasterizar e fechar acontecem sempre sob esta trava (reentrante: as funções se chamam).
+# Render em paralelo só entre processos (pipeline em estágios).
+_PDFIUM_LOCK = threading.RLock()
+
+def _open_pdfium(pdf_ref):
+    """Abre o PDF no pypdfium2 a partir de caminho, bytes ou file-like (chamar com _PDFIUM_LOCK)."""
+    import pypdfium2
+    if isinstance(pdf_ref, (str, os.PathLike)):
+        return pypdfium2.PdfDocument(os.fspath(pdf_ref))
+    if isinstance(pdf_ref, (bytes, bytearray)):
+        return pypdfium2.PdfDocument(bytes(pdf_ref))
+    if hasattr(pdf_ref, "getvalue"):
+        return pypdfium2.PdfDocument(pdf_ref.getvalue())
+    pdf_ref.seek(0)
+    return pypdfium2.PdfDocument(pdf_ref.read())
+
+_CLIP_MARGIN_PX = 8
+
+_LAYOUT_GRID = 64        # posições dos traços quantizadas em 1/64 da página
+_LAYOUT_MIN_SPAN = 0.2   # só traços/retângulos com >= 20% da largura ou altura
+
+def _layout_fingerprint_on(pdf) -> str:
+    import pypdfium2.raw as pdfium_c
+    if len(pdf) == 0:
+        return hashlib.sha1(b"vazio").hexdigest()
+    page = pdf[0]
+    try:
+        left, bottom, right, top = page.get_bbox()
+        w, h = max(right - left, 1.0), max(top - bottom, 1.0)
+        marks = set()
+        for obj in page.get_objects(filter=[pdfium_c.FPDF_PAGEOBJ_PATH]):
+            # get_pos (pypdfium2 4.x) virou get_bounds na 5.x
+            x0, y0, x1, y1 = (obj.get_bounds if hasattr(obj, "get_bounds") else obj.get_pos)()
+            if (x1 - x0) < _LAYOUT_MIN_SPAN * w and (y1 - y0) < _LAYOUT_MIN_SPAN * h:
+                continue
+            marks.add(tuple(
+                round(v * _LAYOUT_GRID)
+                for v in ((x0 - left) / w, (y0 - bottom) / h, (x1 - left) / w, (y1 - bottom) / h)
+            ))
+        head = f"{round(w)}x{round(h)}:{page.get_rotation()}"
+    finally:
+        page.close()
+    return hashlib.sha1(f"{head}|{sorted(marks)}".encode()).hexdigest()
+
+def layout_fingerprint(pdf_ref) -> str:
+    """
+    Fingerprint barato do leiaute da 1ª página: tamanho, rotação e posições
+    quantizadas dos traços longos (moldura, carimbo, grade da tabela). Pranchas
+    do mesmo modelo com conteúdo diferente dão o mesmo valor. Não lê o texto.
+    """
+    with _PDFIUM_LOCK:  # chamado nos workers do lote (doc_index.lookup)
+        pdf = _open_pdfium(pdf_ref)
+        try:
+            return _layout_fingerprint_on(pdf)
+        finally:
+            pdf.close()
+
+def _page_text_on(pdf, page_index: int) -> str:
+    textpage = pdf[page_index].get_textpage()
+    try:
+        return textpage.get_text_range()
+    finally:
+        textpage.close()
+
+def first_page_features(pdf_ref) -> Dict[str, Any]:
+    """
+    Texto e fingerprint de leiaute da 1ª página com um único handle do documento,
+    além do sha256 dos bytes: {"fingerprint", "layout", "text"}.
+    """
+    fingerprint = pdf_content_hash(pdf_ref)
+    with _PDFIUM_LOCK:  # chamado nos workers do lote (escolha automática de preset)
+        pdf = _open_pdfium(pdf_ref)
+        try:
+            text = _page_text_on(pdf, 0) if len(pdf) else ""
+            return {"fingerprint": fingerprint, "layout": _layout_fingerprint_on(pdf), "text": text}
+        finally:
+            pdf.close()
+
+def page_count(pdf_ref) -> int:
+    """Número de páginas (pypdfium2, sem parse do conteúdo)."""
+    with _PDFIUM_LOCK:
+        pdf = _open_pdfium(pdf_ref)
+        try:
+            return len(pdf)
+        finally:
+            pdf.close()
+
+# ---------------------------------------------------------------------------
+# DPI adaptativo: o menor texto dentro da bbox deve ter ~DPI_TARGET_GLYPH_PX de
+# altura; o recorte não passa de DPI_MAX_MEGAPIXELS. Sem camada de texto
+# (escaneado) vale PROCESS_DPI.
+# ---------------------------------------------------------------------------
+
+_MIN_GLYPH_PT = 2.5  # texto menor que isso é ruído (marcas, texto oculto) e não dita o DPI
+_DPI_STEP = 10       # DPI em degraus: páginas parecidas reaproveitam o cache de render
+
+def _rel_to_page_rect(page, bbox_rel) -> Tuple[float, float, float, float]:
+    """bbox_rel (frações da página renderizada, já girada) -> retângulo em pontos no espaço da página."""
+    l, b, r, t = page.get_bbox()
+    w, h = r - l, t - b
+    rot = page.get_rotation() % 360
+
+    def to_page(fx, fy):
+        if rot == 90:
+            return l + fy * w, b + fx * h
+        if rot == 180:
+            return r - fx * w, b + fy * h
+        if rot == 270:
+            return r - fy * w, t - fx * h
+        return l + fx * w, t - fy * h
+
+    ax, ay = to_page(bbox_rel["x0"], bbox_rel["y0"])
+    bx, by = to_page(bbox_rel["x1"], bbox_rel["y1"])
+    return min(ax, bx), min(ay, by), max(ax, bx), max(ay, by)
+
+def _smallest_glyph_pt(page, rect) -> Optional[float]:
+    """
+    Altura (pt) do menor texto dentro de rect: percentil 5 das caixas "loose"
+    (ascendente + descendente, independe do glifo) dos caracteres visíveis.
+    None se não há texto na região.
+    """
+    import pypdfium2.raw as pdfium_c
+    x0, y0, x1, y1 = rect
+    textpage = page.get_textpage()
+    try:
+        sizes = []
+        for i in range(textpage.count_chars()):
+            l, b, r, t = textpage.get_charbox(i, loose=True)
+            cx, cy = (l + r) / 2, (b + t) / 2
+            if not (x0 <= cx <= x1 and y0 <= cy <= y1):
+                continue
+            code = pdfium_c.FPDFText_GetUnicode(textpage.raw, i)
+            if code <= 32 or chr(code).isspace() or pdfium_c.FPDFText_IsGenerated(textpage.raw, i) == 1:
+                continue
+            # texto girado (cotas verticais): a altura do glifo é a largura da caixa
+            angle = max(0.0, pdfium_c.FPDFText_GetCharAngle(textpage.raw, i))
+            size = (t - b) if abs(math.sin(angle)) < 0.7 else (r - l)
+            if size >= _MIN_GLYPH_PT:
+                sizes.append(size)
+    finally:
+        textpage.close()
+    if not sizes:
+        return None
+    sizes.sort()
+    return sizes[len(sizes) // 20]
+
+def _fixed_dpi(dpi: int) -> Dict[str, Any]:
+    return {"dpi": int(dpi), "source": "fixo", "glyph_pt": None, "capped": False}
+
+def _choose_dpi_on(pdf, page_index: int, bbox_rel, *, full_page: bool = False) -> Dict[str, Any]:
+    page = pdf[page_index]
+    rect = _rel_to_page_rect(page, bbox_rel)
+    glyph = _smallest_glyph_pt(page, rect)
+    if glyph is None:
+        dpi, source = PROCESS_DPI, "padrão"
+    else:
+        dpi, source = DPI_TARGET_GLYPH_PX * 72 / glyph, "texto"
+        dpi = min(DPI_MAX, max(DPI_MIN, math.ceil(dpi / _DPI_STEP) * _DPI_STEP))
+
+    # Orçamento de pixels sobre o que será rasterizado (a página inteira sem clip)
+    if full_page:
+        area = page.get_width() * page.get_height()
+    else:
+        area = (rect[2] - rect[0]) * (rect[3] - rect[1])
+    capped = False
+    if area > 0:
+        max_dpi = 72 * math.sqrt(DPI_MAX_MEGAPIXELS * 1e6 / area)
+        if dpi > max_dpi:
+            dpi = max(_DPI_STEP, int(max_dpi // _DPI_STEP) * _DPI_STEP)
+            capped = True
+    return {
+        "dpi": int(dpi),
+        "source": source,
+        "glyph_pt": round(glyph, 2) if glyph is not None else None,
+        "capped": capped,
+    }
+
+def choose_dpi(pdf_ref, page_index: int, bbox_rel: Dict[str, float], dpi: Optional[int] = None,
+               *, full_page: bool = False) -> Dict[str, Any]:
+    """
+    DPI para rasterizar o recorte bbox_rel: {"dpi", "source", "glyph_pt", "capped"}.
+      source 'texto'  -> menor texto da bbox (glyph_pt) a DPI_TARGET_GLYPH_PX, entre DPI_MIN e DPI_MAX
+             'padrão' -> sem camada de texto na região: PROCESS_DPI
+             'fixo'   -> dpi informado (ou ADAPTIVE_DPI desligado)
+    capped=True quando o orçamento DPI_MAX_MEGAPIXELS reduziu o DPI
+    (full_page=True: o orçamento vale para a página inteira, caminho sem clip).
+    """
+    if dpi is not None:
+        return _fixed_dpi(dpi)
+    if not ADAPTIVE_DPI:
+        return _fixed_dpi(PROCESS_DPI)
+    with _PDFIUM_LOCK:
+        pdf = _open_pdfium(pdf_ref)
+        try:
+            return _choose_dpi_on(pdf, page_index, bbox_rel, full_page=full_page)
+        finally:
+            pdf.close()
+
+def _px_to_crop_units(px: int, scale: float) -> float:
+    # pypdfium2 corta ceil(c * scale) pixels; -0.5 evita arredondar para o pixel seguinte
+    return 0.0 if px <= 0 else (px - 0.5) / scale
+
+def render_region(pdf_ref, page_index: int, bbox_rel: Dict[str, float], dpi: int) -> Image.Image:
+    """
+    Rasteriza apenas o recorte bbox_rel da página (clip no pypdfium2).
+    Produz o mesmo tamanho e os mesmos pixels de
+    render_pdf_page(...).crop(bbox_rel_to_px(...)) (salvo diferenças isoladas
+    de 1px no antialias de glifos), sem rasterizar o resto da prancha.
+    """
+    doc_hash = pdf_content_hash(pdf_ref)
+    full = _peek_full_region(doc_hash, page_index, bbox_rel, dpi)
+    if full is not None:
+        return full
+
+    with _PDFIUM_LOCK:
+        pdf = _open_pdfium(pdf_ref)
+        try:
+            return _render_region_on(pdf, pdf_ref, doc_hash, page_index, bbox_rel, dpi)
+        finally:
+            pdf.close()
+
+def _peek_full_region(doc_hash: str, page_index: int, bbox_rel, dpi: int) -> Optional[Image.Image]:
+    # Se a página inteira já está em memória, recortar é mais barato que renderizar
+    full = _render_cache.peek((doc_hash, int(page_index), int(dpi), RENDERER_ID))
+    if full is None:
+        return None
+    return full.crop(bbox_rel_to_px(bbox_rel, full.width, full.height))
+
+def _render_region_on(pdf, pdf_ref, doc_hash: str, page_index: int, bbox_rel, dpi: int) -> Image.Image:
+    """Clip de uma página num PdfDocument já aberto (chamar com _PDFIUM_LOCK)."""
+    scale = dpi / 72
+    page = pdf[page_index]
+    w = math.ceil(page.get_width() * scale)
+    h = math.ceil(page.get_height() * scale)
+    x0, y0, x1, y1 = bbox_rel_to_px(bbox_rel, w, h)
+    if x1 <= x0 or y1 <= y0:
+        # recorte degenerado: mantém o comportamento do crop sobre a página inteira
+        return render_pdf_page(pdf_ref, page_index, dpi=dpi).crop((x0, y0, x1, y1))
+
+    key = (doc_hash, int(page_index), int(dpi), f"clip{x0}-{y0}-{x1}-{y1}")
+    img = _render_cache.get(key)
+    if img is not None:
+        return img
+
+    # Margem de alguns pixels: glifos cortados exatamente na borda do clip
+    # rasterizam diferente; renderiza um pouco a mais e apara no PIL.
+    m = _CLIP_MARGIN_PX
+    mx0, my0 = max(0, x0 - m), max(0, y0 - m)
+    mx1, my1 = min(w, x1 + m), min(h, y1 + m)
+    crop = (
+        _px_to_crop_units(mx0, scale),
+        _px_to_crop_units(h - my1, scale),
+        _px_to_crop_units(w - mx1, scale),
+        _px_to_crop_units(my0, scale),
+    )
+    # Mesmos parâmetros usados pelo pdfplumber em page.to_image()
+    bitmap = page.render(
+        scale=scale,
+        crop=crop,
+        no_smoothtext=True,
+        no_smoothpath=True,
+        no_smoothimage=True,
+        prefer_bgrx=True,
+    )
+    img = bitmap.to_pil().convert("RGB")
+    bitmap.close()  # ainda sob a trava (senão o finalizador libera o bitmap em outra thread)
+    img = img.crop((x0 - mx0, y0 - my0, x0 - mx0 + (x1 - x0), y0 - my0 + (y1 - y0)))
+
+    _render_cache.put(key, img)
+    return img
+
+def _fold(text: str) -> str:
+    """Minúsculas e sem acentos, para casar palavras-chave ('Lista de Matériais' ~ 'LISTA DE MATERIAIS')."""
+    norm = unicodedata.normalize("NFKD", text or "")
+    return "".join(c for c in norm if not unicodedata.combining(c)).casefold()
+
+def _select_pages_on(pdf, page_filter: Optional[str]) -> List[int]:
+    n_pages = len(pdf)
+    if n_pages <= 0:
+        return []
+    spec = (page_filter or "0").strip()
+    low = spec.lower()
+
+    if low.startswith("text:"):
+        keyword = _fold(spec[5:].strip())
+        if not keyword:
+            return []
+        return [i for i in range(n_pages) if keyword in _fold(_page_text_on(pdf, i))]
+
+    pages = set()
+    for part in low.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            if part == "all":
+                pages.update(range(n_pages))
+            elif part == "first":
+                pages.add(0)
+            elif part == "last":
+                pages.add(n_pages - 1)
+            elif "-" in part:
+                a, b = part.split("-", 1)
+                a = int(a) if a.strip() else 0
+                b = n_pages - 1 if b.strip() in ("", "last") else int(b)
+                pages.update(range(a, b + 1))
+            else:
+                pages.add(int(part))
+        except ValueError:
+            raise ValueError(f"Filtro de páginas inválido: {spec!r} (trecho {part!r})") from None
+    return sorted(i for i in pages if 0 <= i < n_pages)
+
+def select_pages(pdf_ref, page_filter: Optional[str]) -> List[int]:
+    """
+    Páginas (0-index, como no app) selecionadas por page_filter:
+      'all' | 'first' | 'last' | '0,2,5-7' | '3-' / '2-last' (até o fim)
+      'text:<palavra>' -> páginas cuja camada de texto contém a palavra
+                          (sem diferenciar maiúsculas/acentos; PDFs escaneados não casam)
+    Vazio/None -> primeira página (comportamento anterior do lote).
+    Lança ValueError para especificação inválida.
+    """
+    with _PDFIUM_LOCK:
+        pdf = _open_pdfium(pdf_ref)
+        try:
+            return _select_pages_on(pdf, page_filter)
+        finally:
+            pdf.close()
+
+def render_selected_regions(pdf_ref, page_filter, bbox_rel: Dict[str, float],
+                            dpi: Optional[int] = None) -> List[Tuple[int, Image.Image, Dict[str, Any]]]:
+    """
+    Seleciona as páginas de page_filter (especificação de select_pages ou lista
+    de páginas já escolhidas) e rasteriza o recorte bbox_rel de cada uma com um
+    ÚNICO handle do documento (abre/parseia o PDF uma vez só).
+    dpi=None -> DPI adaptativo por página (choose_dpi).
+    Retorna [(page_index, crop, dpi_info), ...] na ordem das páginas.
+    O documento fica sob _PDFIUM_LOCK do começo ao fim: em lotes, os workers
+    renderizam um de cada vez (as chamadas ao Gemini continuam em paralelo).
+    """
+    doc_hash = pdf_content_hash(pdf_ref)
+    with _PDFIUM_LOCK:
+        pdf = _open_pdfium(pdf_ref)
+        try:
+            out = []
+            pages = list(page_filter) if isinstance(page_filter, (list, tuple)) else _select_pages_on(pdf, page_filter)
+            for i in pages:
+                if dpi is not None:
+                    info = _fixed_dpi(dpi)
+                elif ADAPTIVE_DPI:
+                    info = _choose_dpi_on(pdf, i, bbox_rel)
+                else:
+                    info = _fixed_dpi(PROCESS_DPI)
+                img = _peek_full_region(doc_hash, i, bbox_rel, info["dpi"])
+                if img is None:
+                    img = _render_region_on(pdf, pdf_ref, doc_hash, i, bbox_rel, info["dpi"])
+                out.append((i, img, info))
+            return out
+        finally:
+            pdf.close()
+
+def _has_text_in(page, rect) -> bool:
+    textpage = page.get_textpage()
+    try:
+        x0, y0, x1, y1 = rect
+        return bool(textpage.get_text_bounded(left=x0, bottom=y0, right=x1, top=y1).strip())
+    finally:
+        textpage.close()
+
+def extract_text_tables(pdf_ref, pages: List[int], bbox_rel: Dict[str, float]) -> Dict[int, List[List[List[Optional[str]]]]]:
+    """
+    Tabelas da camada de texto dentro de bbox_rel (pdfplumber extract_tables), por página:
+    {page_index: [tabela = [linha = [célula, ...], ...], ...]}.
+    Páginas sem texto na região (escaneadas) nem passam pelo pdfplumber e voltam [];
+    páginas giradas também (o pdfplumber lê as células na orientação original,
+    a tabela sairia transposta).
+    pdf_ref deve ser picklável ou file-like (roda também no process pool do pipeline em estágios).
+    """
+    with _PDFIUM_LOCK:  # triagem pelo pdfium; o pdfplumber abaixo (pdfminer) não precisa da trava
+        pdf = _open_pdfium(pdf_ref)
+        try:
+            with_text = {
+                i for i in pages
+                if pdf[i].get_rotation() % 360 == 0 and _has_text_in(pdf[i], _rel_to_page_rect(pdf[i], bbox_rel))
+            }
+        finally:
+            pdf.close()
+    out = {i: [] for i in pages}
+    if not with_text:
+        return out
+
+    if isinstance(pdf_ref, (bytes, bytearray)):
+        src = io.BytesIO(pdf_ref)
+    elif hasattr(pdf_ref, "getvalue"):
+        src = io.BytesIO(pdf_ref.getvalue())
+    else:
+        src = pdf_ref
+    fx0, fx1 = sorted((bbox_rel["x0"], bbox_rel["x1"]))
+    fy0, fy1 = sorted((bbox_rel["y0"], bbox_rel["y1"]))
+    with pdfplumber.open(src) as doc:
+        for i in pages:
+            if i not in with_text:
+                continue
+            page = doc.pages[i]
+            x0, top, x1, bottom = page.bbox
+            w, h = x1 - x0, bottom - top
+            region = page.crop((x0 + fx0 * w, top + fy0 * h, x0 + fx1 * w, top + fy1 * h))
+            out[i] = region.extract_tables()
+            page.close()
+    return out
 
 def bbox_rel_to_px(bbox_rel, w: int, h: int):
     """Converte frações (x0,y0,x1,y1) em pixels (top-left)."""
@@ -1,18 +1,83 @@
 # app/pipeline.py
 from __future__ import annotations
+import json
+import threading
 from pathlib import Path
 import pdfplumber
 import pandas as pd
-from typing import Any, Dict, Optional, Tuple
-
-from app.settings import PROCESS_DPI
-from app.pdf_utils import render_page_pair, bbox_rel_to_px
-from app.save_utils import save_crop_image
-from app.gemini_client import call_gemini_on_image_json, SHARED_PROMPT
-from app.json_utils import loads_loose
-from app.result_utils import consolidate_tables
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.settings import (
+    CLIP_RENDER, PAGE_CONCURRENCY, DEFAULT_PAGE_FILTER, TILE_MODE, TILE_MIN_HEIGHT_PX, TILE_CONCURRENCY,
+    TEXT_LAYER_FASTPATH, TEXT_LAYER_MIN_SCORE, NORMALIZE_NUMERIC_COLUMNS,
+)
+from app.pdf_utils import (
+    choose_dpi, extract_text_tables, render_page_pair, render_region, render_selected_regions,
+    select_pages, bbox_rel_to_px,
+)
+from app.save_utils import save_crop_image, save_region_crop
+from app.gemini_client import call_gemini_on_image_payload, SHARED_PROMPT
+from app.result_utils import consolidate_tables, normalize_bom_columns, merge_tile_payloads, text_tables_payload
+from app.image_utils import tile_bands
 from app.paths import OUT_DIR
 
+# ---------------------------------------------------------------------------
+# Roteador da camada de texto: em PDF vetorial a tabela costuma existir como
+# texto; se o pdfplumber a extrai limpa, o Gemini nem é chamado.
+# ---------------------------------------------------------------------------
+
+_text_layer_lock = threading.Lock()
+_text_layer_counts = {"tried": 0, "used": 0, "no_text": 0, "low_score": 0}
+
+def _count_text_layer(name: str) -> None:
+    with _text_layer_lock:
+        _text_layer_counts[name] += 1
+
+def text_layer_stats() -> Dict[str, int]:
+    """Páginas tentadas pela camada de texto; "used" = chamadas ao Gemini evitadas."""
+    with _text_layer_lock:
+        return dict(_text_layer_counts)
+
+def route_text_tables(tables_by_page: Dict[int, List[Any]]) -> Dict[int, Dict[str, Any]]:
+    """
+    Pontua as tabelas de extract_text_tables e devolve {página: payload} só das
+    páginas com nota >= TEXT_LAYER_MIN_SCORE; as demais seguem para o Gemini.
+    """
+    routed = {}
+    for page_index, tables in tables_by_page.items():
+        _count_text_layer("tried")
+        if not tables:
+            _count_text_layer("no_text")
+            continue
+        payload, score = text_tables_payload(tables)
+        if payload is None or score < TEXT_LAYER_MIN_SCORE:
+            _count_text_layer("low_score")
+            continue
+        payload["text_layer_score"] = round(score, 3)
+        routed[page_index] = payload
+        _count_text_layer("used")
+    return routed
+
+def text_layer_route(pdf_file, pages: List[int], bbox_rel: Dict[str, float]) -> Dict[int, Dict[str, Any]]:
+    """extract_text_tables + route_text_tables; erro no PDF -> {} (tudo vai ao Gemini)."""
+    try:
+        tables = extract_text_tables(pdf_file, pages, bbox_rel)
+    except Exception as e:
+        print(f"Aviso: camada de texto indisponível, usando o Gemini: {e}")
+        return {}
+    return route_text_tables(tables)
+
+def _text_layer_result(payload: Dict[str, Any], *, pdf_name: str, page_index: int, bbox_rel: Dict[str, float],
+                       on_rows: Optional[Callable[[List[Dict[str, Any]]], None]] = None) -> Dict[str, Any]:
+    print(f"⚡ Tabela lida da camada de texto (nota {payload['text_layer_score']}): {pdf_name} p{page_index}")
+    if on_rows:
+        on_rows([row for t in payload["tables"] for row in t["rows"]])
+    return build_result(
+        pdf_name=pdf_name, page_index=page_index, bbox_rel=bbox_rel,
+        raw_text=json.dumps(payload, ensure_ascii=False), payload=payload, crop_path=None,
+        source="text_layer",
+    )
+
 def process_pdf_once(
     *,
     pdf_file,                      # st.uploaded_file OR Path
@@ -21,47 +86,249 @@ def process_pdf_once(
     api_key: str,
     template_name: Optional[str] = None,
     save_artifacts: bool = True,
+    clip_render: bool = CLIP_RENDER,
+    use_cache: bool = True,
+    on_rows: Optional[Callable[[List[Dict[str, Any]]], None]] = None,
+    dpi: Optional[int] = None,
+    tiled: Optional[bool] = None,
+    text_layer: Optional[bool] = None,
 ) -> Dict[str, Any]:
     """
     Executa o MESMO percurso do fluxo individual:
-    1) render page em 400dpi (fallback 340)
+    0) camada de texto (text_layer=None -> TEXT_LAYER_FASTPATH): se a tabela da
+       bbox sai limpa do pdfplumber, retorna direto (artifacts["source"] = "text_layer")
+    1) render page no DPI de choose_dpi (adaptativo ao menor texto da bbox, ou
+       o dpi informado); com clip_render, só a região da bbox_rel
     2) aplicar crop pela bbox_rel
-    3) chamar Gemini em JSON mode
+    3) chamar Gemini em JSON mode (com on_rows, em streaming: on_rows recebe
+       as linhas brutas do modelo à medida que chegam). Recortes altos
+       (tiled=None -> TILE_MODE) vão em faixas sobrepostas, em paralelo
     4) parse resiliente para JSON
     5) normalizar em rows/DataFrame
-    Retorna dicionário com rows/df/payload e caminhos salvos.
+    Retorna dicionário com rows/df/payload e caminhos salvos; artifacts["dpi"]
+    e artifacts["dpi_info"] registram o DPI usado.
     """
     # Nome do arquivo amigável
     pdf_name = getattr(pdf_file, "name", str(pdf_file))
     base_name = Path(pdf_name).stem
 
-    # 1) Renderiza par consistente (HD + preview)
-    img_hd, img_prev = render_page_pair(pdf_file, page_index, dpi_hd=PROCESS_DPI)
+    if TEXT_LAYER_FASTPATH if text_layer is None else text_layer:
+        routed = text_layer_route(pdf_file, [page_index], bbox_rel)
+        if page_index in routed:
+            return _text_layer_result(
+                routed[page_index], pdf_name=pdf_name, page_index=page_index, bbox_rel=bbox_rel, on_rows=on_rows,
+            )
 
-    # 2) Salvar crop na imagem HD usando bbox_rel
     crop_path = None
-    crop_pil = None
-    
-    # Recortar da imagem HD
-    w, h = img_hd.size
-    x0, y0, x1, y1 = bbox_rel_to_px(bbox_rel, w, h)
-    crop_pil = img_hd.crop((x0, y0, x1, y1))
-    
-    # Salvar crop em arquivo (se solicitado)
-    if save_artifacts:
-        crop_path = save_crop_image(img_hd, bbox_rel, base_name, page_index)
-        print(f"📁 Crop salvo para processamento: {crop_path}")
-    
+    if clip_render:
+        # 1+2) Rasteriza só a região do preset (mesmos pixels do crop da página HD)
+        dpi_info = choose_dpi(pdf_file, page_index, bbox_rel, dpi)
+        crop_pil = render_region(pdf_file, page_index, bbox_rel, dpi_info["dpi"])
+        if save_artifacts:
+            crop_path = save_region_crop(crop_pil, base_name, page_index, dpi=dpi_info["dpi"])
+            print(f"📁 Crop salvo para processamento: {crop_path}")
+    else:
+        # 1) Renderiza par consistente (HD + preview); o orçamento de pixels vale para a página
+        dpi_info = choose_dpi(pdf_file, page_index, bbox_rel, dpi, full_page=True)
+        img_hd, img_prev = render_page_pair(pdf_file, page_index, dpi_hd=dpi_info["dpi"])
+
+        # 2) Recortar da imagem HD usando bbox_rel
+        w, h = img_hd.size
+        x0, y0, x1, y1 = bbox_rel_to_px(bbox_rel, w, h)
+        crop_pil = img_hd.crop((x0, y0, x1, y1))
+
+        # Salvar crop em arquivo (se solicitado)
+        if save_artifacts:
+            crop_path = save_crop_image(img_hd, bbox_rel, base_name, page_index, dpi=dpi_info["dpi"])
+            print(f"📁 Crop salvo para processamento: {crop_path}")
+
+    return _extract_crop(
+        crop_pil, pdf_name=pdf_name, page_index=page_index, bbox_rel=bbox_rel,
+        api_key=api_key, crop_path=crop_path, use_cache=use_cache, on_rows=on_rows,
+        dpi_info=dpi_info, tiled=tiled,
+    )
+
+def _use_tiles(crop_pil, tiled: Optional[bool]) -> bool:
+    if tiled is not None:
+        return tiled
+    if TILE_MODE == "on":
+        return True
+    if TILE_MODE == "off":
+        return False
+    return crop_pil.height > TILE_MIN_HEIGHT_PX and crop_pil.height > crop_pil.width
+
+def _extract_crop(crop_pil, *, pdf_name: str, page_index: int, bbox_rel: Dict[str, float],
+                  api_key: str, crop_path: Optional[str], use_cache: bool,
+                  on_rows: Optional[Callable[[List[Dict[str, Any]]], None]] = None,
+                  dpi_info: Optional[Dict[str, Any]] = None,
+                  tiled: Optional[bool] = None) -> Dict[str, Any]:
+    bands = tile_bands(crop_pil) if _use_tiles(crop_pil, tiled) else [(0, crop_pil.height)]
+
     # 3) Chamar Gemini usando o crop PIL (não o arquivo salvo)
     # Nota: Enviamos a imagem PIL diretamente para melhor qualidade
-    print(f"🤖 Enviando crop para Gemini - Tamanho: {crop_pil.size}")
-    raw_text = call_gemini_on_image_json(api_key, crop_pil, SHARED_PROMPT)
-
-    # 5) parse (tolerante à cerca ```json)
-    payload = loads_loose(raw_text)
+    print(f"🤖 Enviando crop para Gemini - Tamanho: {crop_pil.size}"
+          + (f" @ {dpi_info['dpi']} DPI ({dpi_info['source']})" if dpi_info else "")
+          + (f" em {len(bands)} faixas" if len(bands) > 1 else ""))
+    # 4+5) resposta + parse tolerante (em cache hit o payload já vem parseado)
+    tiles = None
+    if len(bands) > 1:
+        raw_text, payload, tiles = _extract_tiles(
+            crop_pil, bands, api_key=api_key, use_cache=use_cache, on_rows=on_rows,
+        )
+    else:
+        raw_text, payload = call_gemini_on_image_payload(
+            api_key, crop_pil, SHARED_PROMPT, use_cache=use_cache, on_rows=on_rows,
+        )
 
     # 6) normalização -> consolidar todas as tabelas
+    return build_result(
+        pdf_name=pdf_name, page_index=page_index, bbox_rel=bbox_rel,
+        raw_text=raw_text, payload=payload, crop_path=crop_path, dpi_info=dpi_info,
+        tiles=tiles,
+    )
+
+def _extract_tiles(crop_pil, bands: List[Tuple[int, int]], *, api_key: str, use_cache: bool,
+                   on_rows: Optional[Callable[[List[Dict[str, Any]]], None]] = None):
+    """
+    Uma chamada ao Gemini por faixa (y0, y1), em paralelo (TILE_CONCURRENCY).
+    Retorna (texto bruto das faixas, payload unido, [{"y0", "y1", "rows"}]).
+    A falha de uma faixa falha o recorte inteiro, como numa chamada única.
+    on_rows é chamado na thread de quem chamou (as faixas só acumulam as linhas).
+    """
+    from app.batch_executor import run_ordered
+
+    streamed: List[Dict[str, Any]] = []
+    lock = threading.Lock()
+
+    def _collect(rows):
+        with lock:
+            streamed.extend(rows)
+
+    def _flush(*_):
+        with lock:
+            rows = streamed[:]
+            streamed.clear()
+        if rows:
+            on_rows(rows)
+
+    def _work(band):
+        y0, y1 = band
+        return call_gemini_on_image_payload(
+            api_key, crop_pil.crop((0, y0, crop_pil.width, y1)), SHARED_PROMPT,
+            use_cache=use_cache, on_rows=_collect if on_rows else None,
+        )
+
+    results = run_ordered(
+        bands, _work, concurrency=TILE_CONCURRENCY,
+        on_done=_flush if on_rows else None, on_poll=_flush if on_rows else None,
+    )
+    for r in results:
+        if r["error"] is not None:
+            raise r["error"]
+
+    n = len(bands)
+    raw_text = "\n\n".join(
+        f"// faixa {i + 1}/{n}: y={y0}-{y1}px\n{r['result'][0]}"
+        for i, ((y0, y1), r) in enumerate(zip(bands, results))
+    )
+    payloads = [r["result"][1] for r in results]
+    tiles = [{"y0": y0, "y1": y1, "rows": _count_rows(p)} for (y0, y1), p in zip(bands, payloads)]
+    return raw_text, merge_tile_payloads(payloads), tiles
+
+def _count_rows(payload: Any) -> int:
+    if isinstance(payload, list):
+        return len(payload)
+    if not isinstance(payload, dict):
+        return 0
+    return sum(len(t.get("rows") or []) for t in payload.get("tables") or [] if isinstance(t, dict))
+
+def process_pdf_pages(
+    *,
+    pdf_file,
+    bbox_rel: Dict[str, float],
+    api_key: str,
+    page_filter: Optional[str] = DEFAULT_PAGE_FILTER,
+    template_name: Optional[str] = None,
+    save_artifacts: bool = True,
+    clip_render: bool = CLIP_RENDER,
+    use_cache: bool = True,
+    concurrency: int = PAGE_CONCURRENCY,
+    on_rows: Optional[Callable[[int, List[Dict[str, Any]]], None]] = None,
+    dpi: Optional[int] = None,
+    tiled: Optional[bool] = None,
+    text_layer: Optional[bool] = None,
+) -> List[Dict[str, Any]]:
+    """
+    process_pdf_once para todas as páginas de page_filter (ver pdf_utils.select_pages).
+    Páginas resolvidas pela camada de texto não são rasterizadas; os recortes
+    das demais saem em sequência de um único handle do documento e as chamadas
+    ao Gemini das páginas rodam em paralelo (concurrency).
+    Retorna, na ordem das páginas, [{"index", "item": page_index, "result", "error"}]
+    (formato de run_ordered): a falha de uma página não derruba as demais.
+    on_rows(page_index, linhas) liga o streaming; roda nas threads das páginas.
+    """
+    from app.batch_executor import run_ordered
+
+    pdf_name = getattr(pdf_file, "name", str(pdf_file))
+    base_name = Path(pdf_name).stem
+
+    pages = select_pages(pdf_file, page_filter)
+    use_text = TEXT_LAYER_FASTPATH if text_layer is None else text_layer
+    routed = text_layer_route(pdf_file, pages, bbox_rel) if use_text and pages else {}
+    rest = [i for i in pages if i not in routed]
+
+    crops = {}
+    if clip_render and rest:
+        crops = {i: (img, info) for i, img, info in render_selected_regions(pdf_file, rest, bbox_rel, dpi)}
+
+    def _work(page_index: int) -> Dict[str, Any]:
+        if page_index in routed:
+            return _text_layer_result(
+                routed.pop(page_index), pdf_name=pdf_name, page_index=page_index, bbox_rel=bbox_rel,
+                on_rows=_page_rows(on_rows, page_index),
+            )
+        if not clip_render:
+            return process_pdf_once(
+                pdf_file=pdf_file, page_index=page_index, bbox_rel=bbox_rel, api_key=api_key,
+                template_name=template_name, save_artifacts=save_artifacts,
+                clip_render=False, use_cache=use_cache,
+                on_rows=_page_rows(on_rows, page_index), dpi=dpi, tiled=tiled, text_layer=False,
+            )
+        crop_pil, dpi_info = crops.pop(page_index)  # libera os pixels ao terminar a página
+        crop_path = None
+        if save_artifacts:
+            crop_path = save_region_crop(crop_pil, base_name, page_index, dpi=dpi_info["dpi"])
+            print(f"📁 Crop salvo para processamento: {crop_path}")
+        return _extract_crop(
+            crop_pil, pdf_name=pdf_name, page_index=page_index, bbox_rel=bbox_rel,
+            api_key=api_key, crop_path=crop_path, use_cache=use_cache,
+            on_rows=_page_rows(on_rows, page_index), dpi_info=dpi_info, tiled=tiled,
+        )
+
+    return run_ordered(pages, _work, concurrency=concurrency)
+
+def _page_rows(on_rows, page_index: int):
+    """Prende o índice da página ao callback de streaming de process_pdf_pages."""
+    if on_rows is None:
+        return None
+    return lambda rows: on_rows(page_index, rows)
+
+def build_result(
+    *,
+    pdf_name: str,
+    page_index: int,
+    bbox_rel: Dict[str, float],
+    raw_text: str,
+    payload: Any,
+    crop_path: Optional[str],
+    dpi_info: Optional[Dict[str, Any]] = None,
+    tiles: Optional[List[Dict[str, int]]] = None,
+    source: str = "gemini",
+) -> Dict[str, Any]:
+    """Normaliza o payload e monta o retorno padronizado de process_pdf_once."""
     df_all = consolidate_tables(payload)
+    if NORMALIZE_NUMERIC_COLUMNS:
+        df_all = normalize_bom_columns(df_all)
     
     # Extrair nome da tabela do payload (se disponível)
     table_name = "tabela_extraida"
@@ -73,7 +340,11 @@ def process_pdf_once(
     artifacts = {
         "crop_path": crop_path, 
         "raw_text": raw_text,
-        "table_name": table_name
+        "table_name": table_name,
+        "dpi": dpi_info["dpi"] if dpi_info else None,
+        "dpi_info": dpi_info,
+        "tiles": tiles,
+        "source": source,   # "gemini" | "text_layer"
     }
 
     # Retorno padronizado
@@ -85,5 +356,6 @@ def process_pdf_once(
         "payload": payload,
         "artifacts": artifacts,
         "is_empty": df_all.empty,
-        "rows": df_all.to_dict('records') if not df_all.empty else []
+        # NaN -> None: as colunas numéricas normalizadas têm NaN, que json.dumps grava como NaN (JSON inválido)
+        "rows": df_all.astype(object).where(df_all.notna(), None).to_dict('records') if not df_all.empty else []
     }
@@ -0,0 +1,181 @@
+# app/preset_db.py
+"""
+Backend SQLite dos presets (PRESETS_BACKEND = "sqlite"), atrás da mesma API de
+app/presets.py.
+
+- Uma linha por preset: colunas indexadas (escopo, modelo, fingerprints) +
+  o dict completo em JSON. use_count/active/updated_at são colunas próprias,
+  alteradas com UPDATE sem regravar o resto.
+- Modo WAL: sessões concorrentes leem enquanto outra grava.
+- Leitura em cache por processo; a tabela meta guarda uma revisão que toda
+  gravação incrementa, então o cache só é refeito quando alguém gravou.
+- Na criação do banco, o config/presets.json existente é importado uma vez.
+"""
+from __future__ import annotations
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from app.presets import PRESETS_DIR, PRESETS_PATH
+
+PRESETS_DB_PATH = PRESETS_DIR / "presets.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS presets (
+    id                   TEXT PRIMARY KEY,
+    pos                  INTEGER NOT NULL,
+    name                 TEXT,
+    scope                TEXT NOT NULL DEFAULT 'global',
+    template_id          TEXT,
+    document_fingerprint TEXT,
+    layout_fingerprint   TEXT,
+    active               INTEGER NOT NULL DEFAULT 1,
+    use_count            INTEGER NOT NULL DEFAULT 0,
+    created_at           TEXT,
+    updated_at           TEXT,
+    data                 TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_presets_scope ON presets(scope, active);
+CREATE INDEX IF NOT EXISTS ix_presets_template ON presets(template_id);
+CREATE INDEX IF NOT EXISTS ix_presets_document ON presets(document_fingerprint);
+CREATE INDEX IF NOT EXISTS ix_presets_layout ON presets(layout_fingerprint);
+CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v INTEGER NOT NULL);
+INSERT OR IGNORE INTO meta(k, v) VALUES ('rev', 0);
+"""
+
+_COLUMNS = ("id", "pos", "name", "scope", "template_id", "document_fingerprint", "layout_fingerprint",
+            "active", "use_count", "created_at", "updated_at", "data")
+
+def _template_key(p: Dict) -> Optional[str]:
+    return (p.get("template_id") or p.get("template_name") or "").strip().lower() or None
+
+def _row(p: Dict, pos: int) -> tuple:
+    return (
+        p["id"], pos, p.get("name"), p.get("scope", "global"), _template_key(p),
+        p.get("document_fingerprint"), p.get("layout_fingerprint"),
+        1 if p.get("active", True) else 0, int(p.get("use_count") or 0),
+        p.get("created_at"), p.get("updated_at"), json.dumps(p, ensure_ascii=False),
+    )
+
+def _preset(row: sqlite3.Row) -> Dict:
+    """Dict do preset; as colunas alteradas por UPDATE prevalecem sobre o JSON."""
+    p = json.loads(row["data"])
+    p["active"] = bool(row["active"])
+    p["use_count"] = row["use_count"]
+    if row["updated_at"]:
+        p["updated_at"] = row["updated_at"]
+    return p
+
+class SQLitePresetStore:
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self._local = threading.local()  # uma conexão por thread
+        self._lock = threading.Lock()
+        self._rev = None
+        self._presets: List[Dict] = []
+        self._by_id: Dict[str, Dict] = {}
+        self.version = 0
+        created = not self.db_path.exists()
+        with self._conn() as conn:
+            conn.executescript(_SCHEMA)
+        if created and PRESETS_PATH.exists():
+            n = import_json(PRESETS_PATH, self)
+            print(f"Presets: {n} importado(s) de {PRESETS_PATH.name} para {self.db_path.name}")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _write(self, sql: str, params: Iterable = (), many: bool = False) -> None:
+        conn = self._conn()
+        with conn:  # transação; BEGIN IMMEDIATE evita deadlock de upgrade de leitura p/ escrita
+            conn.execute("BEGIN IMMEDIATE")
+            (conn.executemany if many else conn.execute)(sql, params)
+            conn.execute("UPDATE meta SET v = v + 1 WHERE k = 'rev'")
+
+    def refresh(self) -> None:
+        conn = self._conn()
+        rev = conn.execute("SELECT v FROM meta WHERE k = 'rev'").fetchone()[0]
+        if rev == self._rev:
+            return
+        rows = conn.execute("SELECT * FROM presets ORDER BY pos").fetchall()
+        presets = [_preset(r) for r in rows]
+        with self._lock:
+            self._presets, self._rev = presets, rev
+            self._by_id = {p["id"]: p for p in presets}
+            self.version += 1
+
+    def all(self) -> List[Dict]:
+        self.refresh()
+        return list(self._presets)
+
+    def get(self, pid: str) -> Optional[Dict]:
+        self.refresh()
+        return self._by_id.get(pid)
+
+    def _query(self, where: str, value) -> List[Dict]:
+        rows = self._conn().execute(f"SELECT * FROM presets WHERE {where} = ? ORDER BY pos", (value,)).fetchall()
+        return [_preset(r) for r in rows]
+
+    def scope(self, scope: str) -> List[Dict]:
+        return self._query("scope", scope)
+
+    def template(self, template: str) -> List[Dict]:
+        return self._query("template_id", (template or "").strip().lower())
+
+    def by_document(self, fingerprint: str) -> List[Dict]:
+        return self._query("document_fingerprint", fingerprint)
+
+    def current_version(self):
+        self.refresh()
+        return self.version
+
+    def replace_all(self, presets: List[Dict]) -> None:
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM presets")
+            conn.executemany(
+                f"INSERT INTO presets({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})",
+                [_row(p, i) for i, p in enumerate(presets) if p.get("id")],
+            )
+            conn.execute("UPDATE meta SET v = v + 1 WHERE k = 'rev'")
+
+    def upsert(self, preset: Dict) -> None:
+        # Preset novo vai para o fim; existente mantém a posição e o use_count do banco
+        cols = [c for c in _COLUMNS if c not in ("pos", "use_count")]
+        row = dict(zip(_COLUMNS, _row(preset, 0)))
+        self._write(
+            f"INSERT INTO presets({', '.join(cols)}, pos, use_count) "
+            f"VALUES ({', '.join('?' * len(cols))}, (SELECT COALESCE(MAX(pos), -1) + 1 FROM presets), ?) "
+            f"ON CONFLICT(id) DO UPDATE SET "
+            + ", ".join(f"{c} = excluded.{c}" for c in cols if c != "id"),
+            [row[c] for c in cols] + [row["use_count"]],
+        )
+
+    def set_active(self, pid: str, active: bool) -> None:
+        self._write("UPDATE presets SET active = ? WHERE id = ?", (1 if active else 0, pid))
+
+    def add_uses(self, counts: Dict[str, int]) -> None:
+        """Todos os incrementos pendentes numa única transação."""
+        self._write("UPDATE presets SET use_count = use_count + ? WHERE id = ?",
+                    [(n, pid) for pid, n in counts.items()], many=True)
+
+def import_json(json_path: Path = PRESETS_PATH, store: Optional[SQLitePresetStore] = None) -> int:
+    """Importa (substituindo) os presets de um presets.json para o banco. Retorna quantos."""
+    data = json.loads(Path(json_path).read_text(encoding="utf-8"))
+    if not isinstance(data, list):
+        raise ValueError(f"{json_path}: o conteúdo não é uma lista")
+    store = store or SQLitePresetStore(PRESETS_DB_PATH)
+    presets = [p for p in data if isinstance(p, dict) and p.get("id")]
+    store.replace_all(presets)
+    return len(presets)
@@ -1,6 +1,13 @@
 # app/presets.py
 from __future__ import annotations
+import atexit
+import contextlib
+import copy
 import json
+import os
+import threading
+import time
+from datetime import datetime
 from pathlib import Path
 from typing import List, Dict, Optional
 
@@ -8,60 +15,266 @@ from typing import List, Dict, Optional
 PROJECT_ROOT = Path(__file__).resolve().parents[1]                  # ...\Takeoff_AI_Multi_v2
 PRESETS_DIR  = PROJECT_ROOT / "config"
 PRESETS_PATH = PRESETS_DIR / "presets.json"
+LOCK_PATH    = PRESETS_DIR / "presets.json.lock"
 
 def ensure_store():
     """Garante que config/ e presets.json existam."""
     PRESETS_DIR.mkdir(parents=True, exist_ok=True)
     if not PRESETS_PATH.exists():
-        PRESETS_PATH.write_text("[]", encoding="utf-8")
+        with _file_lock():
+            if not PRESETS_PATH.exists():
+                _write_atomic([])
 
-def load_presets() -> List[Dict]:
-    """Carrega a lista de presets do arquivo JSON."""
-    ensure_store()
+@contextlib.contextmanager
+def _file_lock():
+    """Trava exclusiva entre processos (sessões do Streamlit, CLI) em config/presets.json.lock."""
+    PRESETS_DIR.mkdir(parents=True, exist_ok=True)
+    with open(LOCK_PATH, "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:  # LK_LOCK desiste após ~10 s; tenta de novo
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def _write_atomic(presets: List[Dict]) -> None:
+    """Grava num arquivo temporário e troca pelo definitivo (leitores nunca veem meio arquivo)."""
+    tmp = PRESETS_PATH.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_text(json.dumps(presets, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, PRESETS_PATH)
+
+def _stamp():
     try:
-        data = json.loads(PRESETS_PATH.read_text(encoding="utf-8"))
-        return data if isinstance(data, list) else []
-    except Exception:
-        # Corrupção? Zera com lista vazia.
-        PRESETS_PATH.write_text("[]", encoding="utf-8")
-        return []
+        st_ = os.stat(PRESETS_PATH)
+    except OSError:
+        return None
+    return (st_.st_mtime_ns, st_.st_size)
+
+class PresetStore:
+    """
+    presets.json em memória: relido só quando mtime/tamanho mudam, com índices
+    por id, escopo e modelo. Os dicts devolvidos são compartilhados (não altere;
+    use upsert_preset/set_active).
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._stamp = None
+        self._presets: List[Dict] = []
+        self.by_id: Dict[str, Dict] = {}
+        self.by_scope: Dict[str, List[Dict]] = {}
+        self.by_template: Dict[str, List[Dict]] = {}
+        self.version = 0  # muda a cada recarga/gravação (ex.: índice de modelos)
+
+    def _index(self, presets: List[Dict], stamp) -> None:
+        self._presets, self._stamp = presets, stamp
+        self.by_id, self.by_scope, self.by_template = {}, {}, {}
+        for p in presets:
+            if p.get("id"):
+                self.by_id[p["id"]] = p
+            self.by_scope.setdefault(p.get("scope", "global"), []).append(p)
+            tmpl = (p.get("template_id") or p.get("template_name") or "").strip().lower()
+            if tmpl:
+                self.by_template.setdefault(tmpl, []).append(p)
+        self.version += 1
+
+    def _read(self) -> Optional[List[Dict]]:
+        """Lista do arquivo; None se ilegível (o arquivo é preservado como .corrompido-<ts>)."""
+        try:
+            data = json.loads(PRESETS_PATH.read_text(encoding="utf-8"))
+            if isinstance(data, list):
+                return data
+            raise ValueError("o conteúdo não é uma lista")
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as e:
+            backup = PRESETS_PATH.with_name(f"presets.json.corrompido-{time.strftime('%Y%m%d_%H%M%S')}")
+            print(f"Aviso: presets.json ilegível ({e}); cópia preservada em {backup.name}")
+            try:
+                os.replace(PRESETS_PATH, backup)
+            except OSError:
+                pass
+            return None
+
+    def refresh(self) -> None:
+        stamp = _stamp()
+        if stamp == self._stamp and self.version:
+            return
+        with self._lock:
+            stamp = _stamp()
+            if stamp == self._stamp and self.version:
+                return
+            presets = self._read()
+            if presets is None:
+                # Mantém o último estado bom em memória e regrava o arquivo com ele
+                with _file_lock():
+                    _write_atomic(self._presets)
+                presets = self._presets
+            self._index(presets, _stamp())
+
+    def all(self) -> List[Dict]:
+        self.refresh()
+        return list(self._presets)
+
+    def get(self, pid: str) -> Optional[Dict]:
+        self.refresh()
+        return self.by_id.get(pid)
+
+    def update(self, fn) -> None:
+        """Lê o arquivo, aplica fn(lista) e grava, tudo sob a trava entre processos."""
+        ensure_store()
+        with self._lock, _file_lock():
+            presets = self._read()
+            if presets is None:
+                presets = copy.deepcopy(self._presets)
+            fn(presets)
+            _write_atomic(presets)
+            self._index(presets, _stamp())
+
+    def scope(self, scope: str) -> List[Dict]:
+        self.refresh()
+        return list(self.by_scope.get(scope, ()))
+
+    def template(self, template: str) -> List[Dict]:
+        self.refresh()
+        return list(self.by_template.get((template or "").strip().lower(), ()))
+
+    def current_version(self):
+        self.refresh()
+        return self.version
+
+    def replace_all(self, presets: List[Dict]) -> None:
+        def _replace(current: List[Dict]) -> None:
+            current[:] = presets
+        self.update(_replace)
+
+    def upsert(self, preset: Dict) -> None:
+        pid = preset["id"]
+
+        def _upsert(presets: List[Dict]) -> None:
+            for i, p in enumerate(presets):
+                if p.get("id") == pid:
+                    presets[i] = preset
+                    return
+            presets.append(preset)
+        self.update(_upsert)
+
+    def set_active(self, pid: str, active: bool) -> None:
+        def _set(presets: List[Dict]) -> None:
+            for p in presets:
+                if p.get("id") == pid:
+                    p["active"] = bool(active)
+                    break
+        self.update(_set)
+
+    def add_uses(self, counts: Dict[str, int]) -> None:
+        """Soma use_count de vários presets numa única gravação."""
+        def _add(presets: List[Dict]) -> None:
+            for p in presets:
+                n = counts.get(p.get("id"))
+                if n:
+                    p["use_count"] = int(p.get("use_count") or 0) + n
+        self.update(_add)
+
+_stores: Dict[str, object] = {}
+_stores_lock = threading.Lock()
+
+def _store():
+    """Backend configurado em PRESETS_BACKEND ('json' ou 'sqlite')."""
+    from app.settings import PRESETS_BACKEND
+    with _stores_lock:
+        store = _stores.get(PRESETS_BACKEND)
+        if store is None:
+            if PRESETS_BACKEND == "sqlite":
+                from app.preset_db import SQLitePresetStore, PRESETS_DB_PATH
+                store = SQLitePresetStore(PRESETS_DB_PATH)
+            else:
+                ensure_store()
+                store = PresetStore()
+            _stores[PRESETS_BACKEND] = store
+        return store
+
+def load_presets() -> List[Dict]:
+    """Lista de presets (em cache; relida só quando o armazenamento muda)."""
+    return _store().all()
+
+def presets_version():
+    """Versão da lista em memória (muda quando o armazenamento é relido ou gravado)."""
+    return _store().current_version()
 
 def save_presets(presets: List[Dict]) -> None:
-    ensure_store()
-    PRESETS_PATH.write_text(json.dumps(presets, ensure_ascii=False, indent=2), encoding="utf-8")
+    _store().replace_all(presets)
 
 def list_active_presets() -> List[Dict]:
     return [p for p in load_presets() if p.get("active", True)]
 
 def get_preset_by_id(pid: str) -> Optional[Dict]:
-    for p in load_presets():
-        if p.get("id") == pid:
-            return p
-    return None
+    return _store().get(pid)
+
+def presets_by_scope(scope: str) -> List[Dict]:
+    return _store().scope(scope)
+
+def presets_by_template(template: str) -> List[Dict]:
+    return _store().template(template)
 
 def upsert_preset(preset: Dict) -> None:
     """Inclui/atualiza um preset pelo campo 'id'."""
-    presets = load_presets()
-    pid = preset.get("id")
-    if not pid:
+    if not preset.get("id"):
         raise ValueError("Preset precisa de campo 'id'.")
-    found = False
-    for i, p in enumerate(presets):
-        if p.get("id") == pid:
-            presets[i] = preset
-            found = True
-            break
-    if not found:
-        presets.append(preset)
-    save_presets(presets)
+    _store().upsert(dict(preset, updated_at=datetime.now().isoformat()))
 
 def set_active(pid: str, active: bool) -> None:
-    presets = load_presets()
-    for p in presets:
-        if p.get("id") == pid:
-            p["active"] = bool(active)
-            break
-    save_presets(presets)
+    _store().set_active(pid, active)
+
+# ---------------------------------------------------------------------------
+# use_count: incrementos acumulados em memória e gravados em lote
+# (a cada PRESET_USE_FLUSH_N usos, PRESET_USE_FLUSH_S segundos ou na saída)
+# ---------------------------------------------------------------------------
+
+_uses: Dict[str, int] = {}
+_uses_lock = threading.Lock()
+_uses_last_flush = [time.monotonic()]
+
+def record_preset_use(pid: Optional[str], n: int = 1) -> None:
+    """Conta um uso do preset; a gravação acontece em lote (flush_preset_uses)."""
+    if not pid:
+        return
+    from app.settings import PRESET_USE_FLUSH_N, PRESET_USE_FLUSH_S
+    with _uses_lock:
+        _uses[pid] = _uses.get(pid, 0) + n
+        due = (sum(_uses.values()) >= PRESET_USE_FLUSH_N
+               or time.monotonic() - _uses_last_flush[0] >= PRESET_USE_FLUSH_S)
+    if due:
+        flush_preset_uses()
+
+def flush_preset_uses() -> None:
+    with _uses_lock:
+        counts = dict(_uses)
+        _uses.clear()
+        _uses_last_flush[0] = time.monotonic()
+    if not counts:
+        return
+    try:
+        _store().add_uses(counts)
+    except Exception as e:
+        print(f"Aviso: não foi possível gravar use_count dos presets: {e}")
+
+atexit.register(flush_preset_uses)
 
 def preset_label(p: Dict) -> str:
     return f'{p.get("name","(sem nome)")} ({p.get("scope","global")})'
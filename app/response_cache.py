@@ -0,0 +1,109 @@
+# app/response_cache.py
+from __future__ import annotations
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from PIL import Image
+
+from app.cache_utils import trim_disk_lru
+from app.paths import CACHE_DIR
+from app.settings import RESPONSE_CACHE_TTL_DAYS, RESPONSE_CACHE_DISK_MB
+
+def response_key(img: Image.Image, prompt: str, model_name: str) -> str:
+    """sha256(pixels do crop + modo/tamanho, prompt, modelo)."""
+    h = hashlib.sha256()
+    h.update(f"{img.mode}:{img.width}x{img.height}\0".encode())
+    h.update(img.tobytes())
+    h.update(b"\0")
+    h.update(prompt.encode("utf-8"))
+    h.update(b"\0")
+    h.update(model_name.encode("utf-8"))
+    return h.hexdigest()
+
+class ResponseCache:
+    """
+    Cache em disco das respostas do Gemini (texto bruto + payload parseado).
+    Uma entrada JSON por chave; expira por TTL e remove as menos usadas
+    (mtime) quando o diretório passa do limite de tamanho.
+    """
+
+    def __init__(self, cache_dir: Path, ttl_days: float, disk_limit_mb: int):
+        self.cache_dir = Path(cache_dir)
+        self.ttl = float(ttl_days) * 86400
+        self.disk_limit = int(disk_limit_mb) * 1024 * 1024
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "stores": 0}
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.json"
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.stats[name] += 1
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        path = self._path(key)
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            self._count("misses")
+            return None
+        if self.ttl > 0 and time.time() - entry.get("created_at", 0) > self.ttl:
+            self._count("expired")
+            self._count("misses")
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            return None
+        try:
+            os.utime(path)  # uso recente para a remoção por LRU
+        except OSError:
+            pass
+        self._count("hits")
+        return entry
+
+    def put(self, key: str, *, model_name: str, raw_text: str, payload: Any) -> None:
+        entry = {
+            "created_at": time.time(),
+            "model": model_name,
+            "raw_text": raw_text,
+            "payload": payload,
+        }
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            path = self._path(key)
+            tmp = path.with_suffix(f".{threading.get_ident()}.tmp")
+            tmp.write_text(json.dumps(entry, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, path)
+            self._count("stores")
+            self._evict()
+        except (OSError, TypeError, ValueError) as e:
+            print(f"Aviso: não foi possível gravar cache de respostas: {e}")
+
+    def _evict(self) -> None:
+        trim_disk_lru(self.cache_dir, ".json", self.disk_limit)
+
+    def clear(self) -> None:
+        if not self.cache_dir.exists():
+            return
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith(".json"):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+response_cache = ResponseCache(CACHE_DIR / "gemini", RESPONSE_CACHE_TTL_DAYS, RESPONSE_CACHE_DISK_MB)
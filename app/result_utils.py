@@ -1,5 +1,10 @@
+import hashlib
+import json
+import re
+import unicodedata
+from collections import Counter
 import pandas as pd
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 
 SAFE_DEFAULT_COLUMNS = ["material","descricao","dimensoes_unidade","qtd","peso_unidade_kg","peso_total_kg"]
 
@@ -60,3 +65,303 @@ def consolidate_tables(payload: Dict[str, Any]) -> pd.DataFrame:
         return pd.DataFrame(columns=SAFE_DEFAULT_COLUMNS + ["_table_name"])
     cols = sorted(set().union(*[set(d.columns) for d in dfs]))
     return pd.concat([d.reindex(columns=cols) for d in dfs], ignore_index=True)
+
+# ---------------------------------------------------------------------------
+# Normalização tipada (números no formato brasileiro + unidades), vetorizada
+# ---------------------------------------------------------------------------
+
+# Número (com sinal, milhar e decimal em qualquer convenção) seguido de unidade opcional (RE2)
+_NUM_UNIT_PAT = r"^(?P<num>[-+]?\d[\d.,]*)\s*(?P<unit>[a-zçãõµ²³/]*)\.?$"
+_THOUSANDS_DOT_PAT = r"^[-+]?\d{1,3}(?:\.\d{3})+$"   # "1.234" / "12.345.678": ponto de milhar
+_VALID_NUM_PAT = r"^[-+]?\d+(?:\.\d+)?$"
+
+# Fator por unidade; unidade fora do mapa -> NaN (ex.: "3,2 kg/m" não é um peso em kg)
+_MASS_UNITS = {"": 1.0, "kg": 1.0, "kgs": 1.0, "kgf": 1.0, "g": 0.001, "gr": 0.001, "t": 1000.0, "ton": 1000.0}
+_LENGTH_UNITS = {"": 1.0, "mm": 1.0, "cm": 10.0, "m": 1000.0}   # dimensoes_* em mm quando há unidade
+
+def _numeric_kind(col: str) -> Optional[str]:
+    if col == "qtd":
+        return "qtd"
+    if col in ("peso_unidade_kg", "peso_total_kg"):
+        return "mass"
+    if col.startswith("dimensoes_"):
+        return "length"
+    return None
+
+def parse_br_numbers(values: pd.Series, units: Optional[Dict[str, float]] = None) -> pd.Series:
+    """
+    Texto -> float64 com kernels do pyarrow.compute (sem laço em Python):
+    "1.234,5" -> 1234.5, "12 pç" -> 12, "3,2 kg" -> 3.2. Com vírgula, o ponto é
+    milhar; sem vírgula, ponto seguido de grupos de 3 dígitos é milhar ("1.234")
+    e os demais são decimais ("1.5").
+    units: fator por unidade (minúsculas); None aceita qualquer unidade com fator 1.
+    O que não casa vira NaN; números que já vêm numéricos passam direto.
+    """
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        return values.astype("float64")
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    try:
+        arr = pa.array(values, type=pa.string(), from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):  # células numéricas no meio do texto
+        arr = pa.array(values.where(values.isna(), values.astype(str)), type=pa.string(), from_pandas=True)
+    parts = pc.extract_regex(pc.utf8_lower(pc.utf8_trim_whitespace(arr)), _NUM_UNIT_PAT)
+    num = pc.replace_substring_regex(pc.struct_field(parts, "num"), r"[.,]$", "")
+    thousands = pc.or_(pc.match_substring(num, ","), pc.match_substring_regex(num, _THOUSANDS_DOT_PAT))
+    num = pc.if_else(thousands, pc.replace_substring(num, ".", ""), num)
+    num = pc.replace_substring(num, ",", ".")
+    num = pc.if_else(pc.match_substring_regex(num, _VALID_NUM_PAT), num, pa.scalar(None, pa.string()))
+    out = pc.cast(num, pa.float64())
+    if units is not None:
+        idx = pc.index_in(pc.struct_field(parts, "unit"), value_set=pa.array(list(units), pa.string()))
+        out = pc.multiply(out, pc.take(pa.array(list(units.values()), pa.float64()), idx))
+    return pd.Series(out.to_numpy(zero_copy_only=False), index=values.index, dtype="float64")
+
+def normalize_bom_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Etapa depois de consolidate_tables: qtd, peso_unidade_kg, peso_total_kg e
+    dimensoes_* viram colunas numéricas (qtd int64 quando todas as quantidades
+    são inteiras e presentes, senão float64; pesos em kg; dimensões em mm quando
+    a unidade vem escrita). O texto original fica em <coluna>_raw ao lado, sempre
+    como texto (valores int/str misturados quebram o Parquet) e sempre presente
+    nessas colunas, mesmo quando já vêm numéricas ou vazias: o esquema fica igual
+    entre páginas.
+    """
+    if df.empty:
+        return df
+    df = df.copy()
+    for col in list(df.columns):
+        kind = _numeric_kind(col)
+        if kind is None or col.endswith("_raw") or f"{col}_raw" in df.columns:
+            continue
+        raw = df[col]
+        if pd.api.types.is_numeric_dtype(raw):
+            parsed = raw
+        elif raw.isna().all():  # coluna ausente na tabela: mesmo tipo das demais páginas
+            parsed = raw.astype("float64")
+        else:
+            units = _MASS_UNITS if kind == "mass" else _LENGTH_UNITS if kind == "length" else None
+            parsed = parse_br_numbers(raw, units)
+            if kind == "qtd" and parsed.notna().all() and (parsed % 1 == 0).all():
+                parsed = parsed.astype("int64")
+        df[col] = parsed
+        # texto com None nos vazios (pd.NA quebraria json.dumps/pa.array das linhas em to_dict)
+        raw_text = raw.astype("string").astype(object).where(raw.notna(), None)
+        df.insert(df.columns.get_loc(col) + 1, f"{col}_raw", raw_text)
+    return df
+
+# ---------------------------------------------------------------------------
+# Junção dos payloads das faixas de um recorte alto (extração em faixas)
+# ---------------------------------------------------------------------------
+
+def _row_key(row: Any) -> str:
+    """Hash da linha com espaços/maiúsculas normalizados (mesma linha lida em duas faixas)."""
+    def norm(v):
+        if isinstance(v, str):
+            return " ".join(v.split()).casefold()
+        if isinstance(v, dict):
+            return {k: norm(x) for k, x in v.items()}
+        if isinstance(v, list):
+            return [norm(x) for x in v]
+        return v
+    blob = json.dumps(norm(row), sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(blob.encode("utf-8")).hexdigest()
+
+def _seam_overlap(prev: List[str], nxt: List[str]) -> int:
+    """Maior L com prev[-L:] == nxt[:L]: linhas da sobreposição entre duas faixas."""
+    for n in range(min(len(prev), len(nxt)), 0, -1):
+        if prev[-n:] == nxt[:n]:
+            return n
+    return 0
+
+def _table_key(table: Dict[str, Any]) -> Optional[str]:
+    name = table.get("name") or table.get("header_in_image")
+    return _safe_name(name) if name else None
+
+def merge_tile_payloads(payloads: List[Any]) -> Dict[str, Any]:
+    """
+    Junta os payloads das faixas de um recorte (de cima para baixo) num único
+    envelope {"tables", "project_data", "notes", "warnings"}, compatível com
+    consolidate_tables.
+
+    - tabelas com o mesmo nome viram uma só, na ordem em que aparecem;
+    - a primeira tabela de uma faixa sem cabeçalho visível continua a última
+      tabela da faixa anterior (tabela cortada na emenda);
+    - na emenda, as linhas repetidas pela sobreposição (sufixo da faixa de cima
+      igual ao prefixo da de baixo, comparados por hash) entram uma vez só.
+      Linhas iguais dentro de uma mesma faixa são preservadas.
+    """
+    merged: Dict[str, Any] = {"tables": [], "project_data": [], "notes": [], "warnings": []}
+    by_key: Dict[str, Dict[str, Any]] = {}
+    seen_extra = {k: set() for k in ("project_data", "notes", "warnings")}
+    prev_last = None  # última tabela da faixa anterior
+
+    for payload in payloads:
+        if isinstance(payload, list):
+            payload = {"tables": [{"rows": payload}]}
+        if not isinstance(payload, dict):
+            prev_last = None
+            continue
+
+        tables = [t for t in (payload.get("tables") or []) if isinstance(t, dict)]
+        last = None
+        for pos, table in enumerate(tables):
+            rows = table.get("rows") if isinstance(table.get("rows"), list) else []
+            key = _table_key(table)
+            target = by_key.get(key) if key else None
+            if target is None and pos == 0 and prev_last is not None and not table.get("header_in_image"):
+                target = prev_last
+
+            if target is None:
+                target = {k: v for k, v in table.items() if k != "rows"}
+                target["rows"] = list(rows)
+                merged["tables"].append(target)
+                if key:
+                    by_key[key] = target
+            else:
+                if pos == 0 and target is prev_last:
+                    skip = _seam_overlap([_row_key(r) for r in target["rows"]], [_row_key(r) for r in rows])
+                    rows = rows[skip:]
+                target["rows"].extend(rows)
+                cols = target.get("columns_detected")
+                new_cols = table.get("columns_detected")
+                if isinstance(cols, list) and isinstance(new_cols, list):
+                    target["columns_detected"] = cols + [c for c in new_cols if c not in cols]
+            last = target
+        prev_last = last
+
+        for field, seen in seen_extra.items():
+            items = payload.get(field)
+            if not isinstance(items, list):
+                continue
+            for item in items:
+                k = _row_key(item)
+                if k not in seen:
+                    seen.add(k)
+                    merged[field].append(item)
+    return merged
+
+# ---------------------------------------------------------------------------
+# Tabelas da camada de texto (pdfplumber) -> envelope do Gemini + nota de confiança
+# ---------------------------------------------------------------------------
+
+# Cabeçalho (sem acentos, minúsculo) -> coluna padrão; a ordem importa ("peso total" antes de "peso")
+_HEADER_SYNONYMS = [
+    ("peso_total_kg", ("peso total", "peso tot", "total (kg)", "total kg")),
+    ("peso_unidade_kg", ("peso unit", "peso un", "peso/un", "kg/un", "peso (kg/", "peso")),
+    ("qtd", ("qtd", "qtde", "quant", "qde", "qt.")),
+    ("dimensoes_unidade", ("dimens", "medida", "comprimento", "compr")),
+    ("descricao", ("descri", "especifica", "discrimina")),
+    ("material", ("material", "perfil", "produto")),
+]
+
+def _plain(text: str) -> str:
+    norm = unicodedata.normalize("NFKD", text or "")
+    return " ".join("".join(c for c in norm if not unicodedata.combining(c)).casefold().split())
+
+def _column_name(header: str) -> str:
+    plain = _plain(header).replace("_", " ")
+    for col, keys in _HEADER_SYNONYMS:
+        if any(k in plain for k in keys):
+            return col
+    return re.sub(r"[^a-z0-9]+", "_", plain).strip("_")
+
+def _cell(text: Optional[str]) -> str:
+    return " ".join((text or "").split())
+
+def text_tables_payload(tables: List[List[List[Optional[str]]]]) -> Tuple[Optional[Dict[str, Any]], float]:
+    """
+    Converte as tabelas da camada de texto (células do pdfplumber) no envelope
+    {"tables": [...]} do Gemini e dá uma nota 0..1, média ponderada pelas linhas:
+      0.4 preenchimento das células + 0.3 consistência das colunas por linha
+      + 0.3 cabeçalho reconhecido (SAFE_DEFAULT_COLUMNS).
+    Tabelas com menos de 2 colunas conhecidas no cabeçalho são descartadas.
+    Retorna (None, 0.0) se nenhuma tabela é utilizável.
+    """
+    out, scores, weights = [], [], []
+    for cells in tables or []:
+        rows = [[_cell(c) for c in r] for r in cells or [] if r and any(_cell(c) for c in r)]
+        title = None
+        if rows and len(rows[0]) >= 3 and sum(1 for c in rows[0] if c) == 1:
+            title = next(c for c in rows[0] if c)  # linha de título (célula mesclada)
+            rows = rows[1:]
+        if len(rows) < 2:
+            continue
+        header, body = rows[0], rows[1:]
+        width = max(len(r) for r in rows)
+        keep = [j for j in range(width) if any(j < len(r) and r[j] for r in rows)]
+        cols: List[str] = []
+        for j in keep:
+            name = _column_name(header[j] if j < len(header) else "") or f"col_{j}"
+            cols.append(name if name not in cols else f"{name}_{j}")
+        known = sum(1 for c in cols if c in SAFE_DEFAULT_COLUMNS)
+        if len(keep) < 2 or known < 2:
+            continue
+
+        filled = [sum(1 for j in keep if j < len(r) and r[j]) for r in body]
+        fill = sum(filled) / (len(keep) * len(body))
+        mode = Counter(filled).most_common(1)[0][0]
+        consistency = sum(1 for f in filled if abs(f - mode) <= 1) / len(body)
+        header_score = min(1.0, known / min(3, len(keep)))
+        scores.append(0.4 * fill + 0.3 * consistency + 0.3 * header_score)
+        weights.append(len(body))
+
+        out.append({
+            "header_in_image": title,
+            "name": _safe_name(re.sub(r"[^a-z0-9 ]+", " ", _plain(title))) if title else "tabela_texto",
+            "columns_detected": cols,
+            "rows": [
+                {c: (r[j] if j < len(r) and r[j] else None) for c, j in zip(cols, keep)}
+                for r in body
+            ],
+        })
+    if not out:
+        return None, 0.0
+    score = sum(s * w for s, w in zip(scores, weights)) / sum(weights)
+    return {"tables": out, "project_data": [], "notes": [], "warnings": []}, score
+
+if __name__ == "__main__":
+    # Benchmark: python -m app.result_utils [n_linhas]
+    import sys
+    import time
+
+    def _parse_row_wise(v, units=None):
+        # Referência linha a linha (apply), como as rotinas de consolidação faziam
+        if v is None or (isinstance(v, float) and v != v):
+            return float("nan")
+        m = re.match(_NUM_UNIT_PAT, str(v).strip().lower())
+        if not m:
+            return float("nan")
+        num, unit = re.sub(r"[.,]$", "", m.group("num")), m.group("unit") or ""
+        if "," in num or re.fullmatch(_THOUSANDS_DOT_PAT, num):
+            num = num.replace(".", "")
+        try:
+            value = float(num.replace(",", "."))
+        except ValueError:
+            return float("nan")
+        if units is None:
+            return value
+        return value * units[unit] if unit in units else float("nan")
+
+    n_rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    samples = {
+        "qtd": ["12 pç", "1.234", "3", "10 un", "1,5 m", "-", None, "7 pcs"],
+        "peso_total_kg": ["1.234,5", "3,2 kg", "3200 g", "1,5 t", "12.50", "2,5 kg/m", "", None],
+        "dimensoes_comprimento": ["6,00 m", "600 mm", "60 cm", "600", "L50x50", None, "1.200", "1,2m"],
+    }
+    df = pd.DataFrame({"material": "Perfil W150", **{
+        c: (vals * (n_rows // len(vals) + 1))[:n_rows] for c, vals in samples.items()}})
+    print(f"{n_rows} linhas, colunas: {', '.join(samples)}")
+
+    t0 = time.perf_counter()
+    out = normalize_bom_columns(df)
+    dt_vec = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    ref = {c: df[c].apply(_parse_row_wise, units=u) for c, u in
+           (("qtd", None), ("peso_total_kg", _MASS_UNITS), ("dimensoes_comprimento", _LENGTH_UNITS))}
+    dt_row = time.perf_counter() - t0
+
+    same = all(out[c].astype("float64").equals(ref[c].astype("float64")) for c in ref)
+    print(f"  vetorizado (normalize_bom_columns) {dt_vec:7.2f} s")
+    print(f"  linha a linha (apply)              {dt_row:7.2f} s   ({dt_row / dt_vec:.1f}x)   resultados iguais: {same}")
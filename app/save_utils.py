@@ -1,8 +1,13 @@
+import csv
+import json
+import math
 from pathlib import Path
 from PIL import Image
 from datetime import datetime
+from typing import Any, Dict, List, Optional
 from app.paths import CROPS_DIR, OUT_DIR
 from app.pdf_utils import bbox_rel_to_px, draw_overlay
+from app.result_utils import SAFE_DEFAULT_COLUMNS
 
 def sanitize_stem(stem: str) -> str:
     # remove caracteres ruins para nome de arquivo
@@ -11,10 +16,12 @@ def sanitize_stem(stem: str) -> str:
         stem = stem.replace(ch, "_")
     return stem.strip()
 
-def save_crop_image(img_hd: Image.Image, bbox_rel: dict, base_name: str, page_index: int) -> Path:
+def save_crop_image(img_hd: Image.Image, bbox_rel: dict, base_name: str, page_index: int,
+                    dpi: Optional[int] = None) -> Path:
     """
     Corta na imagem HD usando bbox_rel (frações) e salva JPG.
     Também salva um overlay de debug sobre a imagem HD.
+    dpi (se informado) fica gravado no JPG (densidade JFIF).
     """
     # Sanitizar nome do arquivo
     clean_name = sanitize_stem(base_name)
@@ -25,7 +32,7 @@ def save_crop_image(img_hd: Image.Image, bbox_rel: dict, base_name: str, page_in
     
     CROPS_DIR.mkdir(parents=True, exist_ok=True)
     out = CROPS_DIR / f"{clean_name}_p{page_index}_crop.jpg"
-    crop.save(out, quality=95, optimize=True)
+    crop.save(out, quality=95, optimize=True, **_dpi_kw(dpi))
     
     # overlay debug em HD
     dbg = draw_overlay(img_hd, bbox_rel)
@@ -34,3 +41,303 @@ def save_crop_image(img_hd: Image.Image, bbox_rel: dict, base_name: str, page_in
     dbg.save(dbg_out, quality=85)
     
     return out
+
+def save_region_crop(crop: Image.Image, base_name: str, page_index: int, dpi: Optional[int] = None) -> Path:
+    """
+    Salva um recorte já rasterizado (render por região) como JPG.
+    Sem a página inteira em memória, não há overlay de debug.
+    """
+    clean_name = sanitize_stem(base_name)
+    CROPS_DIR.mkdir(parents=True, exist_ok=True)
+    out = CROPS_DIR / f"{clean_name}_p{page_index}_crop.jpg"
+    crop.save(out, quality=95, optimize=True, **_dpi_kw(dpi))
+    return out
+
+def _dpi_kw(dpi: Optional[int]) -> dict:
+    return {"dpi": (dpi, dpi)} if dpi else {}
+
+# ---------------------------------------------------------------------------
+# Gravação incremental de linhas (lotes headless): memória constante
+# ---------------------------------------------------------------------------
+STREAM_META_COLUMNS = ["_table_name", "_source_pdf", "_page_idx"]
+STREAM_COLUMNS = SAFE_DEFAULT_COLUMNS + STREAM_META_COLUMNS + ["_extra"]
+
+def _clean_value(v: Any) -> Any:
+    if isinstance(v, float) and math.isnan(v):
+        return None
+    return v
+
+def _to_fixed_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Projeta a linha nas colunas fixas; colunas extras vão como JSON em _extra."""
+    fixed = {}
+    for c in SAFE_DEFAULT_COLUMNS + STREAM_META_COLUMNS:
+        v = _clean_value(row.get(c))
+        fixed[c] = v if v is None or c == "_page_idx" else str(v)
+    extra = {k: _clean_value(v) for k, v in row.items() if k not in fixed}
+    extra = {k: v for k, v in extra.items() if v is not None}
+    fixed["_extra"] = json.dumps(extra, ensure_ascii=False, default=str) if extra else None
+    return fixed
+
+class StreamingRowWriter:
+    """
+    Grava linhas à medida que chegam em JSONL, CSV ou Parquet.
+    JSONL preserva as linhas como vieram; CSV/Parquet usam o esquema fixo
+    STREAM_COLUMNS (cabeçalho não pode mudar no meio do arquivo).
+    """
+
+    FORMATS = ("jsonl", "csv", "parquet")
+
+    def __init__(self, path: Path, fmt: str = "jsonl"):
+        if fmt not in self.FORMATS:
+            raise ValueError(f"Formato não suportado: {fmt}")
+        self.path = Path(path)
+        self.fmt = fmt
+        self.rows_written = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._fh = None
+        self._csv = None
+        self._pq = None
+        if fmt == "jsonl":
+            self._fh = open(self.path, "w", encoding="utf-8")
+        elif fmt == "csv":
+            self._fh = open(self.path, "w", encoding="utf-8-sig", newline="")
+            self._csv = csv.DictWriter(self._fh, fieldnames=STREAM_COLUMNS)
+            self._csv.writeheader()
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            self._pa = pa
+            self._schema = pa.schema(
+                [(c, pa.int64() if c == "_page_idx" else pa.string()) for c in STREAM_COLUMNS]
+            )
+            self._pq = pq.ParquetWriter(str(self.path), self._schema)
+
+    def write(self, rows: List[Dict[str, Any]]) -> None:
+        if not rows:
+            return
+        if self.fmt == "jsonl":
+            for r in rows:
+                clean = {k: _clean_value(v) for k, v in r.items()}
+                self._fh.write(json.dumps(clean, ensure_ascii=False, default=str) + "\n")
+            self._fh.flush()
+        elif self.fmt == "csv":
+            self._csv.writerows(_to_fixed_row(r) for r in rows)
+            self._fh.flush()
+        else:
+            fixed = [_to_fixed_row(r) for r in rows]
+            table = self._pa.Table.from_pylist(fixed, schema=self._schema)
+            self._pq.write_table(table)  # um row group por chamada
+        self.rows_written += len(rows)
+
+    def close(self) -> None:
+        if self._pq is not None:
+            self._pq.close()
+            self._pq = None
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# ---------------------------------------------------------------------------
+# Exportação Arrow (Parquet / Arrow IPC) com tipos preservados
+# ---------------------------------------------------------------------------
+ARROW_PARTITION_COLUMNS = ["_source_pdf", "_table_name"]
+# Valor da partição quando a linha não tem arquivo/tabela (partição nula quebra pd.read_parquet do dataset)
+_PARTITION_DEFAULTS = {"_source_pdf": "lote.pdf", "_table_name": "tabela"}
+ARROW_FORMATS = {  # formato -> (extensão, mime, formato do pyarrow.dataset)
+    "parquet": (".parquet", "application/vnd.apache.parquet", "parquet"),
+    "arrow": (".arrow", "application/vnd.apache.arrow.file", "ipc"),
+}
+
+def _pandas_column(values):
+    """Coluna Arrow de uma Series; tipos misturados (ex.: 3 e '4 pç') viram texto, como aggregate._column."""
+    import pyarrow as pa
+    try:
+        return pa.array(values, from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array(values.where(values.isna(), values.astype(str)), type=pa.string(), from_pandas=True)
+
+def _arrow_table(data):
+    """pa.Table a partir de DataFrame, lista de dicts ou Table; colunas só com nulos viram texto."""
+    import pyarrow as pa
+    if isinstance(data, pa.Table):
+        table = data
+    elif isinstance(data, list):
+        from app.aggregate import _column
+        names: Dict[str, None] = {}
+        for r in data:
+            names.update(dict.fromkeys(r))
+        table = pa.table({c: _column([r.get(c) for r in data]) for c in names})
+    else:
+        arrays = [_pandas_column(data.iloc[:, i]) for i in range(data.shape[1])]
+        table = pa.Table.from_arrays(arrays, names=[str(c) for c in data.columns])
+    for i, field in enumerate(table.schema):
+        # large_string (dtype "str" do pandas recente) -> string: mesmo esquema entre partes
+        if pa.types.is_null(field.type) or pa.types.is_large_string(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(pa.string()))
+    return table.replace_schema_metadata(None)
+
+def _partition_runs(table, by: List[str]):
+    """
+    Fatias contíguas com a mesma chave de partição (o agregado já vem agrupado por
+    arquivo/tabela), juntando vizinhas até EXPORT_ROW_GROUP_ROWS linhas: uma partição
+    só é dividida entre row groups se for maior que isso (row groups minúsculos
+    deixam a leitura lenta).
+    """
+    from app.settings import EXPORT_ROW_GROUP_ROWS
+    n = table.num_rows
+    if not n:
+        return
+    import numpy as np
+    change = np.zeros(n, dtype=bool)
+    change[0] = True
+    for c in by:
+        if c in table.column_names:
+            v = table.column(c).to_pandas().astype(object).fillna("\0").to_numpy()
+            change[1:] |= v[1:] != v[:-1]
+    bounds = np.flatnonzero(change).tolist() + [n]
+    start = 0
+    for a, b in zip(bounds, bounds[1:]):
+        if a > start and b - start > EXPORT_ROW_GROUP_ROWS:
+            yield table.slice(start, a - start)
+            start = a
+    yield table.slice(start, n - start)
+
+def write_arrow_file(data, dest, fmt: str = "parquet", partition_by: List[str] = ARROW_PARTITION_COLUMNS):
+    """
+    Grava um arquivo Parquet ou Arrow IPC com row groups (Parquet) / record batches
+    (IPC) alinhados às partições _source_pdf/_table_name. dest: caminho ou buffer binário.
+    """
+    if fmt not in ARROW_FORMATS:
+        raise ValueError(f"Formato não suportado: {fmt}")
+    import pyarrow as pa
+    table = _arrow_table(data)
+    if isinstance(dest, (str, Path)):
+        Path(dest).parent.mkdir(parents=True, exist_ok=True)
+        dest = str(dest)
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        with pq.ParquetWriter(dest, table.schema) as writer:
+            for part in _partition_runs(table, partition_by):
+                writer.write_table(part, row_group_size=max(part.num_rows, 1))
+    else:
+        with pa.ipc.new_file(dest, table.schema) as writer:
+            for part in _partition_runs(table, partition_by):
+                writer.write_table(part, max_chunksize=max(part.num_rows, 1))
+    return dest
+
+def arrow_file_bytes(data, fmt: str = "parquet", partition_by: List[str] = ARROW_PARTITION_COLUMNS) -> bytes:
+    """Mesmo conteúdo de write_arrow_file, em memória (para st.download_button)."""
+    import pyarrow as pa
+    sink = pa.BufferOutputStream()
+    write_arrow_file(data, sink, fmt, partition_by)
+    return sink.getvalue().to_pybytes()
+
+def dataset_schema(partition_by: List[str] = ARROW_PARTITION_COLUMNS):
+    """
+    Esquema fixo do dataset particionado: o pyarrow descobre o esquema pelo primeiro
+    arquivo de parte, então toda parte precisa das mesmas colunas e tipos.
+    SAFE_DEFAULT_COLUMNS (qtd/pesos/dimensões em float64 + <coluna>_raw quando
+    NORMALIZE_NUMERIC_COLUMNS), _page_idx, colunas de partição e as demais colunas
+    como JSON em _extra (mesma ideia de STREAM_COLUMNS).
+    """
+    import pyarrow as pa
+    from app.settings import NORMALIZE_NUMERIC_COLUMNS
+    from app.result_utils import _numeric_kind
+    fields = []
+    for c in SAFE_DEFAULT_COLUMNS:
+        if NORMALIZE_NUMERIC_COLUMNS and _numeric_kind(c):
+            fields += [(c, pa.float64()), (f"{c}_raw", pa.string())]
+        else:
+            fields.append((c, pa.string()))
+    fields.append(("_page_idx", pa.int64()))
+    fields += [(c, pa.string()) for c in partition_by]
+    fields.append(("_extra", pa.string()))
+    return pa.schema(fields)
+
+def _dataset_table(data, schema):
+    """Projeta as linhas no esquema fixo do dataset (colunas ausentes -> nulo, sobras -> _extra)."""
+    import pandas as pd
+    import pyarrow as pa
+    if isinstance(data, pa.Table):
+        df = data.to_pandas()
+    elif isinstance(data, list):
+        df = pd.DataFrame(data)
+    else:
+        df = data
+    df = df.reset_index(drop=True)
+    arrays = []
+    for field in schema:
+        if field.name == "_extra":
+            extra_cols = [c for c in df.columns if c not in schema.names]
+            if not extra_cols:
+                arrays.append(pa.nulls(len(df), pa.string()))
+                continue
+            extra = [{k: _clean_value(v) for k, v in r.items()} for r in df[extra_cols].to_dict("records")]
+            extra = [{k: v for k, v in r.items() if v is not None} for r in extra]
+            arrays.append(pa.array(
+                [json.dumps(r, ensure_ascii=False, default=str) if r else None for r in extra], pa.string()
+            ))
+            continue
+        name = field.name
+        if name not in df.columns and name.endswith("_raw") and name[:-4] in df.columns:
+            name = name[:-4]  # linhas não normalizadas: o texto original vai para <coluna>_raw
+        if name not in df.columns:
+            arrays.append(pa.nulls(len(df), field.type))
+            continue
+        col = df[name]
+        if pa.types.is_string(field.type):
+            col = col.where(col.isna(), col.astype(str))
+        else:
+            col = pd.to_numeric(col, errors="coerce")
+            if pa.types.is_integer(field.type):
+                col = col.astype("Int64")
+        arrays.append(pa.array(col, type=field.type, from_pandas=True))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+class PartitionedDatasetWriter:
+    """
+    Dataset particionado no estilo hive, acrescido à medida que os arquivos terminam:
+
+        base_dir/source_pdf=<pdf>/table_name=<tabela>/part-<n>-0.parquet
+
+    As colunas de partição perdem o "_" inicial (o pyarrow ignora diretórios
+    começados por "_"). Cada write() gera novos arquivos de parte (nada é
+    regravado), todos com o esquema fixo de dataset_schema: uma coluna que só
+    aparece em arquivos posteriores vai em _extra em vez de sumir na leitura.
+    Leitura: pd.read_parquet(base_dir) ou pyarrow.dataset.dataset(base_dir, partitioning="hive").
+    """
+
+    def __init__(self, base_dir: Path, fmt: str = "parquet", partition_by: List[str] = ARROW_PARTITION_COLUMNS):
+        if fmt not in ARROW_FORMATS:
+            raise ValueError(f"Formato não suportado: {fmt}")
+        self.base_dir = Path(base_dir)
+        self.fmt = fmt
+        self.partition_by = list(partition_by)
+        self.partition_names = [c.lstrip("_") for c in self.partition_by]
+        self.schema = dataset_schema(self.partition_by)
+        self.rows_written = 0
+        self._parts = 0
+
+    def write(self, data) -> None:
+        import pyarrow.dataset as ds
+        table = _dataset_table(data, self.schema)
+        if not table.num_rows:
+            return
+        for c, name in zip(self.partition_by, self.partition_names):
+            col = table.column(c).fill_null(_PARTITION_DEFAULTS.get(c, "sem_valor"))
+            table = table.set_column(table.column_names.index(c), name, col)
+        ext, _, ds_format = ARROW_FORMATS[self.fmt]
+        ds.write_dataset(
+            table, self.base_dir, format=ds_format,
+            partitioning=self.partition_names, partitioning_flavor="hive",
+            basename_template=f"part-{self._parts}-{{i}}{ext}",
+            existing_data_behavior="overwrite_or_ignore",
+        )
+        self._parts += 1
+        self.rows_written += table.num_rows
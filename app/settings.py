@@ -5,3 +5,74 @@ Configurações globais da aplicação
 # Configurações de DPI para processamento de imagens
 PROCESS_DPI = 180  # DPI para processamento no Gemini
 FALLBACK_DPI = 150  # DPI de fallback se o principal falhar
+
+# DPI adaptativo: escolhe o DPI pelo menor texto dentro da bbox (camada de texto do PDF);
+# sem camada de texto (escaneado) usa PROCESS_DPI. Sempre limitado pelo orçamento de pixels.
+ADAPTIVE_DPI = True
+DPI_TARGET_GLYPH_PX = 24      # altura em pixels da linha do menor texto (caixa ascendente+descendente; 8 pt ~ 190 DPI)
+DPI_MIN = 120
+DPI_MAX = 400
+DPI_MAX_MEGAPIXELS = 24       # orçamento de pixels do recorte renderizado
+
+# Cache de renderização de páginas (memória + disco)
+RENDER_CACHE_MEM_MB = 768    # limite do LRU em memória (pixels descomprimidos)
+RENDER_CACHE_DISK_MB = 2048  # limite do cache em disco (PNGs em cache/render)
+
+# Detecção de tabelas em várias páginas: processos em paralelo
+DETECT_TABLES_WORKERS = 2
+
+# Renderiza apenas a região do preset (clip no pypdfium2) em vez da página inteira
+CLIP_RENDER = True
+
+# Caminho rápido: tabela na camada de texto do PDF (vetorial) dispensa o Gemini
+TEXT_LAYER_FASTPATH = True
+TEXT_LAYER_MIN_SCORE = 0.8    # nota 0..1: preenchimento, consistência das colunas e cabeçalho conhecido
+
+# Processamento em lote: nº de PDFs em paralelo (I/O com o Gemini domina o tempo)
+BATCH_CONCURRENCY = 4
+# Páginas de um mesmo PDF em paralelo (multiplica BATCH_CONCURRENCY) e filtro padrão
+PAGE_CONCURRENCY = 2
+DEFAULT_PAGE_FILTER = "0"
+
+# Cache de respostas do Gemini (chave: pixels do crop + prompt + modelo)
+RESPONSE_CACHE_TTL_DAYS = 30
+RESPONSE_CACHE_DISK_MB = 256
+
+# Presets: "json" (config/presets.json) ou "sqlite" (config/presets.db, modo WAL;
+# na primeira abertura importa o presets.json). use_count é gravado em lote.
+PRESETS_BACKEND = "json"
+PRESET_USE_FLUSH_N = 50
+PRESET_USE_FLUSH_S = 30
+
+# Índice de documentos já vistos (fingerprint -> preset, modelo, resultados)
+DOC_INDEX_MAX_ENTRIES = 5000
+
+# Validação da chave Gemini: revalida em background após este intervalo
+KEY_VALIDATION_TTL_S = 3600
+
+# Pipeline em estágios (render -> encode -> extração -> parse), cada um com sua concorrência
+STAGE_RENDER_WORKERS = 2      # processos de rasterização (CPU)
+STAGE_ENCODE_WORKERS = 2      # threads de preparo do crop / consulta ao cache
+STAGE_EXTRACT_CONCURRENCY = 8 # chamadas simultâneas ao Gemini (asyncio)
+STAGE_PARSE_WORKERS = 2       # threads de parse/normalização
+STAGE_QUEUE_SIZE = 8          # itens máximos esperando entre dois estágios
+
+# Codificação do crop enviado ao Gemini (sem isso o SDK manda JPEG qualidade 75)
+UPLOAD_FORMAT = "auto"        # auto | png | webp | jpeg
+UPLOAD_MAX_KB = 1536          # orçamento de bytes por imagem enviada
+UPLOAD_QUANTIZE = True        # desenhos de linha com poucas cores -> paleta (PNG 8 bits)
+UPLOAD_JPEG_QUALITY = 92      # JPEG: qualidade inicial...
+UPLOAD_JPEG_MIN_QUALITY = 75  # ...e mínima antes de reduzir a resolução
+
+# Recortes altos: extração em faixas horizontais sobrepostas, em paralelo
+TILE_MODE = "auto"            # auto | on | off
+TILE_MIN_HEIGHT_PX = 2400     # auto: só divide recortes mais altos que isso e mais altos que largos
+TILE_HEIGHT_PX = 1400         # altura alvo de cada faixa
+TILE_OVERLAP_PX = 96          # sobreposição mínima entre faixas vizinhas
+TILE_CONCURRENCY = 4          # faixas de um recorte em paralelo
+
+# Exportação Parquet/Arrow: partições (arquivo/tabela) contíguas agrupadas em row groups deste tamanho
+EXPORT_ROW_GROUP_ROWS = 10000
+
+# Após consolidar as tabelas: qtd/pesos/dimensoes_* viram números (texto original em <coluna>_raw)
+NORMALIZE_NUMERIC_COLUMNS = True
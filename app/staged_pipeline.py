@@ -0,0 +1,210 @@
+# app/staged_pipeline.py
+"""
+Pipeline em estágios para lotes: o mesmo percurso de process_pdf_once, mas com
+rasterização (CPU) e espera de rede (Gemini) sobrepostas.
+
+    render/crop (processos) -> encode (threads: cache + PNG/WebP/JPEG) -> extração (asyncio) -> parse/normalização (threads)
+
+Os estágios são ligados por filas limitadas (backpressure): um estágio lento
+faz os anteriores pararem em vez de acumular crops na memória.
+"""
+from __future__ import annotations
+import asyncio
+import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from app.settings import (
+    STAGE_RENDER_WORKERS,
+    STAGE_ENCODE_WORKERS,
+    STAGE_EXTRACT_CONCURRENCY,
+    STAGE_PARSE_WORKERS,
+    STAGE_QUEUE_SIZE,
+    TEXT_LAYER_FASTPATH,
+)
+
+_DONE = object()  # sentinela de fim de fila
+
+def _pickable_source(pdf_file) -> Any:
+    """Caminho continua caminho; UploadedFile/file-like vira bytes (vai para outro processo)."""
+    if isinstance(pdf_file, (str, Path)):
+        return str(pdf_file)
+    if hasattr(pdf_file, "getvalue"):
+        return pdf_file.getvalue()
+    pdf_file.seek(0)
+    return pdf_file.read()
+
+async def _run_stage(fn, inq: asyncio.Queue, outq: asyncio.Queue, workers: int, next_workers: int) -> None:
+    """N consumidores de inq; jobs com erro passam direto. Ao fim, avisa o próximo estágio."""
+    async def worker():
+        while True:
+            job = await inq.get()
+            if job is _DONE:
+                return
+            if job["error"] is None:
+                try:
+                    await fn(job)
+                except Exception as e:
+                    job["error"] = e
+            await outq.put(job)
+
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    for _ in range(next_workers):
+        await outq.put(_DONE)
+
+async def _run_async(
+    items: Iterable[Tuple[Any, int]],
+    *,
+    bbox_rel: Dict[str, float],
+    api_key: str,
+    on_result: Callable[[int, Tuple[Any, int], Optional[Dict[str, Any]], Optional[BaseException]], None],
+    save_artifacts: bool,
+    use_cache: bool,
+    dpi: Optional[int],
+    render_workers: int,
+    encode_workers: int,
+    extract_concurrency: int,
+    parse_workers: int,
+    queue_size: int,
+    text_layer: bool,
+    backend=None,
+) -> int:
+    from app.gemini_client import AsyncGeminiClient, SHARED_PROMPT, DEFAULT_MODEL, _ensure_pil, _encode
+    from app.json_utils import extract_json
+    from app.response_cache import response_cache, response_key
+    from app.pdf_utils import render_crop_job, extract_text_tables
+    from app.pipeline import build_result, route_text_tables
+
+    loop = asyncio.get_running_loop()
+    client = AsyncGeminiClient(api_key, max_concurrency=extract_concurrency, backend=backend)
+    q_render, q_encode, q_extract, q_parse, q_out = (asyncio.Queue(maxsize=queue_size) for _ in range(5))
+
+    with ProcessPoolExecutor(max_workers=render_workers) as cpu_pool, \
+         ThreadPoolExecutor(max_workers=encode_workers + parse_workers, thread_name_prefix="stage") as io_pool:
+
+        async def render(job):
+            pdf_name = job["pdf_name"] = getattr(job["pdf_file"], "name", str(job["pdf_file"]))
+            src = _pickable_source(job["pdf_file"])
+            if text_layer:
+                # Tabela limpa na camada de texto: nem rasteriza nem chama o Gemini
+                try:
+                    tables = await loop.run_in_executor(
+                        cpu_pool, extract_text_tables, src, [job["page_index"]], bbox_rel,
+                    )
+                except Exception as e:
+                    print(f"Aviso: camada de texto indisponível, usando o Gemini: {e}")
+                    tables = {}
+                payload = route_text_tables(tables).get(job["page_index"])
+                if payload is not None:
+                    job["payload"], job["source"], job["cached"] = payload, "text_layer", True
+                    job["raw_text"] = json.dumps(payload, ensure_ascii=False)
+                    return
+            job["crop"], job["crop_path"], job["dpi_info"] = await loop.run_in_executor(
+                cpu_pool, render_crop_job,
+                src, job["page_index"], bbox_rel, dpi,
+                Path(pdf_name).stem, save_artifacts,
+            )
+
+        def _encode_sync(job):
+            if job["source"] == "text_layer":
+                return
+            job["crop"] = _ensure_pil(job["crop"])
+            if use_cache:
+                job["cache_key"] = response_key(job["crop"], SHARED_PROMPT, DEFAULT_MODEL)
+                entry = response_cache.get(job["cache_key"])
+                if entry is not None:
+                    job["raw_text"], job["payload"], job["cached"] = entry["raw_text"], entry["payload"], True
+            if not job["cached"]:
+                job["encoded"] = _encode(job["crop"])
+            job["crop"] = None  # daqui em diante só os bytes codificados
+
+        async def encode(job):
+            await loop.run_in_executor(io_pool, _encode_sync, job)
+
+        async def extract(job):
+            if not job["cached"]:
+                job["raw_text"] = await client.generate(job["encoded"], SHARED_PROMPT, DEFAULT_MODEL)
+            job["encoded"] = None
+
+        def _parse_sync(job):
+            if not job["cached"]:
+                job["payload"], repaired = extract_json(job["raw_text"])
+                if job["cache_key"] and job["payload"] is not None and not repaired:
+                    response_cache.put(job["cache_key"], model_name=DEFAULT_MODEL,
+                                       raw_text=job["raw_text"], payload=job["payload"])
+            job["result"] = build_result(
+                pdf_name=job["pdf_name"], page_index=job["page_index"], bbox_rel=bbox_rel,
+                raw_text=job["raw_text"], payload=job["payload"], crop_path=job["crop_path"],
+                dpi_info=job["dpi_info"], source=job["source"],
+            )
+
+        async def parse(job):
+            await loop.run_in_executor(io_pool, _parse_sync, job)
+
+        async def produce():
+            for i, (pdf_file, page_index) in enumerate(items):
+                await q_render.put({
+                    "index": i, "item": (pdf_file, page_index), "pdf_file": pdf_file,
+                    "page_index": page_index, "pdf_name": None, "crop": None, "crop_path": None, "dpi_info": None,
+                    "cache_key": None, "cached": False, "encoded": None, "raw_text": "", "payload": None,
+                    "source": "gemini",
+                    "result": None, "error": None,
+                })
+            for _ in range(render_workers):
+                await q_render.put(_DONE)
+
+        done_count = 0
+
+        async def consume():
+            nonlocal done_count
+            while True:
+                job = await q_out.get()
+                if job is _DONE:
+                    return
+                done_count += 1
+                on_result(job["index"], job["item"], job["result"], job["error"])
+
+        await asyncio.gather(
+            produce(),
+            _run_stage(render, q_render, q_encode, render_workers, encode_workers),
+            _run_stage(encode, q_encode, q_extract, encode_workers, extract_concurrency),
+            _run_stage(extract, q_extract, q_parse, extract_concurrency, parse_workers),
+            _run_stage(parse, q_parse, q_out, parse_workers, 1),
+            consume(),
+        )
+    return done_count
+
+def run_staged(
+    items: Iterable[Tuple[Any, int]],
+    *,
+    bbox_rel: Dict[str, float],
+    api_key: str,
+    on_result: Callable[[int, Tuple[Any, int], Optional[Dict[str, Any]], Optional[BaseException]], None],
+    save_artifacts: bool = True,
+    use_cache: bool = True,
+    dpi: Optional[int] = None,
+    render_workers: int = STAGE_RENDER_WORKERS,
+    encode_workers: int = STAGE_ENCODE_WORKERS,
+    extract_concurrency: int = STAGE_EXTRACT_CONCURRENCY,
+    parse_workers: int = STAGE_PARSE_WORKERS,
+    queue_size: int = STAGE_QUEUE_SIZE,
+    text_layer: bool = TEXT_LAYER_FASTPATH,
+    backend=None,
+) -> int:
+    """
+    Processa itens (pdf_file, page_index) pelos quatro estágios.
+    on_result(index, item, result, error) é chamado na thread de quem chamou,
+    na ordem de conclusão, com o mesmo dicionário de process_pdf_once.
+    dpi=None: DPI adaptativo por recorte (pdf_utils.choose_dpi).
+    text_layer: páginas com tabela limpa na camada de texto não vão ao Gemini.
+    Retorna o nº de itens processados. Nada é retido após o callback.
+    """
+    return asyncio.run(_run_async(
+        items,
+        bbox_rel=bbox_rel, api_key=api_key, on_result=on_result,
+        save_artifacts=save_artifacts, use_cache=use_cache, dpi=dpi,
+        render_workers=max(1, render_workers), encode_workers=max(1, encode_workers),
+        extract_concurrency=max(1, extract_concurrency), parse_workers=max(1, parse_workers),
+        queue_size=max(1, queue_size), text_layer=text_layer, backend=backend,
+    ))
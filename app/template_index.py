@@ -0,0 +1,143 @@
+# app/template_index.py
+"""
+Escolha automática de preset por documento.
+
+As características da 1ª página (texto, fingerprint de leiaute, sha256) são
+extraídas uma vez por documento; o índice dos presets é montado uma vez por
+versão da lista de presets. A escolha é só consulta em dicts:
+
+    1. preset 'document' do próprio arquivo (fingerprint; presets antigos: nome)
+    2. preset usado da última vez neste arquivo (índice de documentos)
+    3. preset 'template' do mesmo leiaute de prancha
+    4. preset 'template' cujo modelo aparece no texto da 1ª página
+"""
+from __future__ import annotations
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+# Padrões que identificam o modelo no texto da 1ª página (compilados uma vez)
+_TEMPLATE_PATTERNS = tuple(re.compile(p, re.IGNORECASE) for p in (
+    r"modelo\s*[:.]?\s*([a-z0-9][a-z0-9 \t]*)",
+    r"template\s*[:.]?\s*([a-z0-9][a-z0-9 \t]*)",
+    r"formul[aá]rio\s*[:.]?\s*([a-z0-9][a-z0-9 \t]*)",
+    r"vale\s*v(\d+)",
+    r"vers[aã]o\s*[:.]?\s*([a-z0-9][a-z0-9 \t]*)",
+))
+_FEATURES_MAX = 64
+
+def match_template_id(text: str) -> Optional[str]:
+    """Identificador do modelo pelo primeiro padrão que casar (como PDFUtils.get_template_id)."""
+    for pattern in _TEMPLATE_PATTERNS:
+        m = pattern.search(text or "")
+        if m:
+            return m.group(1).strip()
+    return None
+
+def template_key(name: Optional[str]) -> str:
+    """Forma canônica do nome do modelo: sem acentos, minúsculas, espaços simples."""
+    from app.pdf_utils import _fold
+    return " ".join(_fold(name or "").split())
+
+def _fold_lines(text: str) -> str:
+    from app.pdf_utils import _fold
+    return "\n".join(" ".join(line.split()) for line in _fold(text).splitlines())
+
+_features: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_features_lock = threading.Lock()
+
+def document_features(pdf_ref, name: Optional[str] = None) -> Dict[str, Any]:
+    """
+    {"fingerprint", "layout", "text", "template_id", "name"} da 1ª página, em cache
+    por sha256 do documento (uploads repetidos e reruns não reabrem o PDF).
+    """
+    from app.pdf_utils import pdf_content_hash, first_page_features
+    fp = pdf_content_hash(pdf_ref)
+    with _features_lock:
+        feats = _features.get(fp)
+        if feats is not None:
+            _features.move_to_end(fp)
+            return dict(feats, name=name or feats["name"])
+    feats = first_page_features(pdf_ref)
+    feats["template_id"] = match_template_id(feats["text"])
+    feats["text"] = _fold_lines(feats["text"])
+    feats["name"] = name or getattr(pdf_ref, "name", None) or (pdf_ref if isinstance(pdf_ref, str) else None)
+    with _features_lock:
+        _features[fp] = feats
+        while len(_features) > _FEATURES_MAX:
+            _features.popitem(last=False)
+    return dict(feats)
+
+class TemplateIndex:
+    """Presets ativos indexados por fingerprint, nome do PDF, leiaute e modelo."""
+
+    def __init__(self, presets: List[Dict]):
+        self.by_id: Dict[str, Dict] = {}
+        self.by_fingerprint: Dict[str, Dict] = {}
+        self.by_pdf_name: Dict[str, Dict] = {}
+        self.by_layout: Dict[str, Dict] = {}
+        self.by_template: Dict[str, Dict] = {}
+        for p in presets:
+            if not p.get("active", True) or not p.get("bbox_rel"):
+                continue
+            self.by_id[p["id"]] = p
+            scope = p.get("scope", "global")
+            if scope == "document":
+                if p.get("document_fingerprint"):
+                    self.by_fingerprint.setdefault(p["document_fingerprint"], p)
+                if p.get("pdf_name"):
+                    self.by_pdf_name.setdefault(p["pdf_name"], p)
+            elif scope == "template":
+                if p.get("layout_fingerprint"):
+                    self.by_layout.setdefault(p["layout_fingerprint"], p)
+                key = template_key(p.get("template_id") or p.get("template_name"))
+                if key:
+                    self.by_template.setdefault(key, p)
+        # Uma única busca no texto encontra qualquer modelo conhecido (nomes mais longos primeiro)
+        names = sorted(self.by_template, key=len, reverse=True)
+        self._names_re = re.compile(r"\b(?:" + "|".join(map(re.escape, names)) + r")\b") if names else None
+        self._text_hits: Dict[str, Optional[str]] = {}  # fingerprint -> modelo encontrado no texto
+
+    def match(self, features: Dict[str, Any]) -> Tuple[Optional[Dict], str]:
+        """(preset, motivo) para o documento; (None, "") se nada casar."""
+        fp = features.get("fingerprint")
+        p = self.by_fingerprint.get(fp) or self.by_pdf_name.get(features.get("name") or "")
+        if p:
+            return p, "documento"
+        if fp:
+            from app.doc_index import doc_index
+            entry = doc_index.get(fp)
+            p = self.by_id.get((entry or {}).get("preset_id"))
+            if p:
+                return p, "usado antes neste documento"
+        p = self.by_layout.get(features.get("layout"))
+        if p:
+            return p, "mesmo leiaute"
+        p = self.by_template.get(template_key(features.get("template_id")))
+        if p is None and self._names_re is not None:
+            if fp not in self._text_hits:
+                m = self._names_re.search(features.get("text") or "")
+                self._text_hits[fp] = m.group(0) if m else None
+            p = self.by_template.get(self._text_hits[fp])
+        if p:
+            return p, "modelo no texto"
+        return None, ""
+
+_index: Optional[TemplateIndex] = None
+_index_sig = None
+_index_lock = threading.Lock()
+
+def get_template_index(presets: List[Dict]) -> TemplateIndex:
+    """Índice da lista de presets; remontado só quando o presets.json é relido/gravado."""
+    from app.presets import presets_version
+    global _index, _index_sig
+    sig = (presets_version(), tuple(p.get("id") for p in presets))
+    with _index_lock:
+        if _index is None or sig != _index_sig:
+            _index, _index_sig = TemplateIndex(presets), sig
+        return _index
+
+def auto_preset(pdf_ref, presets: List[Dict], name: Optional[str] = None) -> Tuple[Optional[Dict], str]:
+    """Preset escolhido automaticamente para o documento (ou (None, ""))."""
+    return get_template_index(presets).match(document_features(pdf_ref, name))
@@ -158,6 +158,12 @@ class UIState:
             df.to_csv(csv_path, index=False, encoding='utf-8-sig')
             output_files["csv"] = csv_path
             
+            # Salvar Parquet (tipos preservados)
+            from app.save_utils import write_arrow_file
+            parquet_path = os.path.join(output_dir, f"tabela_{timestamp}.parquet")
+            write_arrow_file(df, parquet_path)
+            output_files["parquet"] = parquet_path
+            
         except Exception as e:
             st.error(f"Erro ao salvar outputs: {e}")
         